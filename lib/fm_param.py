@@ -45,6 +45,17 @@ class FmConst:
     gentooLinuxCacheDir = os.path.join(portageCacheDir, "gentoo-linux")
     mswinCacheDir = os.path.join(portageCacheDir, "ms-win")
 
+    sysmanCacheDir = "/var/cache/sysman"
+    fileVerifyCacheFile = os.path.join(sysmanCacheDir, "file-verify.cache")
+    installedFileIndexFile = os.path.join(sysmanCacheDir, "installed-file-index.cache")
+    pkgExtraFilesCacheFile = os.path.join(sysmanCacheDir, "pkg-extra-files.cache")
+    pkgCheckCheckpointFile = os.path.join(sysmanCacheDir, "pkg-check.checkpoint")
+    md5CacheIndexFile = os.path.join(sysmanCacheDir, "md5-cache-index.cache")
+    pkgFileSampleCursorFile = os.path.join(sysmanCacheDir, "pkg-file-sample.cursor")
+    preEnableIndexFile = os.path.join(sysmanCacheDir, "pre-enable-index.cache")
+    cloudOverlayDbCacheDir = os.path.join(sysmanCacheDir, "cloud-overlay-db")
+    portagePatchCacheDir = os.path.join(sysmanCacheDir, "portage-patch")
+
     bbkiKernelFile = os.path.join(portageCfgDir, "bbki.kernel")
     bbkiKernelAddonDir = os.path.join(portageCfgDir, "bbki.kernel_addon")
     bbkiMaskDir = os.path.join(portageCfgDir, "bbki.mask")
@@ -20,12 +20,16 @@ import pathlib
 import asyncio
 import asyncio_pool
 import socket
+import ntplib
 import struct
+import pickle
 import filecmp
 import fnmatch
+import statistics
 import gstage4
 import pyudev
 import random
+import runpy
 import termios
 import hashlib
 import tempfile
@@ -35,8 +39,14 @@ import portage
 import platform
 import threading
 import subprocess
+import traceback
+import multiprocessing
+import concurrent.futures
+import importlib.machinery
 import lxml.html
+import strict_fsh
 import passlib.hosts
+import urllib.parse
 import urllib.request
 import urllib.error
 import robust_layer
@@ -335,6 +345,14 @@ class FmUtil:
         else:
             assert False
 
+    @staticmethod
+    def parseSize(value):
+        # "100", "512K", "20M", "4G", "1T", "4GiB" -> value in bytes
+        m = re.fullmatch("([0-9]+)([KMGT]?)(i?B)?", value.strip(), re.I)
+        if m is None:
+            raise ValueError("invalid size \"%s\"" % (value))
+        return int(m.group(1)) * (1024 ** " KMGT".index(m.group(2).upper() if m.group(2) != "" else " "))
+
     @staticmethod
     def formatFlops(value):
         # value is in gflops
@@ -714,9 +732,45 @@ class FmUtil:
         return ret
 
     @staticmethod
-    def isTwoDirSame(dir1, dir2):
-        # FIXME: we could use python to do this
-        return FmUtil.cmdCallWithRetCode("diff", "-r", dir1, dir2)[0] == 0
+    def isTwoDirSame(dir1, dir2, ioThrottle=None):
+        # same as "diff -r", symlinks are followed, broken symlink, unreadable file or directory makes the result false
+        try:
+            nameList = sorted(os.listdir(dir1))
+            if nameList != sorted(os.listdir(dir2)):
+                return False
+            for fn in nameList:
+                fullfn1 = os.path.join(dir1, fn)
+                fullfn2 = os.path.join(dir2, fn)
+                st1 = os.stat(fullfn1)                  # broken symlink raises OSError, "diff -r" reports it as trouble
+                st2 = os.stat(fullfn2)
+                if stat.S_ISDIR(st1.st_mode) or stat.S_ISDIR(st2.st_mode):
+                    if not (stat.S_ISDIR(st1.st_mode) and stat.S_ISDIR(st2.st_mode)):
+                        return False
+                    if not FmUtil.isTwoDirSame(fullfn1, fullfn2, ioThrottle):
+                        return False
+                elif not stat.S_ISREG(st1.st_mode) or not stat.S_ISREG(st2.st_mode):
+                    # "diff -r" treats character and block special files as same only if they are the same device, other special files are always different
+                    if stat.S_ISCHR(st1.st_mode) and stat.S_ISCHR(st2.st_mode) and st1.st_rdev == st2.st_rdev:
+                        continue
+                    if stat.S_ISBLK(st1.st_mode) and stat.S_ISBLK(st2.st_mode) and st1.st_rdev == st2.st_rdev:
+                        continue
+                    return False
+                else:
+                    if st1.st_size != st2.st_size:
+                        return False
+                    with open(fullfn1, "rb") as f1, open(fullfn2, "rb") as f2:
+                        while True:
+                            block1 = f1.read(65536)
+                            block2 = f2.read(65536)
+                            if ioThrottle is not None:
+                                ioThrottle.consume(len(block1) + len(block2))
+                            if block1 != block2:
+                                return False
+                            if len(block1) == 0:
+                                break
+            return True
+        except OSError:
+            return False
 
     @staticmethod
     def fileHasSameContent(filename1, filename2):
@@ -998,6 +1052,38 @@ class FmUtil:
                 s.close()
         raise Exception("No valid tcp port in [%d,%d]." % (start_port, end_port))
 
+    @staticmethod
+    def queryNtpOffset(serverList, timeout=2, answerCount=3, graceTime=0.5, port="ntp"):
+        # query all the servers concurrently, returns median offset of the first answerCount answers
+        # after the first answer, other servers have only graceTime to answer
+        # slow or filtered servers are abandoned, their threads end by the socket timeout
+        offsetList = []
+        lastError = None
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(serverList))
+        try:
+            deadline = time.monotonic() + timeout
+            jobSet = set([pool.submit(ntplib.NTPClient().request, x, port=port, timeout=timeout) for x in serverList])
+            while len(jobSet) > 0 and len(offsetList) < answerCount:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    break
+                doneSet, jobSet = concurrent.futures.wait(jobSet, timeout=remain, return_when=concurrent.futures.FIRST_COMPLETED)
+                for job in doneSet:
+                    try:
+                        offsetList.append(job.result().offset)
+                    except Exception as e:
+                        lastError = e
+                if len(offsetList) > 0:
+                    deadline = min(deadline, time.monotonic() + graceTime)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        if len(offsetList) == 0:
+            if lastError is not None:
+                raise lastError
+            raise Exception("no answer from NTP servers in %d seconds" % (timeout))
+        return statistics.median(offsetList[:answerCount])
+
     @staticmethod
     def waitTcpService(ip, port):
         ip = ip.replace(".", "\\.")
@@ -1212,42 +1298,6 @@ class FmUtil:
         # fatal error: can not get repoName
         return None
 
-    @staticmethod
-    def repoGetPkgExtraFilesWildcards(pkgDbDir, pkgAtom):
-        # get the content of pkg_extra_files()
-        ebuildFullFn = glob.glob(os.path.join(pkgDbDir, pkgAtom, "*.ebuild"))[0]
-        lineList = pathlib.Path(ebuildFullFn).read_text().split("\n")
-        startIdx = None
-        endIdx = None
-        for i in range(0, len(lineList)):
-            if lineList[i] == "pkg_extra_files() {":
-                startIdx = i
-                continue
-            if startIdx is not None and lineList[i] == "}":
-                endIdx = i
-                break
-        if startIdx is None:
-            return []
-
-        # run pkg_extra_files(), get the result
-        # FIXME: not the context only have CHOST, it lacks a lot
-        funcContent = "\n".join(lineList[startIdx:endIdx+1])
-        ret = FmUtil.cmdCall("bash", "-c", "%s\nexport CHOST=%s\npkg_extra_files" % (funcContent, FmUtil.portageGetChost()))
-
-        # convert the result to wildcards
-        wildcards = []
-        for w in ret.split("\n"):
-            w = w.strip()
-            if w == "" or w.startswith("#"):
-                continue
-            if w.startswith("~"):
-                continue
-            wildcards.append("+ %s" % (w))
-            if os.path.realpath(w) != w:
-                wildcards.append("+ %s" % (os.path.realpath(w)))
-
-        return wildcards
-
     @staticmethod
     def wgetSpider(url):
         return FmUtil.cmdCallTestSuccess("wget", "--spider", url)
@@ -1412,51 +1462,6 @@ class FmUtil:
             pkgAtomList.append(fbasename)
         return pkgAtomList
 
-    @staticmethod
-    def portageGetInstalledFileSet(expanded=False):
-        fileSet = set()
-
-        if True:
-            cmdStr = r"cat /var/db/pkg/*/*/CONTENTS "
-            cmdStr += r'| sed -e "s:^obj \(.*\) [[:xdigit:]]\+ [[:digit:]]\+$:\1:" '
-            cmdStr += r'| sed -e "s:^sym \(.*\) -> .* .*$:\1:" '
-            cmdStr += r'| sed -e "s:^dir \(.*\)$:\1:" '
-            ret = FmUtil.shellCall(cmdStr)
-            fileSet = set(ret.split("\n"))
-
-        if expanded:
-            # deal with .keep
-            nret = set()
-            for f in fileSet:
-                if os.path.isdir(f) and os.path.exists(os.path.join(f, ".keep")):
-                    nret.add(os.path.join(f, ".keep"))
-            fileSet |= nret
-
-            # deal with *.py
-            nret = set()
-            for f in fileSet:
-                if f.endswith(".py"):
-                    if os.path.exists(f + "c"):
-                        nret.add(f + "c")
-                    if os.path.exists(f + "o"):
-                        nret.add(f + "o")
-            fileSet |= nret
-
-            # deal with __pycache__
-            for dn in ["/usr/lib", "/usr/lib64", "/usr/libexec"]:
-                ret = FmUtil.cmdCall("find", dn, "-regex", r'.*/__pycache__\(/.*\)?')
-                fileSet |= set(ret.split("\n"))
-
-            # deal with directory symlink
-            nret = set()
-            for f in fileSet:
-                f2 = os.path.join(os.path.realpath(os.path.dirname(f)), os.path.basename(f))
-                if f2 != f:
-                    nret.add(f2)
-            fileSet |= nret
-
-        return fileSet
-
     @staticmethod
     def portageReadCfgMaskFile(filename):
         """Returns list<package-atom>"""
@@ -1632,35 +1637,74 @@ class FmUtil:
         return ret
 
     @staticmethod
-    def portagePatchRepository(repoName, repoDir, patchTypeName, patchDir, jobNumber=None):
-        # patch eclass files
-        eclassDir = os.path.join(patchDir, "eclass")
-        if os.path.exists(eclassDir):
-            dstDir = os.path.join(repoDir, "eclass")
-            FmUtil._portagePatchRepositoryExecScript(repoName, patchTypeName, patchDir, eclassDir, dstDir)
-
-        # patch profile files
-        profilesDir = os.path.join(patchDir, "profiles")
-        if os.path.exists(profilesDir):
-            dstDir = os.path.join(repoDir, "profiles")
-            FmUtil._portagePatchRepositoryExecScript(repoName, patchTypeName, patchDir, profilesDir, dstDir)
-
-        # patch packages
-        pendingDstDirList = []
-        for categoryDir in os.listdir(patchDir):
+    def getProcessPoolContext():
+        # we may be called in a multi-threaded process, forking it can deadlock the child on locks held by other threads, so use forkserver
+        # our main scripts have no "if __name__ == '__main__'" guard, give __main__ a spec so that multiprocessing does not re-run them in the children
+        mainModule = sys.modules["__main__"]
+        if getattr(mainModule, "__spec__", None) is None:
+            mainModule.__spec__ = importlib.machinery.ModuleSpec("__main__", None)
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["fm_util"])
+        return ctx
+
+    @staticmethod
+    def portagePatchRepository(repoName, repoDir, patchTypeName, patchDir, jobNumber=None, cacheDir=None):
+        # scripts are run in long-lived worker processes to avoid interpreter startup for each script
+        # worker processes are used instead of threads because scripts operate on the current directory
+        # scripts of a directory are run in one worker in file name order, different directories are patched in parallel
+        # patched package directories are cached in cacheDir, keyed by fingerprint of the upstream content and the scripts,
+        # cached result (Manifest included) is restored when the fingerprint is not changed, eclass and profiles are always patched
+        jobList = []
+        for dirName in ["eclass", "profiles"]:
+            srcDir = os.path.join(patchDir, dirName)
+            if os.path.exists(srcDir):
+                jobList.append((srcDir, os.path.join(repoDir, dirName), None))
+        for categoryDir in sorted(os.listdir(patchDir)):
             if categoryDir in ["README", "eclass", "profiles"]:
                 continue
             fullCategoryDir = os.path.join(patchDir, categoryDir)
-            for ebuildDir in os.listdir(fullCategoryDir):
-                srcDir = os.path.join(fullCategoryDir, ebuildDir)
-                dstDir = os.path.join(repoDir, categoryDir, ebuildDir)
-                FmUtil._portagePatchRepositoryExecScript(repoName, patchTypeName, patchDir, srcDir, dstDir)
+            for ebuildDir in sorted(os.listdir(fullCategoryDir)):
+                jobList.append((os.path.join(fullCategoryDir, ebuildDir), os.path.join(repoDir, categoryDir, ebuildDir), fullCategoryDir))
+
+        if cacheDir is not None:
+            cacheDir = os.path.join(cacheDir, "%s.%s" % (repoName, patchTypeName))
+
+        # patch eclass files, profile files and packages
+        # messages and errors are reported in the order of jobList
+        pendingDstDirList = []
+        saveList = []
+        usedSet = set()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobNumber, mp_context=FmUtil.getProcessPoolContext()) as pool:
+            futureList = []
+            for srcDir, dstDir, fullCategoryDir in jobList:
+                futureList.append(pool.submit(FmUtil._portagePatchRepositoryPatchDir, repoName, patchTypeName, patchDir, srcDir, dstDir,
+                                              cacheDir if fullCategoryDir is not None else None))
+            for i in range(0, len(jobList)):
+                srcDir, dstDir, fullCategoryDir = jobList[i]
+                try:
+                    msgList, fingerprint, bRestored = futureList[i].result()
+                except BaseException as e:
+                    for f in futureList[i + 1:]:
+                        f.cancel()
+                    if isinstance(e, subprocess.CalledProcessError):
+                        print(e.output)                 # same as FmUtil.cmdCall()
+                    raise
+                for msg in msgList:
+                    print(msg)
+                if fullCategoryDir is None:
+                    continue
+                if fingerprint is not None:
+                    usedSet.add(fingerprint)
+                    if not bRestored:
+                        saveList.append((dstDir, fingerprint, msgList))
                 if len(glob.glob(os.path.join(dstDir, "*.ebuild"))) == 0:
                     # all ebuild files are deleted, it means this package is removed
                     robust_layer.simple_fops.rm(dstDir)
                     if len(os.listdir(fullCategoryDir)) == 0:
                         robust_layer.simple_fops.rm(fullCategoryDir)
                     continue
+                if bRestored:
+                    continue
                 pendingDstDirList.append(dstDir)
 
         # generate manifest for patched packages
@@ -1669,28 +1713,158 @@ class FmUtil:
             pool = asyncio_pool.AioPool(loop=loop)
         else:
             pool = asyncio_pool.AioPool(size=jobNumber, loop=loop)
+        manifestFutureDict = dict()
         for dstDir in pendingDstDirList:
-            pool.spawn_n(FmUtil._portagePatchRepositoryGenEbuildManifest(dstDir))
+            manifestFutureDict[dstDir] = pool.spawn_n(FmUtil._portagePatchRepositoryGenEbuildManifest(dstDir))
         loop.run_until_complete(pool.join())
 
+        # save patched package directories, remove cache entries not used any more
+        # package directory is not saved if its manifest is failed to generate
+        if cacheDir is not None:
+            try:
+                os.makedirs(cacheDir, exist_ok=True)
+                for dstDir, fingerprint, msgList in saveList:
+                    if dstDir in manifestFutureDict and manifestFutureDict[dstDir].exception() is not None:
+                        usedSet.discard(fingerprint)
+                        continue
+                    FmUtil._portagePatchRepositorySaveCache(cacheDir, fingerprint, msgList, dstDir)
+                for fn in os.listdir(cacheDir):
+                    if fn not in usedSet:
+                        os.unlink(os.path.join(cacheDir, fn))
+            except OSError:
+                pass                # cache is optional
+
+    @staticmethod
+    def _portagePatchRepositoryPatchDir(repoName, patchTypeName, patchDir, srcDir, dstDir, cacheDir):
+        # runs in worker process, returns (messages-to-be-printed, fingerprint, restored-from-cache)
+        fingerprint = None
+        if cacheDir is not None and os.path.isdir(dstDir):
+            fingerprint = FmUtil._portagePatchRepositoryFingerprint(srcDir, dstDir)
+            cacheFile = os.path.join(cacheDir, fingerprint)
+            if os.path.exists(cacheFile):
+                try:
+                    with open(cacheFile, "rb") as f:
+                        msgList, fileList = pickle.load(f)
+                except Exception:
+                    pass            # a corrupt cache entry is the same as no cache entry
+                else:
+                    FmUtil._portagePatchRepositoryRestoreDir(dstDir, fileList)
+                    return (msgList, fingerprint, True)
+        return (FmUtil._portagePatchRepositoryExecScript(repoName, patchTypeName, patchDir, srcDir, dstDir), fingerprint, False)
+
+    @staticmethod
+    def _portagePatchRepositoryFingerprint(srcDir, dstDir):
+        h = hashlib.sha256()
+        h.update(b"1\0")                   # cache format version
+        for dirPath in [srcDir, dstDir]:
+            for item in FmUtil._portagePatchRepositoryReadDir(dirPath):
+                h.update(repr(item).encode("utf-8"))
+                h.update(b"\0")
+            h.update(b"\0")
+        return h.hexdigest()
+
+    @staticmethod
+    def _portagePatchRepositoryReadDir(dirPath):
+        # returns [(relative-path, "dir"|"file"|"sym", mode, content|link-target)] in path order
+        ret = []
+        for root, dirs, files in os.walk(dirPath):
+            dirs.sort()
+            for fn in sorted(dirs + files):
+                fullfn = os.path.join(root, fn)
+                relfn = os.path.relpath(fullfn, dirPath)
+                st = os.lstat(fullfn)
+                if stat.S_ISLNK(st.st_mode):
+                    ret.append((relfn, "sym", 0, os.readlink(fullfn)))
+                elif stat.S_ISDIR(st.st_mode):
+                    ret.append((relfn, "dir", stat.S_IMODE(st.st_mode), None))
+                else:
+                    ret.append((relfn, "file", stat.S_IMODE(st.st_mode), pathlib.Path(fullfn).read_bytes()))
+        return ret
+
+    @staticmethod
+    def _portagePatchRepositoryRestoreDir(dstDir, fileList):
+        for fn in os.listdir(dstDir):
+            robust_layer.simple_fops.rm(os.path.join(dstDir, fn))
+        for relfn, fType, mode, data in fileList:
+            fullfn = os.path.join(dstDir, relfn)
+            if fType == "dir":
+                os.mkdir(fullfn, mode)
+            elif fType == "sym":
+                os.symlink(data, fullfn)
+            elif fType == "file":
+                with open(fullfn, "wb") as f:
+                    f.write(data)
+                os.chmod(fullfn, mode)
+            else:
+                assert False
+
+    @staticmethod
+    def _portagePatchRepositorySaveCache(cacheDir, fingerprint, msgList, dstDir):
+        # package removed by the scripts is saved as an empty file list
+        fileList = FmUtil._portagePatchRepositoryReadDir(dstDir) if os.path.exists(dstDir) else []
+        cacheFile = os.path.join(cacheDir, fingerprint)
+        tmpFile = cacheFile + ".tmp"
+        with open(tmpFile, "wb") as f:
+            pickle.dump((msgList, fileList), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpFile, cacheFile)
+
     @staticmethod
     def _portagePatchRepositoryExecScript(repoName, patchTypeName, patchDir, srcDir, dstDir):
-        for fullfn in glob.glob(os.path.join(srcDir, "*")):
+        # runs in worker process, returns messages to be printed
+        ret = []
+        for fullfn in sorted(glob.glob(os.path.join(srcDir, "*"))):
             if not os.path.isfile(fullfn):
                 continue
             if not os.path.exists(dstDir):
-                print("%s script \"%s\" for \"%s\" is outdated." % (patchTypeName, fullfn[len(patchDir) + 1:], repoName))
+                ret.append("%s script \"%s\" for \"%s\" is outdated." % (patchTypeName, fullfn[len(patchDir) + 1:], repoName))
                 continue
             out = None
             with TempChdir(dstDir):
                 assert fullfn.endswith(".py")
-                out = FmUtil.cmdCall("python3", fullfn)     # FIXME, should respect shebang
+                out = FmUtil._portagePatchRepositoryRunScript(fullfn)     # FIXME, should respect shebang
             if out == "outdated":
-                print("WARNING: %s script \"%s\" for \"%s\" is outdated." % (patchTypeName, fullfn[len(patchDir) + 1:], repoName))
+                ret.append("WARNING: %s script \"%s\" for \"%s\" is outdated." % (patchTypeName, fullfn[len(patchDir) + 1:], repoName))
             elif out == "":
                 pass
             else:
                 raise Exception("%s script \"%s\" for \"%s\" exits with error \"%s\"." % (patchTypeName, fullfn[len(patchDir) + 1:], repoName, out))
+        return ret
+
+    @staticmethod
+    def _portagePatchRepositoryRunScript(fullfn):
+        # run script in the current process, returns output the same as FmUtil.cmdCall("python3", fullfn)
+        # stdout and stderr are redirected at file descriptor level so that output of the sub-processes of the script is also got
+        retcode = 0
+        with tempfile.TemporaryFile() as tmpf:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            oldStdout = os.dup(1)
+            oldStderr = os.dup(2)
+            try:
+                os.dup2(tmpf.fileno(), 1)
+                os.dup2(tmpf.fileno(), 2)
+                try:
+                    runpy.run_path(fullfn, run_name="__main__")
+                except SystemExit as e:
+                    if e.code is not None and e.code != 0:
+                        if not isinstance(e.code, int):
+                            print(e.code, file=sys.stderr)
+                        retcode = e.code if isinstance(e.code, int) else 1
+                except Exception:
+                    traceback.print_exc()
+                    retcode = 1
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os.dup2(oldStdout, 1)
+                os.dup2(oldStderr, 2)
+                os.close(oldStdout)
+                os.close(oldStderr)
+            tmpf.seek(0)
+            out = tmpf.read().decode("utf-8", errors="replace")
+        if retcode != 0:
+            raise subprocess.CalledProcessError(retcode, ["python3", fullfn], output=out)
+        return out.rstrip()
 
     @staticmethod
     async def _portagePatchRepositoryGenEbuildManifest(ebuildDir):
@@ -1946,13 +2120,15 @@ class FmUtil:
         return "/" + newPath
 
     @staticmethod
-    def verifyFileMd5(filename, md5sum):
+    def verifyFileMd5(filename, md5sum, ioThrottle=None):
         with open(filename, "rb") as f:
             thash = hashlib.md5()
             while True:
                 block = f.read(65536)
                 if len(block) == 0:
                     break
+                if ioThrottle is not None:
+                    ioThrottle.consume(len(block))
                 thash.update(block)
             return thash.hexdigest() == md5sum
 
@@ -2335,6 +2511,106 @@ class TempCreateFile:
         os.unlink(self._fn)
 
 
+class PortageResolverSession:
+
+    """
+    Holds the porttree of the running portage config, caches match(), visible match and aux_get() results until invalidate() is called.
+    Atoms of the same package are answered by one visible match of the package, slot is got from cached aux_get() results.
+    Porttree is not thread-safe, so all queries are serialized.
+    """
+
+    def __init__(self):
+        self._porttree = None                   # got when first used
+        self._lock = threading.RLock()
+        self._matchCache = dict()
+        self._matchAllCache = dict()
+        self._auxCache = dict()
+        self._implicitIuseSet = None
+
+    def match(self, atom):
+        """Same as porttree.dbapi.match()"""
+        with self._lock:
+            if atom not in self._matchCache:
+                self._matchCache[atom] = self._matchOne(atom)
+            return list(self._matchCache[atom])
+
+    def xmatchAll(self, atom):
+        """Same as porttree.dbapi.xmatch("match-all", atom), masked versions are also matched"""
+        with self._lock:
+            if atom not in self._matchAllCache:
+                self._matchAllCache[atom] = self._getPorttree().dbapi.xmatch("match-all", atom)
+            return list(self._matchAllCache[atom])
+
+    def matchBatch(self, atomList):
+        """Returns dict<atom, list<cpv>>"""
+        return {x: self.match(x) for x in atomList}
+
+    def isPkgInstallable(self, atom):
+        return len(self.match(atom)) > 0
+
+    def invalidate(self):
+        """Drop all the cached results, it should be called after portage configuration or repositories are modified"""
+        with self._lock:
+            self._porttree = None
+            self._matchCache = dict()
+            self._matchAllCache = dict()
+            self._auxCache = dict()
+            self._implicitIuseSet = None
+
+    def auxGet(self, cpv, key):
+        with self._lock:
+            if (cpv, key) not in self._auxCache:
+                self._auxCache[(cpv, key)] = self._getPorttree().dbapi.aux_get(cpv, [key])[0]
+            return self._auxCache[(cpv, key)]
+
+    def getImplicitIuseSet(self):
+        """Returns set<use-flag> that are in IUSE of all the packages implicitly, such as ARCH and flags of USE_EXPAND_IMPLICIT, like profile-iuse-inject does"""
+        with self._lock:
+            if self._implicitIuseSet is None:
+                settings = self._getPorttree().settings
+                ret = set(settings.get("IUSE_IMPLICIT", "").split())
+                unprefixedList = settings.get("USE_EXPAND_UNPREFIXED", "").split()
+                prefixedList = settings.get("USE_EXPAND", "").split()
+                for var in settings.get("USE_EXPAND_IMPLICIT", "").split():
+                    valueList = settings.get("USE_EXPAND_VALUES_" + var, "").split()
+                    if var in unprefixedList:
+                        ret.update(valueList)
+                    elif var in prefixedList:
+                        ret.update([var.lower() + "_" + x for x in valueList])
+                self._implicitIuseSet = ret
+            return self._implicitIuseSet
+
+    def _matchOne(self, atom):
+        try:
+            a = portage.dep.Atom(atom)
+        except portage.exception.InvalidAtom:
+            a = None
+
+        # atoms that the matching below can't deal with are sent to porttree directly
+        if a is None or a.blocker or a.use is not None or a.repo is not None or a.slot_operator is not None or atom == a.cp:
+            return self._getPorttree().dbapi.match(atom)
+
+        # match against the visible versions of the package
+        if a.cp not in self._matchCache:
+            self._matchCache[a.cp] = self._getPorttree().dbapi.match(a.cp)
+        if a.slot is None:
+            return portage.dep.match_from_list(a, self._matchCache[a.cp])
+        ret = []
+        for cpv in portage.dep.match_from_list(a.without_slot, self._matchCache[a.cp]):
+            slot = self.auxGet(cpv, "SLOT").split("/")
+            if slot[0] != a.slot:
+                continue
+            if a.sub_slot is not None and (len(slot) < 2 or slot[1] != a.sub_slot):
+                continue
+            ret.append(cpv)
+        return ret
+
+    def _getPorttree(self):
+        if self._porttree is None:
+            self._porttree = portage.db[portage.root]["porttree"]
+        return self._porttree
+
+
 class InfoPrinter:
 
     class _InfoPrinterInfoIndenter:
@@ -2368,6 +2644,10 @@ class InfoPrinter:
         self._t = blessed.Terminal()
         self._indent = 0
         self._curIndenter = None
+        self._errorCount = 0
+
+    def getErrorCount(self):
+        return self._errorCount
 
     def incIndent(self):
         self._indent = self._indent + 1
@@ -2393,6 +2673,8 @@ class InfoPrinter:
             print(line)
 
     def printError(self, s):
+        self._errorCount += 1
+
         line = ""
         line += self._t.red("*") + " "
         line += "\t" * self._indent
@@ -2412,6 +2694,324 @@ class InfoPrinter:
         return self._InfoPrinterInfoIndenter(self, s, bRecallable)
 
 
+class TaskPrinter:
+
+    """
+    InfoPrinter for a task which runs concurrently with other tasks.
+    Output is recorded when the task is not at the front, it is replayed to the real InfoPrinter when the task comes to the front,
+    after that, output goes to the real InfoPrinter directly.
+    Recorded events are spilled to a temporary file when raw output in memory exceeds maxBufferSize, so memory usage does not grow with the output.
+    """
+
+    class _TaskPrinterInfoIndenter:
+
+        def __init__(self, parent, message, bRecallable=False):
+            self._parent = parent
+            self._parent._addEvent(("enter", message, bRecallable))
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, type, value, traceback):
+            self._parent._addEvent(("exit",))
+
+    def __init__(self, infoPrinter, maxBufferSize=1024 * 1024):
+        self._infoPrinter = infoPrinter
+        self._maxBufferSize = maxBufferSize
+        self._lock = threading.Lock()
+        self._eventList = []
+        self._rawSize = 0
+        self._spillFile = None
+        self._indenterList = []
+        self._bLive = False
+        self._errorCount = 0
+
+    def getErrorCount(self):
+        return self._errorCount
+
+    def printInfo(self, s):
+        self._addEvent(("info", s))
+
+    def printError(self, s):
+        self._errorCount += 1
+        self._addEvent(("error", s))
+
+    def printInfoAndIndent(self, s, bRecallable=False):
+        return self._TaskPrinterInfoIndenter(self, s, bRecallable)
+
+    def printRaw(self, buf):
+        # buf is str or bytes written to stdout by the task
+        self._addEvent(("raw", buf))
+
+    def isLive(self):
+        return self._bLive
+
+    def setLive(self):
+        with self._lock:
+            if not self._bLive:
+                for event in self._eventList:
+                    self._applyEvent(event)
+                self._eventList = []
+                self._rawSize = 0
+                if self._spillFile is not None:
+                    # events in spill file are all after the ones in memory
+                    self._spillFile.seek(0)
+                    while True:
+                        try:
+                            event = pickle.load(self._spillFile)
+                        except EOFError:
+                            break
+                        self._applyEvent(event)
+                    self._spillFile.close()
+                    self._spillFile = None
+                self._bLive = True
+
+    def _addEvent(self, event):
+        with self._lock:
+            if self._bLive:
+                self._applyEvent(event)
+                return
+            if self._spillFile is None and event[0] == "raw":
+                self._rawSize += len(event[1])
+                if self._rawSize > self._maxBufferSize:
+                    self._spillFile = tempfile.TemporaryFile()
+            if self._spillFile is not None:
+                pickle.dump(event, self._spillFile, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                self._eventList.append(event)
+
+    def _applyEvent(self, event):
+        if event[0] == "info":
+            self._infoPrinter.printInfo(event[1])
+        elif event[0] == "error":
+            self._infoPrinter.printError(event[1])
+        elif event[0] == "enter":
+            self._indenterList.append(self._infoPrinter.printInfoAndIndent(event[1], event[2]))
+        elif event[0] == "exit":
+            self._indenterList.pop().__exit__(None, None, None)
+        elif event[0] == "raw":
+            if isinstance(event[1], bytes):
+                sys.stdout.buffer.write(event[1])
+            else:
+                sys.stdout.write(event[1])
+            sys.stdout.flush()
+        else:
+            assert False
+
+
+class TaskStdout:
+
+    """
+    Replacement of sys.stdout when DagTaskRunner runs, what a task thread writes goes to its TaskPrinter, so that output of sub-modules is also kept grouped.
+    Other threads and tasks at the output front write to the real stdout directly.
+    Output of sub-processes does not go through sys.stdout, it should be piped and written to sys.stdout.buffer by the caller.
+    """
+
+    class _Buffer:
+
+        def __init__(self, parent):
+            self._parent = parent
+
+        def write(self, buf):
+            return self._parent._write(buf, self._parent._real.buffer)
+
+        def flush(self):
+            self._parent._real.buffer.flush()
+
+    def __init__(self, real, tls):
+        self._real = real
+        self._tls = tls
+        self.buffer = self._Buffer(self)
+
+    def write(self, s):
+        return self._write(s, self._real)
+
+    def flush(self):
+        self._real.flush()
+
+    def isatty(self):
+        # output of a task not at the front is recorded
+        printer = getattr(self._tls, "printer", None)
+        if printer is None or printer.isLive():
+            return self._real.isatty()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._real, name)
+
+    def _write(self, buf, realStream):
+        printer = getattr(self._tls, "printer", None)
+        if printer is None or printer.isLive():
+            return realStream.write(buf)
+        printer.printRaw(buf)
+        return len(buf)
+
+
+class DagTaskRunner:
+
+    """
+    Run tasks concurrently as far as their dependencies allow, at most jobNumber tasks run at the same time.
+    Output of each task is kept grouped and in the order that tasks are added, so it looks the same as running tasks one by one.
+    Consecutive tasks with the same section are printed under one section title, task without title prints its own title.
+    Task function is called with a TaskPrinter as parameter, its return value can be got by getResult().
+    If bCaptureStdout is True, what tasks write to sys.stdout is also kept grouped, see TaskStdout.
+    """
+
+    class _Task:
+
+        def __init__(self, name, title, func, dependList, section):
+            self.name = name
+            self.title = title
+            self.func = func
+            self.dependList = dependList
+            self.section = section
+            self.printer = None
+            self.future = None
+            self.result = None
+            self.startTime = None
+            self.endTime = None
+
+    def __init__(self, infoPrinter, jobNumber=None, bCaptureStdout=False):
+        self._infoPrinter = infoPrinter
+        self._jobNumber = jobNumber if jobNumber is not None else os.cpu_count()
+        self._bCaptureStdout = bCaptureStdout
+        self._tls = threading.local()
+        self._taskList = []
+        self._taskDict = dict()
+        self._startTime = None
+        self._endTime = None
+
+    def addTask(self, name, title, func, dependList=[], section=None):
+        # dependencies must be added before, so there's no dependency cycle
+        assert name not in self._taskDict
+        assert all([x in self._taskDict for x in dependList])
+
+        task = self._Task(name, title, func, list(dependList), section)
+        self._taskList.append(task)
+        self._taskDict[name] = task
+
+    def addDependency(self, name, dependName):
+        # make a task depend on a task added after it, output is still in the order of adding
+        assert dependName != name and not self._isDependedOn(name, dependName)
+        self._taskDict[name].dependList.append(dependName)
+
+    def hasTask(self, name):
+        return name in self._taskDict
+
+    def getResult(self, name):
+        return self._taskDict[name].result
+
+    def getTotalTime(self):
+        return self._endTime - self._startTime
+
+    def getTimeline(self):
+        """Returns list<tuple(name, start-seconds, end-seconds)> of the started tasks, time is relative to the start of run(), in the order of starting"""
+
+        ret = []
+        for task in sorted([x for x in self._taskList if x.startTime is not None], key=lambda x: x.startTime):
+            endTime = task.endTime if task.endTime is not None else self._endTime
+            ret.append((task.name, task.startTime - self._startTime, endTime - self._startTime))
+        return ret
+
+    def getCriticalPath(self):
+        """Returns list<tuple(name, seconds)>, it is the dependency chain ending with the task finished last"""
+
+        ret = []
+        task = max([x for x in self._taskList if x.endTime is not None], key=lambda x: x.endTime)
+        while task is not None:
+            ret.insert(0, (task.name, task.endTime - task.startTime))
+            depList = [self._taskDict[x] for x in task.dependList]
+            task = max(depList, key=lambda x: x.endTime) if len(depList) > 0 else None
+        return ret
+
+    def run(self):
+        self._startTime = time.monotonic()
+        frontIdx = 0
+        sectionIndenter = None
+        bFailed = False
+        savedStdout = sys.stdout
+        if self._bCaptureStdout:
+            sys.stdout = TaskStdout(savedStdout, self._tls)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobNumber) as pool:
+                while True:
+                    # start tasks whose dependencies are all successfully finished
+                    if not bFailed:
+                        for task in self._taskList:
+                            if task.future is None and all([self._isTaskSucceeded(self._taskDict[x]) for x in task.dependList]):
+                                task.printer = TaskPrinter(self._infoPrinter)
+                                task.future = pool.submit(self._runTask, task)
+
+                    # move the output front forward
+                    while frontIdx < len(self._taskList):
+                        task = self._taskList[frontIdx]
+                        if task.future is None:
+                            break
+                        sectionIndenter = self._switchSection(sectionIndenter, task.section)
+                        task.printer.setLive()
+                        if not task.future.done():
+                            break
+                        if task.future.exception() is not None:
+                            bFailed = True
+                        frontIdx += 1
+
+                    # wait for any running task
+                    runningList = [x.future for x in self._taskList if x.future is not None and not x.future.done()]
+                    if len(runningList) == 0:
+                        if any([x.future is not None and x.future.exception() is not None for x in self._taskList]):
+                            bFailed = True
+                        if bFailed or frontIdx >= len(self._taskList):
+                            break
+                        continue
+                    concurrent.futures.wait(runningList, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            # show output of the finished tasks which are after a not started task
+            for task in self._taskList[frontIdx:]:
+                if task.future is not None:
+                    sectionIndenter = self._switchSection(sectionIndenter, task.section)
+                    task.printer.setLive()
+        finally:
+            self._switchSection(sectionIndenter, None)
+            sys.stdout = savedStdout
+            self._endTime = time.monotonic()
+
+        for task in self._taskList:
+            if task.future is not None and task.future.exception() is not None:
+                raise task.future.exception()
+
+    def _switchSection(self, sectionIndenter, section):
+        if sectionIndenter is not None:
+            if sectionIndenter[0] == section:
+                return sectionIndenter
+            sectionIndenter[1].__exit__(None, None, None)
+        if section is None:
+            return None
+        return (section, self._infoPrinter.printInfoAndIndent(section))
+
+    def _isDependedOn(self, name, byName):
+        # returns True if task byName depends on task name directly or indirectly
+        for x in self._taskDict[byName].dependList:
+            if x == name or self._isDependedOn(name, x):
+                return True
+        return False
+
+    def _isTaskSucceeded(self, task):
+        return task.future is not None and task.future.done() and task.future.exception() is None
+
+    def _runTask(self, task):
+        task.startTime = time.monotonic()
+        self._tls.printer = task.printer
+        try:
+            if task.title is not None:
+                with task.printer.printInfoAndIndent(task.title):
+                    task.result = task.func(task.printer)
+            else:
+                task.result = task.func(task.printer)
+        finally:
+            del self._tls.printer
+            task.endTime = time.monotonic()
+
+
 class PrintLoadAvgThread(threading.Thread):
 
     def __init__(self, msg):
@@ -2425,6 +3025,7 @@ class PrintLoadAvgThread(threading.Thread):
         self._width = min(self._t.width, self._max_width)
         self._stopEvent = threading.Event()
         self._firstTime = True
+        self._bTty = sys.stdout.isatty()
 
     def __enter__(self):
         self.start()
@@ -2434,10 +3035,17 @@ class PrintLoadAvgThread(threading.Thread):
         self.stop()
 
     def start(self):
+        if not self._bTty:
+            # output is piped or recorded, load average is not shown so that no control sequence is written
+            sys.stdout.write(self._msg + "\n")
+            sys.stdout.flush()
+            return
         self._print_message()
         super().start()
 
     def stop(self):
+        if not self._bTty:
+            return
         self._stopEvent.set()
         self.join()
 
@@ -2461,11 +3069,74 @@ class PrintLoadAvgThread(threading.Thread):
 
 class ParallelRunSequencialPrint:
 
-    def __init__(self):
+    """
+    Run tasks (sub-processes) concurrently, output of each task is shown in the order of adding, as if tasks are run one by one.
+    Output is read in chunks, output of the task at the front goes to stdout directly, output of other tasks is buffered,
+    buffer of a task is spilled to a temporary file when it exceeds max_buffer_size, so memory usage does not grow with the output.
+    In live mode, output of all the tasks is shown immediately, line by line, every line is prefixed with the prefix of its task.
+    Number of running tasks can be limited in total and per host (host is derived from the URL of the task),
+    tasks are started in the order of priority, then in the order of adding.
+    """
+
+    class _TaskOutput:
+
+        def __init__(self, maxBufferSize):
+            self.maxBufferSize = maxBufferSize
+            self.bFront = False
+            self.memBuf = bytearray()
+            self.spillFile = None
+            self.lineBuf = b''                  # partial line, for live mode
+            self.eofEvent = asyncio.Event()
+            self.error = None
+
+        def write(self, buf):
+            if self.bFront:
+                ParallelRunSequencialPrint._writeStdout(buf)
+                return
+            if self.spillFile is None and len(self.memBuf) + len(buf) > self.maxBufferSize:
+                self.spillFile = tempfile.TemporaryFile()
+                self.spillFile.write(self.memBuf)
+                self.memBuf = bytearray()
+            if self.spillFile is not None:
+                self.spillFile.write(buf)
+            else:
+                self.memBuf += buf
+
+        def setFront(self):
+            if self.spillFile is not None:
+                self.spillFile.seek(0)
+                while True:
+                    buf = self.spillFile.read(1024 * 1024)
+                    if buf == b'':
+                        break
+                    ParallelRunSequencialPrint._writeStdout(buf)
+                self.spillFile.close()
+                self.spillFile = None
+            if len(self.memBuf) > 0:
+                ParallelRunSequencialPrint._writeStdout(self.memBuf)
+                self.memBuf = bytearray()
+            self.bFront = True
+
+        def dispose(self):
+            if self.spillFile is not None:
+                self.spillFile.close()
+                self.spillFile = None
+
+    def __init__(self, max_jobs=None, max_jobs_per_host=None, live=False, max_buffer_size=1024 * 1024):
+        self.maxJobs = max_jobs                 # no limit if None
+        self.maxJobsPerHost = max_jobs_per_host     # no limit if None
+        self.bLive = live
+        self.maxBufferSize = max_buffer_size
         self.preFuncList = []
         self.postFuncList = []
+        self.prefixList = []
+        self.hostList = []
+        self.priorityList = []
         self.taskDataList = []
-        self.stdoutList = []
+        self.outputList = []
+        self.pendingList = []
+        self.jobCount = 0
+        self.hostJobCount = dict()
 
     def __enter__(self):
         return self
@@ -2474,44 +3145,236 @@ class ParallelRunSequencialPrint:
         self.run()
 
     # pre_func can't be a coroutine because there's no "async lambda" in python
-    def add_task(self, start_coro, start_coro_param, wait_coro, pre_func=None, post_func=None):
+    # prefix is only used in live mode
+    # url is only used to get the host for max_jobs_per_host, task with higher priority is started earlier
+    def add_task(self, start_coro, start_coro_param, wait_coro, pre_func=None, post_func=None, prefix=None, url=None, priority=0):
         self.preFuncList.append(pre_func)
         self.postFuncList.append(post_func)
+        self.prefixList.append((prefix if prefix is not None else "[%d] " % (len(self.taskDataList))).encode("utf-8"))
+        self.hostList.append(self._getUrlHost(url) if url is not None else None)
+        self.priorityList.append(priority)
         self.taskDataList.append((start_coro, start_coro_param, wait_coro))
 
     def run(self):
-        loop = asyncio.get_event_loop()
-
-        tlist = []
-        for start_coro, start_coro_param, wait_coro in self.taskDataList:
-            proc, outf = loop.run_until_complete(start_coro(*start_coro_param, loop=loop))
-            self.stdoutList.append(outf)
-            tlist.append((proc, wait_coro))
-
-        pool = asyncio_pool.AioPool(loop=loop)
-        pool.spawn_n(self._showResult())
-        for proc, wait_coro in tlist:
-            pool.spawn_n(wait_coro(proc))
-        loop.run_until_complete(pool.join())
+        loop = asyncio.new_event_loop()            # private event loop, so that it can be run in any thread
+        try:
+            loop.run_until_complete(self._run(loop))
+        finally:
+            loop.close()
+            for output in self.outputList:
+                output.dispose()
 
         self.preFuncList = []
         self.postFuncList = []
+        self.prefixList = []
+        self.hostList = []
+        self.priorityList = []
         self.taskDataList = []
-        self.stdoutList = []
+        self.outputList = []
 
-    async def _showResult(self):
-        for i in range(0, len(self.preFuncList)):
-            if self.preFuncList[i] is not None:
+    async def _run(self, loop):
+        # output of tasks that are started before the one being shown is buffered, so starting order does not affect output order
+        self.outputList = [self._TaskOutput(self.maxBufferSize) for x in self.taskDataList]
+        self.pendingList = sorted(range(0, len(self.taskDataList)), key=lambda i: -self.priorityList[i])     # sort is stable
+        self.jobCount = 0
+        self.hostJobCount = dict()
+
+        pool = asyncio_pool.AioPool(loop=loop)
+        if not self.bLive:
+            pool.spawn_n(self._showResult())
+        self._startTasks(loop, pool)
+        await pool.join()
+
+    def _startTasks(self, loop, pool):
+        # start pending tasks as long as the limits allow, a task whose host is full is skipped but not the ones after it
+        for i in list(self.pendingList):
+            if self.maxJobs is not None and self.jobCount >= self.maxJobs:
+                break
+            host = self.hostList[i]
+            if host is not None and self.maxJobsPerHost is not None and self.hostJobCount.get(host, 0) >= self.maxJobsPerHost:
+                continue
+            self.pendingList.remove(i)
+            self.jobCount += 1
+            if host is not None:
+                self.hostJobCount[host] = self.hostJobCount.get(host, 0) + 1
+            pool.spawn_n(self._runTask(loop, pool, i))
+
+    async def _runTask(self, loop, pool, i):
+        start_coro, start_coro_param, wait_coro = self.taskDataList[i]
+        output = self.outputList[i]
+        try:
+            if self.bLive and self.preFuncList[i] is not None:
                 self.preFuncList[i]()
+            proc, outf = await start_coro(*start_coro_param, loop=loop)
             while True:
-                buf = await self.stdoutList[i].read(1)      # no way to read all data in buffer, sucks
+                buf = await outf.read(65536)            # returns as soon as there's any data
                 if buf == b'':
                     break
-                sys.stdout.buffer.write(buf)
-                sys.stdout.flush()
+                if self.bLive:
+                    self._writeLines(i, buf, False)
+                else:
+                    output.write(buf)
+            if self.bLive:
+                self._writeLines(i, b'', True)
+            await wait_coro(proc)
+            if self.bLive and self.postFuncList[i] is not None:
+                self.postFuncList[i]()
+        except BaseException as e:
+            output.error = e
+            raise
+        finally:
+            output.eofEvent.set()
+            self.jobCount -= 1
+            if self.hostList[i] is not None:
+                self.hostJobCount[self.hostList[i]] -= 1
+            self._startTasks(loop, pool)
+
+    async def _showResult(self):
+        for i in range(0, len(self.taskDataList)):
+            if self.preFuncList[i] is not None:
+                self.preFuncList[i]()
+            self.outputList[i].setFront()
+            await self.outputList[i].eofEvent.wait()
+            if self.outputList[i].error is not None:
+                raise self.outputList[i].error
             if self.postFuncList[i] is not None:
                 self.postFuncList[i]()
 
+    def _writeLines(self, i, buf, bEof):
+        # "\r" is also a line separator, so that progress output is shown line by line
+        output = self.outputList[i]
+        lineList = re.split(b"[\r\n]", output.lineBuf + buf)
+        output.lineBuf = lineList.pop() if not bEof else b''
+        data = b''.join([self.prefixList[i] + x + b"\n" for x in lineList if x != b''])
+        if data != b'':
+            self._writeStdout(data)
+
+    @staticmethod
+    def _writeStdout(buf):
+        sys.stdout.buffer.write(buf)
+        sys.stdout.flush()
+
+    @staticmethod
+    def _getUrlHost(url):
+        if "://" in url:
+            return urllib.parse.urlsplit(url).hostname
+        m = re.fullmatch("(?:[^@/]+@)?([^:/]+)::?.*", url)     # "user@host:path" of git and "host::module" of rsync
+        return m.group(1) if m is not None else None
+
+
+class WildcardsMatcher:
+
+    """
+    Compile strict_fsh wildcards into regular expressions, so that a path is matched in one pass instead of rule by rule.
+    Rules are tried in order and the first matching rule decides, the same as strict_fsh.wildcards_match().
+    A rule that can't be translated is checked by strict_fsh.wildcards_match() alone, the rules around it are still compiled.
+    A directory only rule (ending with "/") needs the file type, its regex only pre-filters the path before strict_fsh checks it.
+    """
+
+    def __init__(self, wildcards):
+        self._wildcards = wildcards
+        self._bIncludeList = []
+        self._segList = []                      # list<tuple(regex, index, bConfirm)>, a compiled group of rules, or a single rule that needs strict_fsh
+
+        ptnList = []
+        for i, w in enumerate(wildcards):
+            self._bIncludeList.append(w.startswith("+ "))
+            try:
+                bDirOnly, ptn = self._translate(w)
+                re.compile(ptn)
+            except (ValueError, re.error):
+                bDirOnly, ptn = True, None
+            if not bDirOnly:
+                ptnList.append("(?P<r%d>%s)" % (i, ptn))
+                continue
+            if len(ptnList) > 0:
+                self._segList.append((re.compile("|".join(ptnList)), None, False))
+                ptnList = []
+            self._segList.append((re.compile(ptn) if ptn is not None else None, i, True))
+        if len(ptnList) > 0:
+            self._segList.append((re.compile("|".join(ptnList)), None, False))
+
+    def match(self, path):
+        i = self._getMatchedRule(path)
+        return i is not None and self._bIncludeList[i]
+
+    def isExcluded(self, path):
+        """Returns True if the first matching rule is an exclude rule, returns False if no rule matches"""
+        i = self._getMatchedRule(path)
+        return i is not None and not self._bIncludeList[i]
+
+    def filter(self, pathList):
+        return [x for x in pathList if self.match(x)]
+
+    def _getMatchedRule(self, path):
+        # returns index of the first matching rule, None if no rule matches
+        for regex, i, bConfirm in self._segList:
+            if not bConfirm:
+                m = regex.fullmatch(path)
+                if m is not None:
+                    return int(m.lastgroup[1:])
+            else:
+                if regex is not None and regex.fullmatch(path) is None:
+                    continue
+                if strict_fsh.wildcards_match(path, ["+ " + self._wildcards[i][2:]]):        # whether the rule matches doesn't depend on its sign
+                    return i
+        return None
+
+    @staticmethod
+    def _translate(wildcard):
+        # returns (bDirOnly, regex-pattern)
+        if not wildcard.startswith("+ ") and not wildcard.startswith("- "):
+            raise ValueError("invalid wildcard \"%s\"" % (wildcard))
+        ptn = wildcard[2:]
+
+        # "dir/" matches directory only, which needs file type, the regex matches the name only
+        bDirOnly = False
+        if ptn.endswith("/") and not ptn.endswith("/***") and ptn != "/":
+            ptn = ptn[:-1]
+            bDirOnly = True
+
+        # "dir/***" matches "dir" and everything in it
+        suffix = ""
+        if ptn.endswith("/***"):
+            ptn = ptn[:-4]
+            suffix = "(?:/.*)?"
+
+        # wildcard not starting with "/" matches the tail of the path
+        prefix = "" if ptn.startswith("/") else "(?:.*/)?"
+
+        body = ""
+        i = 0
+        while i < len(ptn):
+            if ptn.startswith("**", i):
+                body += ".*"
+                i += 2
+                while i < len(ptn) and ptn[i] == "*":
+                    i += 1
+            elif ptn[i] == "*":
+                body += "[^/]*"
+                i += 1
+            elif ptn[i] == "?":
+                body += "[^/]"
+                i += 1
+            elif ptn[i] == "[":
+                j = ptn.find("]", i + 2)
+                if j < 0:
+                    raise ValueError("invalid wildcard \"%s\"" % (wildcard))
+                content = ptn[i + 1:j]
+                if content.startswith("!"):
+                    content = "^" + content[1:]
+                if "\\" in content or "[" in content:
+                    raise ValueError("unsupported wildcard \"%s\"" % (wildcard))
+                body += "[%s]" % (content)
+                i = j + 1
+            elif ptn[i] == "\\":
+                raise ValueError("unsupported wildcard \"%s\"" % (wildcard))
+            else:
+                body += re.escape(ptn[i])
+                i += 1
+
+        return (bDirOnly, prefix + body + suffix)
+
 
 class SysfsHwMon:
 
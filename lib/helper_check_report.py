@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import json
+import time
+import resource
+import functools
+
+
+class CheckReport:
+
+    """
+    Records wall time, CPU time, bytes read, subprocesses spawned and findings of every check method.
+    Values are read from process wide counters (children included), so checks must be run one by one to get correct values,
+    and no background work (like a thread pool working ahead) is allowed when recording, all the threads are counted.
+    Subprocesses are counted by an audit hook, which sees subprocesses started by all the threads, too.
+    Values of a check include the checks it calls, a check called several times (like per-package checks) is recorded as a whole.
+    """
+
+    _subprocessCount = 0
+    _bAuditHookAdded = False
+
+    def __init__(self):
+        if not CheckReport._bAuditHookAdded:
+            sys.addaudithook(CheckReport._auditHook)           # audit hook can't be removed, so it is added only once
+            CheckReport._bAuditHookAdded = True
+        self._recordDict = dict()
+
+    def wrap(self, name, func, getErrorCountFunc):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            errorCount = getErrorCountFunc()
+            startTime = time.time()
+            startCounter = self._getCounter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                endCounter = self._getCounter()
+                endTime = time.time()
+                self._addRecord(name, startTime, endTime, [b - a for a, b in zip(startCounter, endCounter)], getErrorCountFunc() - errorCount)
+        return _wrapper
+
+    def getSlowestList(self, count=10):
+        """Returns list<tuple(name, seconds)>"""
+        ret = sorted(self._recordDict.items(), key=lambda x: x[1]["wall_time"], reverse=True)
+        return [(k, v["wall_time"]) for k, v in ret[:count]]
+
+    def save(self, filename, totalTime, ioThrottle=None):
+        data = {
+            "total_time": totalTime,
+            "checks": self._recordDict,
+            "slowest": [{"name": k, "wall_time": v} for k, v in self.getSlowestList()],
+        }
+        if ioThrottle is not None:
+            data["io"] = {
+                "read_bytes": ioThrottle.getTotalBytes(),
+                "read_time": ioThrottle.getTotalTime(),
+                "throughput": ioThrottle.getThroughput(),
+            }
+        with open(filename, "w") as f:
+            json.dump(data, f, indent=4)
+
+    def _addRecord(self, name, startTime, endTime, counterDiff, findings):
+        if name not in self._recordDict:
+            self._recordDict[name] = {
+                "calls": 0,
+                "start_time": startTime,
+                "end_time": endTime,
+                "wall_time": 0.0,
+                "cpu_time": 0.0,
+                "read_chars": 0,
+                "read_bytes": 0,
+                "subprocesses": 0,
+                "findings": 0,
+            }
+        r = self._recordDict[name]
+        r["calls"] += 1
+        r["end_time"] = endTime
+        r["wall_time"] += endTime - startTime
+        r["cpu_time"] += counterDiff[0]
+        r["read_chars"] += counterDiff[1]
+        r["read_bytes"] += counterDiff[2]
+        r["subprocesses"] += counterDiff[3]
+        r["findings"] += findings
+
+    def _getCounter(self):
+        # returns (cpu-time, read-chars, read-bytes, subprocess-count)
+        # reaped children are included in both getrusage(RUSAGE_CHILDREN) and /proc/self/io
+        cpuTime = 0
+        for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+            ru = resource.getrusage(who)
+            cpuTime += ru.ru_utime + ru.ru_stime
+
+        ioDict = {"rchar": 0, "read_bytes": 0}
+        if os.path.exists("/proc/self/io"):                 # kernel may have no task I/O accounting
+            with open("/proc/self/io", "r") as f:
+                for line in f:
+                    k, v = line.split(":")
+                    ioDict[k] = int(v)
+
+        return (cpuTime, ioDict["rchar"], ioDict["read_bytes"], CheckReport._subprocessCount)
+
+    @staticmethod
+    def _auditHook(event, args):
+        if event in ["subprocess.Popen", "os.system", "os.posix_spawn"]:
+            CheckReport._subprocessCount += 1
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import re
+import time
+import threading
+import contextlib
+from fm_util import FmUtil
+
+
+class IoThrottle:
+
+    """
+    Limits the read rate of read-heavy check phases to a ceiling in bytes per second, the ceiling is shared by all the threads.
+    The ceiling is lowered when the system is under I/O pressure ("some avg10" in /proc/pressure/io), down to 1/10 of it.
+    Threads in these phases can also be put into idle I/O scheduling class.
+    Bytes read and time spent are recorded to report the achieved throughput.
+    """
+
+    def __init__(self, maxRate=None, bIdlePriority=False):
+        self._maxRate = maxRate                     # bytes per second, no ceiling if None
+        self._bIdlePriority = bIdlePriority
+        self._pressureFile = "/proc/pressure/io"
+        self._pressureThreshold = 10.0              # percent of time some tasks are stalled on I/O, ceiling is lowered above it
+        self._pressureInterval = 1.0                # seconds between reads of the pressure file
+
+        self._lock = threading.Lock()
+        self._tls = threading.local()
+        self._nextTime = None                       # time when the next read is allowed
+        self._pressure = 0.0
+        self._pressureTime = None
+        self._totalBytes = 0
+        self._totalTime = 0.0
+        self._phaseCount = 0
+        self._phaseStartTime = None
+
+    def consume(self, nbytes):
+        # called after nbytes are read, sleeps to keep the read rate under the ceiling
+        with self._lock:
+            self._totalBytes += nbytes
+            if self._maxRate is None:
+                return
+            now = time.monotonic()
+            if self._nextTime is None or self._nextTime < now:
+                self._nextTime = now                # no credit is accumulated when idle
+            waitTime = self._nextTime - now
+            self._nextTime += nbytes / self._getRate(now)
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+    @contextlib.contextmanager
+    def phase(self):
+        # time of the read-heavy phases is recorded, overlapping phases are counted once
+        # I/O priority of the calling thread is set to idle in the phase
+        with self._lock:
+            if self._phaseCount == 0:
+                self._phaseStartTime = time.monotonic()
+            self._phaseCount += 1
+        bIdleSet = self._enterIdlePriority()
+        try:
+            yield
+        finally:
+            if bIdleSet:
+                self._leaveIdlePriority()
+            with self._lock:
+                self._phaseCount -= 1
+                if self._phaseCount == 0:
+                    self._totalTime += time.monotonic() - self._phaseStartTime
+
+    def threadInitializer(self):
+        # used as initializer of thread pools that run in a phase, pool threads are never restored
+        self._enterIdlePriority()
+
+    def getTotalBytes(self):
+        return self._totalBytes
+
+    def getTotalTime(self):
+        return self._totalTime
+
+    def getThroughput(self):
+        """Returns bytes per second, None if nothing is read"""
+        if self._totalBytes == 0 or self._totalTime == 0:
+            return None
+        return self._totalBytes / self._totalTime
+
+    def _getRate(self, now):
+        if self._pressureTime is None or now - self._pressureTime >= self._pressureInterval:
+            self._pressure = self._readPressure()
+            self._pressureTime = now
+        if self._pressure <= self._pressureThreshold:
+            return self._maxRate
+        return self._maxRate * max(0.1, self._pressureThreshold / self._pressure)
+
+    def _readPressure(self):
+        # content: "some avg10=0.00 avg60=0.00 avg300=0.00 total=0"
+        if not os.path.exists(self._pressureFile):
+            return 0.0                              # kernel has no PSI support, the ceiling is fixed
+        try:
+            with open(self._pressureFile, "r") as f:
+                for line in f:
+                    if line.startswith("some "):
+                        for item in line.split()[1:]:
+                            k, v = item.split("=")
+                            if k == "avg10":
+                                return float(v)
+        except (OSError, ValueError):
+            pass
+        return 0.0
+
+    def _enterIdlePriority(self):
+        if not self._bIdlePriority or getattr(self._tls, "bIdle", False):
+            return False
+        # ioprio is per-thread, threads and processes created afterwards inherit it
+        tid = str(threading.get_native_id())
+        self._tls.oldPriority = self._getPriority(tid)
+        FmUtil.cmdCall("ionice", "-c", "3", "-p", tid)
+        self._tls.bIdle = True
+        return True
+
+    def _leaveIdlePriority(self):
+        ioClass, ioLevel = self._tls.oldPriority
+        if ioLevel is not None:
+            FmUtil.cmdCall("ionice", "-c", ioClass, "-n", ioLevel, "-p", str(threading.get_native_id()))
+        else:
+            FmUtil.cmdCall("ionice", "-c", ioClass, "-p", str(threading.get_native_id()))
+        self._tls.bIdle = False
+
+    def _getPriority(self, tid):
+        # output of "ionice -p": "none: prio 0", "best-effort: prio 4", "realtime: prio 0" or "idle"
+        classDict = {
+            "none": "0",
+            "realtime": "1",
+            "best-effort": "2",
+            "idle": "3",
+        }
+        out = FmUtil.cmdCall("ionice", "-p", tid)
+        m = re.fullmatch("(\\S+?)(?:: prio ([0-9]+))?", out)
+        if m is None or m.group(1) not in classDict:
+            raise Exception("invalid output of ionice: %s" % (out))
+        return (classDict[m.group(1)], m.group(2) if m.group(1) in ["realtime", "best-effort"] else None)      # level is only meaningful for these classes
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import pickle
+import hashlib
+
+
+class PkgCheckCheckpoint:
+
+    """
+    Records the state of every package that passed the per-package check, state is (COUNTER, digest of CONTENTS and CONTENTS_2).
+    Incremental check only checks packages that are added, re-built or changed since the checkpoint, plus a rotating sample of the rest,
+    so that every package is checked again after some runs.
+    Package that fails the check is not recorded, so it is checked again in the next run.
+    """
+
+    def __init__(self, pkgDbDir, checkpointFile):
+        self._pkgDbDir = pkgDbDir
+        self._checkpointFile = checkpointFile
+        self._sampleDivisor = 20            # every unchanged package is checked once in this many incremental runs
+
+        # load checkpoint, it is tuple(dict<pkgNameVer, tuple(counter, digest)>, sample-cursor)
+        self._pkgDict = None
+        self._cursor = 0
+        if os.path.exists(self._checkpointFile):
+            try:
+                with open(self._checkpointFile, "rb") as f:
+                    self._pkgDict, self._cursor = pickle.load(f)
+            except Exception:
+                self._pkgDict = None        # a corrupt checkpoint file is the same as no checkpoint file
+                self._cursor = 0
+        self._newCursor = self._cursor
+
+    def isValid(self):
+        return self._pkgDict is not None
+
+    def getPackageList(self, pkgNameVerList):
+        """Returns packages that need check, in the order of pkgNameVerList"""
+
+        assert self.isValid()
+
+        changedSet = set()
+        unchangedList = []
+        for pkgNameVer in pkgNameVerList:
+            if self._pkgDict.get(pkgNameVer) != self._getStamp(pkgNameVer):
+                changedSet.add(pkgNameVer)
+            else:
+                unchangedList.append(pkgNameVer)
+
+        sampleSet = set()
+        if len(unchangedList) > 0:
+            sampleSize = (len(unchangedList) + self._sampleDivisor - 1) // self._sampleDivisor
+            start = self._cursor % len(unchangedList)
+            for i in range(start, start + sampleSize):
+                sampleSet.add(unchangedList[i % len(unchangedList)])
+            self._newCursor = start + sampleSize
+
+        return [x for x in pkgNameVerList if x in changedSet or x in sampleSet]
+
+    def setChecked(self, pkgNameVer, bPassed):
+        if self._pkgDict is None:
+            self._pkgDict = dict()
+        if bPassed:
+            self._pkgDict[pkgNameVer] = self._getStamp(pkgNameVer)
+        else:
+            self._pkgDict.pop(pkgNameVer, None)
+
+    def save(self, pkgNameVerList):
+        # records of uninstalled packages are dropped
+        pkgDict = dict()
+        for pkgNameVer in pkgNameVerList:
+            if self._pkgDict is not None and pkgNameVer in self._pkgDict:
+                pkgDict[pkgNameVer] = self._pkgDict[pkgNameVer]
+
+        os.makedirs(os.path.dirname(self._checkpointFile), exist_ok=True)
+        tmpFile = self._checkpointFile + ".tmp"
+        with open(tmpFile, "wb") as f:
+            pickle.dump((pkgDict, self._newCursor), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpFile, self._checkpointFile)
+
+    def _getStamp(self, pkgNameVer):
+        # stamp is re-calculated after the package is re-installed by auto-fix, so it is not cached when the package is checked
+        pkgDir = os.path.join(self._pkgDbDir, pkgNameVer)
+
+        counter = None
+        counterFile = os.path.join(pkgDir, "COUNTER")
+        if os.path.exists(counterFile):
+            with open(counterFile, "r") as f:
+                counter = f.read().strip()
+
+        h = hashlib.md5()
+        for fn in ["CONTENTS", "CONTENTS_2"]:
+            fullfn = os.path.join(pkgDir, fn)
+            if os.path.exists(fullfn):
+                with open(fullfn, "rb") as f:
+                    h.update(f.read())
+            h.update(b"\0")
+        return (counter, h.hexdigest())
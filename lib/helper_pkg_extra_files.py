@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import glob
+import pickle
+import hashlib
+import threading
+import concurrent.futures
+from fm_util import FmUtil
+
+
+class PkgExtraFilesEvaluator:
+
+    """
+    Evaluate pkg_extra_files() of installed packages, returns them as wildcards.
+    Packages are evaluated in batches, one bash process runs a whole batch, each package in its own sub-shell.
+    Results are cached in cacheFile keyed by the digest of the installed ebuild file, unchanged packages are never evaluated again.
+    The cache has the output of pkg_extra_files() only, symlinks in it are resolved when the wildcards are returned, so that they are never out of date.
+    """
+
+    def __init__(self, pkgDbDir, cacheFile):
+        self._pkgDbDir = pkgDbDir
+        self._cacheFile = cacheFile
+        self._batchSize = 200
+        self._marker = "#sysman-pkg-extra-files#"
+        self._cacheVersion = 2
+        self._lock = threading.Lock()
+        self._chost = None
+
+        # load cache, it is dict<pkgNameVer, tuple(ebuild-digest, list<output-line>)>
+        self._oldDict = dict()
+        if os.path.exists(self._cacheFile):
+            try:
+                with open(self._cacheFile, "rb") as f:
+                    version, chost, self._oldDict = pickle.load(f)
+                if version != self._cacheVersion:
+                    self._oldDict = dict()          # old cache may have resolved symlinks in it
+                elif chost != self._getChost():
+                    self._oldDict = dict()          # CHOST is in the context of pkg_extra_files()
+            except Exception:
+                self._oldDict = dict()              # a corrupt cache file is the same as no cache file
+        self._newDict = dict()
+        self._bChanged = False
+
+    def prefetch(self, pkgNameVerList):
+        """Evaluate all the not cached packages in pkgNameVerList in batches"""
+
+        todoDict = dict()
+        with self._lock:
+            for pkgNameVer in pkgNameVerList:
+                if pkgNameVer in self._newDict:
+                    continue
+                digest, funcContent = self._readPkgExtraFilesFunc(pkgNameVer)
+                old = self._oldDict.get(pkgNameVer)
+                if old is not None and old[0] == digest:
+                    self._newDict[pkgNameVer] = old
+                elif funcContent is None:
+                    self._newDict[pkgNameVer] = (digest, [])
+                    self._bChanged = True
+                else:
+                    todoDict[pkgNameVer] = (digest, funcContent)
+
+        if len(todoDict) > 0:
+            tlist = list(todoDict.items())
+            batchList = [tlist[i:i + self._batchSize] for i in range(0, len(tlist), self._batchSize)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(batchList), os.cpu_count())) as pool:
+                for retDict in pool.map(self._evaluateBatch, batchList):
+                    with self._lock:
+                        for pkgNameVer, lineList in retDict.items():
+                            self._newDict[pkgNameVer] = (todoDict[pkgNameVer][0], lineList)
+                        self._bChanged = True
+
+    def getWildcards(self, pkgNameVer):
+        with self._lock:
+            ret = self._newDict.get(pkgNameVer)
+        if ret is None:
+            self.prefetch([pkgNameVer])
+            with self._lock:
+                ret = self._newDict[pkgNameVer]
+        return self._convertToWildcards(ret[1])
+
+    def save(self):
+        if not self._bChanged and len(self._newDict) == len(self._oldDict):
+            return
+        os.makedirs(os.path.dirname(self._cacheFile), exist_ok=True)
+        tmpFile = self._cacheFile + ".tmp"
+        with open(tmpFile, "wb") as f:
+            pickle.dump((self._cacheVersion, self._getChost(), self._newDict), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpFile, self._cacheFile)
+
+    def _getChost(self):
+        if self._chost is None:
+            self._chost = FmUtil.portageGetChost()
+        return self._chost
+
+    def _readPkgExtraFilesFunc(self, pkgNameVer):
+        # returns (digest-of-ebuild-file, content-of-pkg_extra_files()), content is None if there's no such function
+        ebuildFullFn = glob.glob(os.path.join(self._pkgDbDir, pkgNameVer, "*.ebuild"))[0]
+        with open(ebuildFullFn, "rb") as f:
+            buf = f.read()
+        digest = hashlib.md5(buf).hexdigest()
+
+        lineList = buf.decode("utf-8", errors="surrogateescape").split("\n")
+        startIdx = None
+        endIdx = None
+        for i in range(0, len(lineList)):
+            if lineList[i] == "pkg_extra_files() {":
+                startIdx = i
+                continue
+            if startIdx is not None and lineList[i] == "}":
+                endIdx = i
+                break
+        if startIdx is None:
+            return (digest, None)
+        return (digest, "\n".join(lineList[startIdx:endIdx + 1]))
+
+    def _evaluateBatch(self, itemList):
+        # run pkg_extra_files() of every package in its own sub-shell, the output of each package is enclosed by marker lines
+        # FIXME: not the context only have CHOST, it lacks a lot
+        script = "export CHOST=%s\n" % (self._getChost())
+        for pkgNameVer, (digest, funcContent) in itemList:
+            script += "(\n"
+            script += "%s\n" % (funcContent)
+            script += "echo \"%s begin %s\"\n" % (self._marker, pkgNameVer)
+            script += "pkg_extra_files\n"
+            script += "echo \"%s end $?\"\n" % (self._marker)
+            script += ")\n"
+        script += "exit 0\n"                     # result of every package is checked by the marker lines
+        out = FmUtil.cmdCallWithInput("bash", script, "-s")
+
+        ret = dict()
+        curPkg = None
+        curLines = None
+        for line in out.split("\n"):
+            if line.startswith(self._marker + " begin "):
+                if curPkg is not None:
+                    self._raiseNotFinished(curPkg, curLines)
+                curPkg = line[len(self._marker + " begin "):]
+                curLines = []
+            elif line.startswith(self._marker + " end "):
+                if line != self._marker + " end 0":
+                    raise Exception("pkg_extra_files() of package \"%s\" exits with error \"%s\"." % (curPkg, "\n".join(curLines)))
+                ret[curPkg] = self._filterOutput(curLines)
+                curPkg = None
+                curLines = None
+            elif curLines is not None:
+                curLines.append(line)
+
+        # pkg_extra_files() may call "exit", which exits the sub-shell before the end marker is printed
+        if curPkg is not None:
+            self._raiseNotFinished(curPkg, curLines)
+        for pkgNameVer, dummy in itemList:
+            if pkgNameVer not in ret:
+                raise Exception("pkg_extra_files() of package \"%s\" is not evaluated." % (pkgNameVer))
+        return ret
+
+    def _raiseNotFinished(self, pkgNameVer, lineList):
+        raise Exception("pkg_extra_files() of package \"%s\" exits without finishing, output is cut off after \"%s\"." % (pkgNameVer, "\n".join(lineList)))
+
+    def _filterOutput(self, lineList):
+        ret = []
+        for w in lineList:
+            w = w.strip()
+            if w == "" or w.startswith("#"):
+                continue
+            if w.startswith("~"):
+                continue
+            ret.append(w)
+        return ret
+
+    def _convertToWildcards(self, lineList):
+        wildcards = []
+        for w in lineList:
+            wildcards.append("+ %s" % (w))
+            if os.path.realpath(w) != w:
+                wildcards.append("+ %s" % (os.path.realpath(w)))
+        return wildcards
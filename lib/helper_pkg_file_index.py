@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import pickle
+import threading
+from fm_util import FmUtil
+from fm_util import WildcardsMatcher
+
+
+class InstalledFileIndex:
+
+    """
+    Index of the files installed by package manager, maps path to (package, type), type is "dir", "obj" or "sym".
+    The index is built by parsing /var/db/pkg/*/*/CONTENTS directly and persisted in cacheFile.
+    Package whose COUNTER and /var/db/pkg entry mtime are not changed is not parsed again.
+    isOwned() answers the same question as "path in getFileSet(expanded=True)" without building the expanded set.
+    """
+
+    def __init__(self, pkgDbDir, cacheFile):
+        self._pkgDbDir = pkgDbDir
+        self._cacheFile = cacheFile
+        self._lock = threading.Lock()
+        self._pyDirSet = None               # directories having installed *.py files
+        self._aliasDict = None              # dict<realpath-of-directory, list<installed-directory>>, for directory symlinks
+
+        # load cache, it is dict<pkgNameVer, tuple(counter, mtime_ns, list<tuple(type, path)>)>
+        oldDict = dict()
+        if os.path.exists(self._cacheFile):
+            try:
+                with open(self._cacheFile, "rb") as f:
+                    oldDict = pickle.load(f)
+            except Exception:
+                pass                    # a corrupt cache file is the same as no cache file
+
+        # refresh changed packages
+        self._pkgDict = dict()
+        bChanged = False
+        for pkgNameVer in FmUtil.portageGetInstalledPkgAtomList(self._pkgDbDir):
+            counter, mtime = self._getPkgStamp(pkgNameVer)
+            old = oldDict.get(pkgNameVer)
+            if old is not None and old[0] == counter and old[1] == mtime:
+                self._pkgDict[pkgNameVer] = old
+            else:
+                self._pkgDict[pkgNameVer] = (counter, mtime, self._parseContentFile(pkgNameVer))
+                bChanged = True
+        if len(oldDict) != len(self._pkgDict):
+            bChanged = True             # some packages are removed
+
+        # save cache
+        if bChanged:
+            os.makedirs(os.path.dirname(self._cacheFile), exist_ok=True)
+            tmpFile = self._cacheFile + ".tmp"
+            with open(tmpFile, "wb") as f:
+                pickle.dump(self._pkgDict, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFile, self._cacheFile)
+
+        # build path index
+        self._pathDict = dict()
+        for pkgNameVer, val in self._pkgDict.items():
+            for fType, path in val[2]:
+                self._pathDict[path] = (pkgNameVer, fType)
+
+    def __contains__(self, path):
+        return path in self._pathDict
+
+    def getOwner(self, path):
+        """Returns None if path is not installed by any package"""
+        ret = self._pathDict.get(path)
+        return ret[0] if ret is not None else None
+
+    def getType(self, path):
+        """Returns None if path is not installed by any package"""
+        ret = self._pathDict.get(path)
+        return ret[1] if ret is not None else None
+
+    def getPackageList(self):
+        return list(self._pkgDict.keys())
+
+    def getPackageFileList(self, pkgNameVer):
+        return [x[1] for x in self._pkgDict[pkgNameVer][2]]
+
+    def getPackageItemList(self, pkgNameVer):
+        """Returns list<tuple(type, path)>"""
+        return list(self._pkgDict[pkgNameVer][2])
+
+    def getPathList(self, fType=None):
+        """Returns sorted list<path>, only paths of type fType are returned if fType is not None"""
+        return sorted([k for k, v in self._pathDict.items() if fType is None or v[1] == fType])
+
+    def getFileSet(self, expanded=False):
+        fileSet = set(self._pathDict.keys())
+
+        if expanded:
+            # deal with .keep
+            for f, val in self._pathDict.items():
+                if val[1] == "dir" and os.path.exists(os.path.join(f, ".keep")):
+                    fileSet.add(os.path.join(f, ".keep"))
+
+            # deal with *.py and __pycache__
+            pyDirSet = set()
+            for f in self._pathDict.keys():
+                if f.endswith(".py"):
+                    if os.path.exists(f + "c"):
+                        fileSet.add(f + "c")
+                    if os.path.exists(f + "o"):
+                        fileSet.add(f + "o")
+                    pyDirSet.add(os.path.dirname(f))
+            for d in pyDirSet:
+                cacheDir = os.path.join(d, "__pycache__")
+                if os.path.isdir(cacheDir):
+                    fileSet.add(cacheDir)
+                    for entry in os.scandir(cacheDir):
+                        fileSet.add(entry.path)
+
+            # deal with directory symlink
+            nret = set()
+            for f in fileSet:
+                f2 = os.path.join(os.path.realpath(os.path.dirname(f)), os.path.basename(f))
+                if f2 != f:
+                    nret.add(f2)
+            fileSet |= nret
+
+        return fileSet
+
+    def isOwned(self, path):
+        """Returns True if path is installed, or is a file that getFileSet(expanded=True) adds for installed files"""
+        if self._isOwnedNoAlias(path):
+            return True
+
+        # deal with directory symlink, try every parent directory that is the real path of an installed directory
+        pyDirSet, aliasDict = self._getDirIndex()
+        d = os.path.dirname(path)
+        while True:
+            for d2 in aliasDict.get(d, []):
+                if self._isOwnedNoAlias(d2 + path[len(d):]):
+                    return True
+            if d == "/":
+                break
+            d = os.path.dirname(d)
+        return False
+
+    def isOwnedTree(self, path):
+        """Returns True if path is a directory whose entries are all owned, __pycache__ of installed *.py files is such a directory"""
+        if os.path.basename(path) != "__pycache__":
+            return False
+        return self.isOwned(path)
+
+    def _isOwnedNoAlias(self, path):
+        if path in self._pathDict:
+            return True
+
+        # deal with .keep
+        dirpath, name = os.path.split(path)
+        if name == ".keep":
+            return self.getType(dirpath) == "dir"
+
+        # deal with *.py and __pycache__
+        if path.endswith(".pyc") or path.endswith(".pyo"):
+            if path[:-1] in self._pathDict:
+                return True
+        pyDirSet, aliasDict = self._getDirIndex()
+        if name == "__pycache__" and dirpath in pyDirSet:
+            return True
+        if os.path.basename(dirpath) == "__pycache__" and os.path.dirname(dirpath) in pyDirSet:
+            return True
+
+        return False
+
+    def _getDirIndex(self):
+        # built when first used, realpath() is called once for every installed directory, not for every file
+        with self._lock:
+            if self._pyDirSet is None:
+                dirSet = set()
+                pyDirSet = set()
+                for f in self._pathDict.keys():
+                    d = os.path.dirname(f)
+                    dirSet.add(d)
+                    if f.endswith(".py"):
+                        pyDirSet.add(d)
+                aliasDict = dict()
+                for d in dirSet:
+                    d2 = os.path.realpath(d)
+                    if d2 != d:
+                        aliasDict.setdefault(d2, []).append(d)
+                self._pyDirSet = pyDirSet
+                self._aliasDict = aliasDict
+            return (self._pyDirSet, self._aliasDict)
+
+    def _getPkgStamp(self, pkgNameVer):
+        pkgDir = os.path.join(self._pkgDbDir, pkgNameVer)
+        counterFile = os.path.join(pkgDir, "COUNTER")
+        if os.path.exists(counterFile):
+            with open(counterFile, "r") as f:
+                counter = f.read().strip()
+        else:
+            counter = None
+        return (counter, os.stat(pkgDir).st_mtime_ns)
+
+    def _parseContentFile(self, pkgNameVer):
+        # line format of CONTENTS file:
+        #   dir <path>
+        #   obj <path> <md5> <mtime>
+        #   sym <path> -> <target> <mtime>
+        #   fif <path>
+        #   dev <path>
+        ret = []
+        contf = os.path.join(self._pkgDbDir, pkgNameVer, "CONTENTS")
+        if not os.path.exists(contf):
+            return ret
+        with open(contf, "r", encoding="UTF-8", errors="surrogateescape") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line == "":
+                    continue
+                fType, rest = line.split(" ", 1)
+                if fType == "obj":
+                    ret.append((fType, rest.rsplit(" ", 2)[0]))
+                elif fType == "sym":
+                    ret.append((fType, rest.split(" -> ", 1)[0]))
+                else:
+                    ret.append((fType, rest))
+        return ret
+
+
+class CruftFileScanner:
+
+    """
+    Walk the root filesystem with os.scandir() and yield cruft files as soon as they are found.
+    A file is cruft if it is matched by wildcards and is not installed by any package, caller deducts extra files of packages from wildcards.
+    Entry type comes from scandir() (d_type), so most files need no stat() call.
+    These directories are not walked:
+      1. directory covered by an extra files wildcard like "+ /dir/***", it is fully owned by the package
+      2. directory whose entries are all owned according to fileIndex, like __pycache__ of installed *.py files
+      3. directory excluded by wildcards, like "- /dir"
+      4. directory deeper than any anchored include wildcard can reach, "+ /*" only lists "/"
+    Only the directories being walked are kept in memory, memory usage does not grow with the size of the filesystem.
+    Reading a directory is charged as one page to ioThrottle.
+    """
+
+    def __init__(self, wildcards, extraWildcards, fileIndex, ioThrottle=None):
+        self._matcher = WildcardsMatcher(wildcards)
+        self._fileIndex = fileIndex
+        self._ioThrottle = ioThrottle
+
+        self._ownedTreeSet = set()
+        for w in extraWildcards:
+            if w.startswith("+ /") and w.endswith("/***") and not any([c in w[2:-4] for c in "*?[\\"]):
+                self._ownedTreeSet.add(w[2:-4])
+
+        self._rootDict = self._getRootDict(wildcards)
+
+    def scan(self):
+        for root, depth in sorted(self._rootDict.items()):
+            if not os.path.lexists(root):
+                continue
+            if self._isCruft(root):
+                yield root
+            if depth != 0 and not self._isPruned(root) and os.path.isdir(root) and not os.path.islink(root):
+                yield from self._scanDir(root, depth)
+
+    def _scanDir(self, dirpath, depth):
+        # depth is how many levels of entries are listed under dirpath, None means unlimited
+        try:
+            with os.scandir(dirpath) as it:
+                entryList = sorted(it, key=lambda x: x.name)
+        except OSError:
+            return                                  # directory removed or not readable when we are walking
+        if self._ioThrottle is not None:
+            self._ioThrottle.consume(4096)
+        for entry in entryList:
+            if entry.path in self._rootDict:
+                continue                            # it is walked as a root
+            if self._isCruft(entry.path):
+                yield entry.path
+            if depth is not None and depth <= 1:
+                continue
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+            except OSError:
+                continue
+            if self._isPruned(entry.path):
+                continue
+            yield from self._scanDir(entry.path, depth - 1 if depth is not None else None)
+
+    def _isCruft(self, path):
+        if not self._matcher.match(path):
+            return False
+        if self._fileIndex.isOwned(path):
+            return False
+        return True
+
+    def _isPruned(self, dirpath):
+        if dirpath in self._ownedTreeSet:
+            return True
+        if self._fileIndex.isOwnedTree(dirpath):
+            return True
+        if self._matcher.isExcluded(dirpath):
+            return True                             # roots in it are walked separately
+        return False
+
+    def _getRootDict(self, wildcards):
+        # returns dict<path, depth>, walking starts from the literal prefix of every anchored include wildcard
+        # depth is how many levels under the root the wildcard reaches, None means unlimited ("**" or "/***")
+        # unanchored include wildcards (like "+ *.pyc") only take effect inside these directories
+        rootDict = dict()
+        for w in wildcards:
+            if not w.startswith("+ /"):
+                continue
+            ptn = w[2:].rstrip("/")
+            if ptn.endswith("/***"):
+                ptn = ptn[:-4]
+                depth = None
+            else:
+                depth = 0
+            for i in range(0, len(ptn)):
+                if ptn[i] in "*?[\\":
+                    root = os.path.dirname(ptn[:i])
+                    if depth is not None and "**" not in ptn:
+                        depth = max(depth, ptn[len(root):].strip("/").count("/") + 1)
+                    else:
+                        depth = None
+                    ptn = root
+                    break
+            if ptn == "":
+                ptn = "/"
+            if ptn in rootDict and (rootDict[ptn] is None or (depth is not None and rootDict[ptn] >= depth)):
+                continue
+            rootDict[ptn] = depth
+
+        # the outer walk skips roots in it, so a root gets the depth that the outer root reaches
+        # roots are never dropped, since the outer walk may not reach them, such as a root in an excluded directory
+        ret = dict()
+        for root in sorted(rootDict.keys()):
+            depth = rootDict[root]
+            for r, d in ret.items():
+                if not root.startswith(r.rstrip("/") + "/"):
+                    continue
+                if d is None:
+                    depth = None
+                elif depth is not None:
+                    depth = max(depth, d - (root[len(r):].strip("/").count("/") + 1))
+            ret[root] = depth
+        return ret
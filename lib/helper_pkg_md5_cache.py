@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import pickle
+import portage
+import functools
+import concurrent.futures
+
+
+class PkgMd5CacheIndex:
+
+    """
+    Index of cpv -> (SLOT, IUSE) and category/package -> cpv list, read from metadata/md5-cache of repositories directly.
+    Category directories are read in parallel, records are persisted in cacheFile and only the cache files whose mtime or size changed are read again.
+    Repositories without metadata/md5-cache are not indexed, match() returns None for packages only in them, caller should ask portage for these repositories.
+    """
+
+    def __init__(self, repoDirList, cacheFile, jobNumber=None):
+        self._cacheFile = cacheFile
+
+        # load cache, it is dict<md5-cache-file, tuple(mtime_ns, size, cpv, slot, iuse-tuple)>
+        oldDict = dict()
+        if os.path.exists(self._cacheFile):
+            try:
+                with open(self._cacheFile, "rb") as f:
+                    oldDict = pickle.load(f)
+            except Exception:
+                pass                    # a corrupt cache file is the same as no cache file
+
+        # read all the category directories
+        catDirList = []
+        catRepoDirList = []
+        self._unindexedRepoDirList = []
+        for repoDir in repoDirList:
+            md5CacheDir = os.path.join(repoDir, "metadata", "md5-cache")
+            if os.path.isdir(md5CacheDir):
+                for x in os.scandir(md5CacheDir):
+                    if x.is_dir():
+                        catDirList.append(x.path)
+                        catRepoDirList.append(repoDir)
+            else:
+                self._unindexedRepoDirList.append(repoDir)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobNumber if jobNumber is not None else os.cpu_count()) as pool:
+            recordListList = list(pool.map(lambda x: self._readCategoryDir(x, oldDict), catDirList))
+        newDict = dict()
+        for recordList in recordListList:
+            newDict.update(recordList)
+
+        # save cache
+        if newDict != oldDict:
+            os.makedirs(os.path.dirname(self._cacheFile), exist_ok=True)
+            tmpFile = self._cacheFile + ".tmp"
+            with open(tmpFile, "wb") as f:
+                pickle.dump(newDict, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFile, self._cacheFile)
+
+        # build index, record of the first repository is used if a cpv exists in several repositories
+        self._cpvDict = dict()
+        self._cpDict = dict()
+        self._repoIuseDict = {x: set() for x in repoDirList if x not in self._unindexedRepoDirList}
+        for repoDir, recordList in zip(catRepoDirList, recordListList):
+            for fullfn, (mtime, size, cpv, slot, iuse) in recordList:
+                self._repoIuseDict[repoDir].update(iuse)
+                if cpv not in self._cpvDict:
+                    self._cpvDict[cpv] = (slot, frozenset(iuse))
+                    self._cpDict.setdefault(portage.versions.cpv_getkey(cpv), []).append(cpv)
+        for cpvList in self._cpDict.values():
+            cpvList.sort(key=functools.cmp_to_key(lambda a, b: portage.versions.vercmp(portage.versions.cpv_getversion(a), portage.versions.cpv_getversion(b))))
+
+        self._allIuseSet = None
+
+    def match(self, atom):
+        """
+        Returns list<cpv> in ascending version order, masked versions are also matched, USE dependencies are ignored.
+        Returns None if the package is not indexed.
+        Raises portage.exception.InvalidAtom if atom is invalid.
+        """
+
+        a = portage.dep.Atom(atom)
+        cpvList = self._cpDict.get(a.cp)
+        if cpvList is None:
+            return None
+
+        b = a.without_use
+        if b.repo is not None:
+            b = b.without_repo
+        if b.slot is not None or b.slot_operator is not None:
+            b = b.without_slot
+        ret = portage.dep.match_from_list(b, cpvList)
+        if a.slot is not None:
+            ret = [x for x in ret if self._cpvDict[x][0].split("/")[0] == a.slot]
+        return ret
+
+    def getUnindexedRepoDirList(self):
+        """Returns list<repository-directory>, they are the repositories without metadata/md5-cache"""
+        return self._unindexedRepoDirList
+
+    def isInUnindexedRepo(self, cp):
+        """Returns True if package cp has ebuilds in a repository without metadata/md5-cache"""
+        return any([os.path.isdir(os.path.join(x, cp)) for x in self._unindexedRepoDirList])
+
+    def getIuseSet(self, cpv):
+        """Returns set<use-flag>, "+" and "-" prefix are removed"""
+        return self._cpvDict[cpv][1]
+
+    def getAllIuseSet(self):
+        if self._allIuseSet is None:
+            self._allIuseSet = set()
+            for iuseSet in self._repoIuseDict.values():
+                self._allIuseSet |= iuseSet
+        return self._allIuseSet
+
+    def getRepoIuseSet(self, repoDir):
+        """Returns set<use-flag> of all the versions in the repository, masked versions included, repoDir must be an indexed repository"""
+        return self._repoIuseDict[repoDir]
+
+    def _readCategoryDir(self, catDir, oldDict):
+        ret = []
+        category = os.path.basename(catDir)
+        for entry in os.scandir(catDir):
+            if not entry.is_file():
+                continue
+            if portage.versions.catpkgsplit("%s/%s" % (category, entry.name)) is None:
+                continue                    # not an ebuild entry, like Manifest.gz in trees synchronized by rsync
+            s = entry.stat()
+            old = oldDict.get(entry.path)
+            if old is not None and old[0] == s.st_mtime_ns and old[1] == s.st_size:
+                ret.append((entry.path, old))
+                continue
+
+            slot = ""
+            iuse = []
+            with open(entry.path, "r", encoding="UTF-8", errors="replace") as f:
+                for line in f:
+                    if line.startswith("SLOT="):
+                        slot = line[len("SLOT="):].rstrip("\n")
+                    elif line.startswith("IUSE="):
+                        iuse = [x.lstrip("+-") for x in line[len("IUSE="):].split()]
+            ret.append((entry.path, (s.st_mtime_ns, s.st_size, "%s/%s" % (category, entry.name), slot, tuple(iuse))))
+        return ret
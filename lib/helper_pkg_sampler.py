@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import time
+import pickle
+import bisect
+
+
+class PkgFileSampler:
+
+    """
+    Selects a rotating slice of the installed regular files for md5 verification, so that a number of runs together cover the whole system.
+    Files are walked in path order from the cursor saved by the last run, until the byte budget is used up.
+    Time budget is converted to byte budget with the throughput measured in the last runs.
+    All the files of packages updated after the last run are always selected, they are not counted in the budget.
+    Files of all the packages are walked, so all the packages must be checked in a sampling run, or else the cursor skips some files.
+    Throughput is measured with the bytes really verified, budget or not.
+    """
+
+    def __init__(self, pkgDbDir, cursorFile):
+        self._pkgDbDir = pkgDbDir
+        self._cursorFile = cursorFile
+        self._defaultThroughput = 100 * 1024 * 1024         # bytes per second, used before any throughput is measured
+
+        # load cursor file, it is tuple(cursor-path, last-run-time, throughput)
+        self._cursor = None
+        self._lastRunTime = None
+        self._throughput = None
+        if os.path.exists(self._cursorFile):
+            try:
+                with open(self._cursorFile, "rb") as f:
+                    self._cursor, self._lastRunTime, self._throughput = pickle.load(f)
+            except Exception:
+                pass                    # a corrupt cursor file is the same as no cursor file
+
+        self._newCursor = None
+        self._selectedBytes = 0
+        self._startTime = None
+        self._fileIndex = None
+        self._selectDict = None
+
+    def getByteBudget(self, sizeBudget, timeBudget):
+        # returns the smaller one if both budgets are specified
+        ret = []
+        if sizeBudget is not None:
+            ret.append(sizeBudget)
+        if timeBudget is not None:
+            ret.append(int(timeBudget * (self._throughput if self._throughput is not None else self._defaultThroughput)))
+        assert len(ret) > 0
+        return min(ret)
+
+    def select(self, fileIndex, byteBudget):
+        """Returns (dict<pkgNameVer, set<path>>, number-of-all-files)"""
+
+        pathList = fileIndex.getPathList("obj")
+        ret = dict()
+
+        # files of recently updated packages
+        if self._lastRunTime is not None:
+            for pkgNameVer in fileIndex.getPackageList():
+                if os.stat(os.path.join(self._pkgDbDir, pkgNameVer)).st_mtime > self._lastRunTime:
+                    for fType, path in fileIndex.getPackageItemList(pkgNameVer):
+                        if fType == "obj":
+                            ret.setdefault(pkgNameVer, set()).add(path)
+
+        # rotating slice
+        if len(pathList) > 0:
+            start = bisect.bisect_right(pathList, self._cursor) if self._cursor is not None else 0
+            total = 0
+            for i in range(start, start + len(pathList)):
+                path = pathList[i % len(pathList)]
+                try:
+                    total += os.lstat(path).st_size
+                except OSError:
+                    pass                                # missing file is reported when verifying
+                ret.setdefault(fileIndex.getOwner(path), set()).add(path)
+                self._newCursor = path
+                if total >= byteBudget:
+                    break
+            else:
+                self._newCursor = None                  # all the files are selected, start from the beginning next time
+            self._selectedBytes = total
+
+        self._startTime = time.time()
+        self._fileIndex = fileIndex
+        self._selectDict = ret
+        return (ret, len(pathList))
+
+    def isPackageFullySelected(self, pkgNameVer):
+        """Returns True if all the regular files of the package are selected"""
+        selectSet = self._selectDict.get(pkgNameVer, set())
+        return all([path in selectSet for fType, path in self._fileIndex.getPackageItemList(pkgNameVer) if fType == "obj"])
+
+    def getSelectedBytes(self):
+        return self._selectedBytes
+
+    def save(self, verifiedBytes):
+        # throughput is measured from the time select() returns, verifiedBytes is the size of files that are really verified
+        endTime = time.time()
+        throughput = self._throughput
+        if verifiedBytes > 0 and endTime > self._startTime:
+            throughput = verifiedBytes / (endTime - self._startTime)
+            if self._throughput is not None:
+                throughput = (throughput + self._throughput) / 2
+        os.makedirs(os.path.dirname(self._cursorFile), exist_ok=True)
+        tmpFile = self._cursorFile + ".tmp"
+        with open(tmpFile, "wb") as f:
+            pickle.dump((self._newCursor, self._startTime, throughput), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpFile, self._cursorFile)
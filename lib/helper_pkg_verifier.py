@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import pickle
+import threading
+import strict_fsh
+import concurrent.futures
+from fm_util import FmUtil
+
+
+class PkgFileVerifier:
+
+    """
+    Verify the installed files of packages in thread pools.
+    Packages are prepared in parallel, files of each package are split into chunks (a big file gets its own chunk), chunks are verified in parallel.
+    Hashing and reading release the GIL, so threads are enough to use all the CPUs and keep several reads in flight.
+    Error messages are returned per package and in the same order as a serial verification would produce.
+    """
+
+    def __init__(self, pkgDbDir, extraFilesEvaluator, cache=None, jobNumber=None, sampleDict=None, ioThrottle=None):
+        if jobNumber is None:
+            jobNumber = os.cpu_count()
+
+        self._pkgDbDir = pkgDbDir
+        self._extraFilesEvaluator = extraFilesEvaluator
+        self._cache = cache
+        self._sampleDict = sampleDict           # dict<pkgNameVer, set<path>>, only these regular files are verified if not None
+        self._ioThrottle = ioThrottle
+        self._chunkSize = 16 * 1024 * 1024          # small files are grouped until the chunk has this many bytes
+        self._prepPool = concurrent.futures.ThreadPoolExecutor(max_workers=jobNumber)
+        self._verifyPool = concurrent.futures.ThreadPoolExecutor(max_workers=jobNumber * 2,      # more reads in flight than CPUs
+                                                                 initializer=ioThrottle.threadInitializer if ioThrottle is not None else None)
+        self._jobDict = dict()
+        self._verifiedBytesLock = threading.Lock()
+        self._verifiedBytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.dispose()
+
+    def dispose(self):
+        for job in self._jobDict.values():
+            job.cancel()
+        self._jobDict = dict()
+        self._prepPool.shutdown(wait=True, cancel_futures=True)         # preparing jobs submit to verify pool, so shutdown prepare pool first
+        self._verifyPool.shutdown(wait=True, cancel_futures=True)
+
+    def addPackage(self, pkgNameVer):
+        assert pkgNameVer not in self._jobDict
+        self._jobDict[pkgNameVer] = self._prepPool.submit(self._prepare, pkgNameVer, True)
+
+    def removePackage(self, pkgNameVer):
+        # the package is changed after it is added, the result would be out of date
+        job = self._jobDict.pop(pkgNameVer, None)
+        if job is not None:
+            job.cancel()
+
+    def getResult(self, pkgNameVer):
+        """Returns list<error-message>, package that is not added (or removed) is verified in the calling thread"""
+
+        job = self._jobDict.pop(pkgNameVer, None)
+        if job is not None:
+            errList, chunkList = job.result()
+            for chunk in chunkList:
+                errList += chunk.result()
+        else:
+            errList, chunkList = self._prepare(pkgNameVer, False)
+            for chunk in chunkList:
+                errList += self._verifyItemList(chunk)
+        return errList
+
+    def getVerifiedBytes(self):
+        """Returns total size of files that are hashed, files verified by cache are not counted"""
+        with self._verifiedBytesLock:
+            return self._verifiedBytes
+
+    def _prepare(self, pkgNameVer, bSubmit):
+        # get item list from CONTENTS_2 file
+        contf = os.path.join(self._pkgDbDir, pkgNameVer, "CONTENTS_2")
+        if not os.path.exists(contf):
+            # FIXME
+            return (["CONTENTS_2 file for %s is missing." % (pkgNameVer)], [])
+        itemList = FmUtil.portageParseVarDbPkgContentFile(contf)
+
+        # filter extra files
+        wildcards = self._extraFilesEvaluator.getWildcards(pkgNameVer)
+        wildcards = strict_fsh.merge_wildcards(wildcards, ["+ /etc/***"])
+        itemList = [x for x in itemList if not strict_fsh.wildcards_match(x[1], wildcards)]
+
+        # filter not sampled regular files
+        if self._sampleDict is not None:
+            sampleSet = self._sampleDict.get(pkgNameVer, set())
+            itemList = [x for x in itemList if x[0] != "obj" or x[1] in sampleSet]
+
+        # split into chunks
+        chunkList = self._splitItemList(itemList)
+        if bSubmit:
+            chunkList = [self._verifyPool.submit(self._verifyItemList, x) for x in chunkList]
+        return ([], chunkList)
+
+    def _splitItemList(self, itemList):
+        ret = []
+        curList = []
+        curSize = 0
+        for item in itemList:
+            curList.append(item)
+            if item[0] == "obj":
+                try:
+                    curSize += os.lstat(item[1]).st_size
+                except OSError:
+                    pass                                # error is reported when verifying
+            if curSize >= self._chunkSize:
+                ret.append(curList)
+                curList = []
+                curSize = 0
+        if curList != []:
+            ret.append(curList)
+        return ret
+
+    def _verifyItemList(self, itemList):
+        ret = []
+        for item in itemList:
+            if item[0] == "dir":
+                if not os.path.exists(item[1]):
+                    ret.append("Directory %s is missing." % (item[1]))
+                else:
+                    s = os.stat(item[1])
+                    if s.st_uid != item[3]:
+                        ret.append("Directory %s failes for uid verification." % (item[1]))
+                    if s.st_gid != item[4]:
+                        ret.append("Directory %s failes for gid verification." % (item[1]))
+            elif item[0] == "obj":
+                if not os.path.exists(item[1]):
+                    ret.append("File %s is missing" % (item[1]))
+                else:
+                    s = os.stat(item[1])
+                    if self._cache is not None and self._cache.isVerified(item[1], s, item[2]):
+                        pass
+                    else:
+                        if FmUtil.verifyFileMd5(item[1], item[2], self._ioThrottle):
+                            if self._cache is not None:
+                                self._cache.setVerified(item[1], s, item[2])        # stat is got before hashing, so modification during hashing invalidates the record
+                        else:
+                            ret.append("File %s fails for MD5 verification." % (item[1]))
+                        with self._verifiedBytesLock:
+                            self._verifiedBytes += s.st_size
+                    if s.st_mode != item[3]:
+                        ret.append("File %s failes for permission verification." % (item[1]))
+                    if s.st_uid != item[4]:
+                        ret.append("File %s failes for uid verification." % (item[1]))
+                    if s.st_gid != item[5]:
+                        ret.append("File %s failes for gid verification." % (item[1]))
+            elif item[0] == "sym":
+                if not os.path.islink(item[1]):
+                    ret.append("Symlink %s is missing." % (item[1]))
+                else:
+                    if os.readlink(item[1]) != item[2]:
+                        ret.append("Symlink %s fails for target verification." % (item[1]))
+                    if not os.path.exists(item[1]):
+                        ret.append("Symlink %s is broken." % (item[1]))
+                    else:
+                        s = os.stat(item[1])
+                        if s.st_uid != item[3]:
+                            ret.append("Symlink %s failes for uid verification." % (item[1]))
+                        if s.st_gid != item[4]:
+                            ret.append("Symlink %s failes for gid verification." % (item[1]))
+            else:
+                assert False
+        return ret
+
+
+class PkgFileVerifyCache:
+
+    """
+    Records files whose md5 are verified, keyed by inode metadata, so that unchanged files are not hashed again in later runs.
+    Only records used in the current run are saved, so the cache does not grow with files that are no longer installed.
+    Record is (dev, inode, size, mtime_ns, ctime_ns, md5), any change of the file updates ctime.
+    """
+
+    def __init__(self, cacheFile, bUseOldRecords=True):
+        self._cacheFile = cacheFile
+        self._oldDict = dict()
+        self._newDict = dict()
+
+        if bUseOldRecords and os.path.exists(self._cacheFile):
+            try:
+                with open(self._cacheFile, "rb") as f:
+                    self._oldDict = pickle.load(f)
+            except Exception:
+                pass                    # a corrupt cache file is the same as no cache file
+
+    def isVerified(self, path, s, md5):
+        record = self._oldDict.get(path)
+        if record is None or record != self._getRecord(s, md5):
+            return False
+        self._newDict[path] = record
+        return True
+
+    def setVerified(self, path, s, md5):
+        self._newDict[path] = self._getRecord(s, md5)
+
+    def save(self, bKeepUnusedRecords=False):
+        # unused records should be kept if only part of the packages are verified in this run
+        if bKeepUnusedRecords:
+            saveDict = dict(self._oldDict)
+            saveDict.update(self._newDict)
+        else:
+            saveDict = self._newDict
+
+        os.makedirs(os.path.dirname(self._cacheFile), exist_ok=True)
+        tmpFile = self._cacheFile + ".tmp"
+        with open(tmpFile, "wb") as f:
+            pickle.dump(saveDict, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpFile, self._cacheFile)
+
+    def _getRecord(self, s, md5):
+        return (s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns, s.st_ctime_ns, md5)
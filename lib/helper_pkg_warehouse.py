@@ -6,6 +6,7 @@ import re
 import glob
 import time
 import shutil
+import pickle
 import portage
 import pathlib
 import fileinput
@@ -19,6 +20,7 @@ import robust_layer.simple_subversion
 import robust_layer.rsync
 import robust_layer.simple_fops
 from fm_util import FmUtil
+from fm_util import PortageResolverSession
 from fm_param import FmConst
 
 
@@ -27,39 +29,23 @@ class PkgWarehouse:
     def __init__(self):
         self.repoman = EbuildRepositories()
         self.layman = EbuildOverlays()
+        self.resolver = PortageResolverSession()
+        self._preEnableIndex = None
+
+    @property
+    def preEnableIndex(self):
+        # loaded when first used, data directory does not change during the life time of this object
+        if self._preEnableIndex is None:
+            self._preEnableIndex = PkgPreEnableIndex(os.path.join(FmConst.dataDir, "pre-enable"), FmConst.preEnableIndexFile)
+        return self._preEnableIndex
 
     def getPreEnableOverlays(self):
-        ret = dict()
-        modDir = os.path.join(FmConst.dataDir, "pre-enable")
-        if os.path.exists(modDir):
-            fullfnList = []
-            fullfnList += list(glob.glob(os.path.join(modDir, "*.new_overlay")))
-            for fullfn in fullfnList:
-                cfg = configparser.ConfigParser()
-                cfg.read(fullfn)
-                name = cfg.get("main", "name", fallback=os.path.basename(fullfn).replace(".new_overlay", ""))
-                url = cfg.get("main", "url", fallback=None)
-                ret[name] = url
-        return ret
+        """Returns dict<overlay-name, url>"""
+        return {x: self.preEnableIndex.getOverlayUrl(x) for x in self.preEnableIndex.getOverlayList()}
 
     def getPreEnablePackages(self):
-        ret = dict()
-        modDir = os.path.join(FmConst.dataDir, "pre-enable")
-        if os.path.exists(modDir):
-            fullfnList = []
-            fullfnList += list(glob.glob(os.path.join(modDir, "*.new_package")))
-            for fullfn in fullfnList:
-                cfg = configparser.ConfigParser()
-                cfg.read(fullfn)
-                name = cfg.get("main", "name")
-                url = cfg.get("main", "url", fallback=None)
-                package = cfg.get("main", "package")
-                if name in ret:
-                    assert url is None or url == ret[name][0]
-                    ret[name][1].append(package)
-                else:
-                    ret[name] = (url, [package])
-        return ret
+        """Returns dict<overlay-name, tuple(url, list<package>)>"""
+        return {x: (self.preEnableIndex.getPackageOverlayUrl(x), self.preEnableIndex.getPackageList(x)) for x in self.preEnableIndex.getPackageOverlayList()}
 
     def getKeywordList(self):
         chost = FmUtil.portageGetChost()
@@ -101,11 +87,11 @@ class PkgWarehouse:
                                      self.__rubyCompareDefaultTargetsUseFlag,
                                      self.__rubyCheckMainPackageOfTargetUseFlag)
 
-    def checkLinguasUseFlags(self):
-        self._operateLinguasUseFlags(True, "97", "linguas")
+    def checkLinguasUseFlags(self, md5CacheIndex):
+        self._operateLinguasUseFlags(True, "97", "linguas", md5CacheIndex)
 
-    def refreshLinguasUseFlags(self):
-        self._operateLinguasUseFlags(False, "97", "linguas")
+    def refreshLinguasUseFlags(self, md5CacheIndex):
+        self._operateLinguasUseFlags(False, "97", "linguas", md5CacheIndex)
 
     def _operateHardwareUseFlags(self, checkOrRefresh, id, name, hwInfo):
         usefn = os.path.join(FmConst.portageCfgUseDir, "%s-%s" % (id, name))
@@ -180,20 +166,24 @@ class PkgWarehouse:
                 with open(usefn, "w") as f:
                     f.write(fnContent)
 
-    def _operateLinguasUseFlags(self, checkOrRefresh, id, name):
+    def _operateLinguasUseFlags(self, checkOrRefresh, id, name, md5CacheIndex):
         usefn = os.path.join(FmConst.portageCfgUseDir, "%s-%s" % (id, name))
-        portree = portage.db[portage.root]["porttree"]
 
-        # get all languages
+        # get all languages, read from md5-cache directly, portage is used only for repositories that have no md5-cache
+        # languages of masked versions are also included, md5-cache has no visibility information
         useSet = set()
         for repoName in self.repoman.getRepositoryList():
-            for pkgName in FmUtil.repoGetEbuildDirList(self.repoman.getRepoDir(repoName)):
-                for cpv in portree.dbapi.match(pkgName):
-                    for use in portree.dbapi.aux_get(cpv, ["IUSE"])[0].split():
-                        if use.startswith("l10n_"):
-                            useSet.add(use[len("l10n_"):])
-                        elif use.startswith("+l10n_"):
-                            useSet.add(use[len("+l10n_"):])
+            repoDir = self.repoman.getRepoDir(repoName)
+            if repoDir not in md5CacheIndex.getUnindexedRepoDirList():
+                useList = md5CacheIndex.getRepoIuseSet(repoDir)
+            else:
+                useList = []
+                for pkgName in FmUtil.repoGetEbuildDirList(repoDir):
+                    for cpv in self.resolver.xmatchAll(pkgName):
+                        useList += [x.lstrip("+-") for x in self.resolver.auxGet(cpv, "IUSE").split()]
+            for use in useList:
+                if use.startswith("l10n_"):
+                    useSet.add(use[len("l10n_"):])
 
         # trick: we keep "no" since "nb" and "no" conflict, see https://bugs.gentoo.org/775734
         if "nb" in useSet and "no" in useSet:
@@ -279,13 +269,13 @@ class PkgWarehouse:
             useFlag = useFlag.replace("python", "")
             slot = useFlag.replace("_", ".")
             pkgName = "dev-lang/python:%s" % (slot)
-            return (FmUtil.portageIsPkgInstallable(pkgName), pkgName)
+            return (self.resolver.isPkgInstallable(pkgName), pkgName)
 
         if useFlag.startswith("pypy"):
             ver = useFlag.replace("pypy", "")
             assert ver in ["", "3"]
             pkgName = "dev-python/pypy%s" % (ver)
-            return (FmUtil.portageIsPkgInstallable(pkgName), pkgName)
+            return (self.resolver.isPkgInstallable(pkgName), pkgName)
 
         if useFlag.startswith("jython"):
             # FIXME
@@ -330,7 +320,7 @@ class PkgWarehouse:
         if useFlag.startswith("ruby"):
             slot = useFlag[4] + "." + useFlag[5:]         # "ruby27" -> "2.7", "ruby210" -> "2.10"
             pkgName = "dev-lang/ruby:%s" % (slot)
-            return (FmUtil.portageIsPkgInstallable(pkgName), pkgName)
+            return (self.resolver.isPkgInstallable(pkgName), pkgName)
 
         if useFlag.startswith("rbx"):
             # FIXME: I don't know what rbx means...
@@ -373,6 +363,13 @@ class EbuildRepositories:
         assert repoName in self._repoInfoDict
         return os.path.join(FmConst.portageDataDir, "repo-%s" % (repoName))
 
+    def getRepoSyncUrl(self, repoName):
+        assert repoName in self._repoInfoDict
+        if repoName == "gentoo":
+            return FmUtil.portageGetGentooPortageRsyncMirror(FmConst.portageCfgMakeConf, FmConst.defaultRsyncMirror)
+        else:
+            return self._repoGitUrlDict[repoName]
+
     def isRepoExist(self, repoName):
         assert repoName in self._repoInfoDict
         return os.path.exists(self.getRepoCfgReposFile(repoName))
@@ -446,7 +443,7 @@ class EbuildRepositories:
             else:
                 assert False
 
-        if self.__hasPatch(repoName):
+        if self.hasPatch(repoName):
             print("Patching...")
             self.__patchRepoN(repoName)
             self.__patchRepoS(repoName)
@@ -455,7 +452,7 @@ class EbuildRepositories:
         with open(self.getRepoCfgReposFile(repoName), "w") as f:
             f.write(self.__generateReposConfContent(repoName))
 
-    def syncRepository(self, repoName):
+    def syncRepository(self, repoName, bPatch=True):
         """Business exception should not be raise, but be printed as error message"""
 
         if repoName == "gentoo":
@@ -466,7 +463,13 @@ class EbuildRepositories:
             else:
                 assert False
 
-        if self.__hasPatch(repoName):
+        if bPatch:
+            self.patchRepository(repoName)
+
+    def patchRepository(self, repoName):
+        # patches are applied to the ebuilds and "ebuild manifest" is called, so eclasses of gentoo repository are used
+        # patching a repository other than gentoo should be done after gentoo repository is synchronized and patched
+        if self.hasPatch(repoName):
             print("Patching...")
             self.__patchRepoN(repoName)
             self.__patchRepoS(repoName)
@@ -489,7 +492,7 @@ class EbuildRepositories:
         buf += "location = %s\n" % (repoDir)
         return buf
 
-    def __hasPatch(self, repoName):
+    def hasPatch(self, repoName):
         repoName2 = "repo-%s" % (repoName)
         for dirName in ["pkgwh-n-patch", "pkgwh-s-patch"]:
             modDir = os.path.join(FmConst.dataDir, dirName, repoName2)
@@ -502,14 +505,14 @@ class EbuildRepositories:
         modDir = os.path.join(FmConst.dataDir, "pkgwh-n-patch", repoName2)
         if os.path.exists(modDir):
             jobCount = FmUtil.portageGetJobCount(FmConst.portageCfgMakeConf)
-            FmUtil.portagePatchRepository(repoName2, self.getRepoDir(repoName), "N-patch", modDir, jobCount)
+            FmUtil.portagePatchRepository(repoName2, self.getRepoDir(repoName), "N-patch", modDir, jobCount, FmConst.portagePatchCacheDir)
 
     def __patchRepoS(self, repoName):
         repoName2 = "repo-%s" % (repoName)
         modDir = os.path.join(FmConst.dataDir, "pkgwh-s-patch", repoName2)
         if os.path.exists(modDir):
             jobCount = FmUtil.portageGetJobCount(FmConst.portageCfgMakeConf)
-            FmUtil.portagePatchRepository(repoName2, self.getRepoDir(repoName), "S-patch", modDir, jobCount)
+            FmUtil.portagePatchRepository(repoName2, self.getRepoDir(repoName), "S-patch", modDir, jobCount, FmConst.portagePatchCacheDir)
 
 
 class RepositoryCheckError(Exception):
@@ -647,7 +650,7 @@ class EbuildOverlays:
         else:
             assert False
 
-    def checkOverlay(self, overlayName, bCheckContent, bAutoFix=False):
+    def checkOverlay(self, overlayName, bCheckContent, bAutoFix=False, ioThrottle=None):
         assert self.isOverlayExist(overlayName)
 
         cfgFile = self.getOverlayCfgReposFile(overlayName)
@@ -808,7 +811,7 @@ class EbuildOverlays:
                             robust_layer.simple_fops.rm(dstEbuildDir)
                         else:
                             raise OverlayCheckError("package \"%s\" in overlay \"%s\" should not exist any more" % (d, overlayName))
-                    if not FmUtil.isTwoDirSame(srcEbuildDir, dstEbuildDir):
+                    if not FmUtil.isTwoDirSame(srcEbuildDir, dstEbuildDir, ioThrottle):
                         if bAutoFix:
                             robust_layer.simple_fops.rm(dstEbuildDir)
                             shutil.copytree(srcEbuildDir, dstEbuildDir)
@@ -1131,7 +1134,7 @@ class EbuildOverlays:
         modDir = os.path.join(FmConst.dataDir, dirName, overlayName2)
         if os.path.exists(modDir):
             jobCount = FmUtil.portageGetJobCount(FmConst.portageCfgMakeConf)
-            FmUtil.portagePatchRepository(overlayName2, overlaySourceDir, typeName, modDir, jobCount)
+            FmUtil.portagePatchRepository(overlayName2, overlaySourceDir, typeName, modDir, jobCount, FmConst.portagePatchCacheDir)
 
     def __overlayDirUglyTrick(self, overlayName, overlayDir):
         # common trick
@@ -1149,6 +1152,140 @@ class EbuildOverlays:
                     print(line.replace("if [ -z \"${UNITY_BUILD_OK}\" ]; then", "if false; then"), end='')
 
 
+class PkgLocationIndex:
+
+    """
+    Index of which repositories and overlays provide a package (category/package).
+    Every repository and overlay directory is walked only once when the index is built.
+    """
+
+    def __init__(self, repoman, layman):
+        self._repoDict = dict()             # dict<repo-name, set<category/package>>, in the order of repoman.getRepositoryList()
+        self._overlayDict = dict()          # dict<overlay-name, set<category/package>>, in the order of layman.getOverlayList()
+
+        for repoName in repoman.getRepositoryList():
+            self._repoDict[repoName] = set(FmUtil.repoGetEbuildDirList(repoman.getRepoDir(repoName)))
+        for overlayName in layman.getOverlayList():
+            self._overlayDict[overlayName] = set(FmUtil.repoGetEbuildDirList(layman.getOverlayDir(overlayName)))
+
+        self._pkgDict = dict()              # dict<category/package, list<tuple("repo"|"overlay", name)>>, repositories are before overlays
+        for repoName, pkgSet in self._repoDict.items():
+            for pkg in pkgSet:
+                self._pkgDict.setdefault(pkg, []).append(("repo", repoName))
+        for overlayName, pkgSet in self._overlayDict.items():
+            for pkg in pkgSet:
+                self._pkgDict.setdefault(pkg, []).append(("overlay", overlayName))
+
+    def hasPackage(self, pkg):
+        return pkg in self._pkgDict
+
+    def getPackageLocationList(self, pkg):
+        """Returns list<tuple("repo"|"overlay", name)>, repositories are before overlays"""
+        return list(self._pkgDict.get(pkg, []))
+
+    def getRepoPackageSet(self, repoName):
+        return self._repoDict[repoName]
+
+    def getOverlayPackageSet(self, overlayName):
+        return self._overlayDict[overlayName]
+
+    def removeOverlayPackage(self, overlayName, pkg):
+        # package is removed from overlay after the index is built
+        self._overlayDict[overlayName].discard(pkg)
+        self._pkgDict[pkg].remove(("overlay", overlayName))
+        if len(self._pkgDict[pkg]) == 0:
+            del self._pkgDict[pkg]
+
+    def removeOverlay(self, overlayName):
+        # overlay is removed after the index is built
+        for pkg in list(self._overlayDict[overlayName]):
+            self.removeOverlayPackage(overlayName, pkg)
+        del self._overlayDict[overlayName]
+
+
+class PkgPreEnableIndex:
+
+    """
+    Index of the pre-enabled overlays (*.new_overlay) and packages (*.new_package) in the data directory.
+    The definition files are parsed into one cache file, which is rebuilt only when a definition file is added, removed or has its mtime changed.
+    """
+
+    def __init__(self, modDir, cacheFile):
+        self._modDir = modDir
+        self._cacheFile = cacheFile
+
+        # stamp is list<tuple(filename, mtime_ns)> of all the definition files
+        stamp = []
+        if os.path.exists(self._modDir):
+            for entry in sorted(os.scandir(self._modDir), key=lambda x: x.name):
+                if entry.name.endswith(".new_overlay") or entry.name.endswith(".new_package"):
+                    stamp.append((entry.name, entry.stat().st_mtime_ns))
+
+        # load cache, it is tuple(stamp, overlay-dict, package-dict)
+        if os.path.exists(self._cacheFile):
+            try:
+                with open(self._cacheFile, "rb") as f:
+                    oldStamp, self._overlayDict, self._pkgDict = pickle.load(f)
+                if oldStamp == stamp:
+                    return
+            except Exception:
+                pass                    # a corrupt cache file is the same as no cache file
+
+        # build index
+        self._overlayDict = dict()          # dict<overlay-name, url>
+        self._pkgDict = dict()              # dict<overlay-name, tuple(url, list<package>)>
+        for fn, mtime in stamp:
+            cfg = configparser.ConfigParser()
+            cfg.read(os.path.join(self._modDir, fn))
+            if fn.endswith(".new_overlay"):
+                name = cfg.get("main", "name", fallback=fn.replace(".new_overlay", ""))
+                self._overlayDict[name] = cfg.get("main", "url", fallback=None)
+            else:
+                name = cfg.get("main", "name")
+                url = cfg.get("main", "url", fallback=None)
+                package = cfg.get("main", "package")
+                if name in self._pkgDict:
+                    assert url is None or url == self._pkgDict[name][0]
+                    self._pkgDict[name][1].append(package)
+                else:
+                    self._pkgDict[name] = (url, [package])
+
+        # save cache, it is not an error if cache directory is not writable
+        try:
+            os.makedirs(os.path.dirname(self._cacheFile), exist_ok=True)
+            tmpFile = self._cacheFile + ".tmp"
+            with open(tmpFile, "wb") as f:
+                pickle.dump((stamp, self._overlayDict, self._pkgDict), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFile, self._cacheFile)
+        except OSError:
+            pass
+
+    def hasOverlay(self, overlayName):
+        return overlayName in self._overlayDict
+
+    def getOverlayList(self):
+        return list(self._overlayDict.keys())
+
+    def getOverlayUrl(self, overlayName):
+        return self._overlayDict[overlayName]
+
+    def hasPackageOverlay(self, overlayName):
+        return overlayName in self._pkgDict
+
+    def getPackageOverlayList(self):
+        """Returns overlays that have pre-enabled packages"""
+        return list(self._pkgDict.keys())
+
+    def getPackageOverlayUrl(self, overlayName):
+        return self._pkgDict[overlayName][0]
+
+    def getPackageList(self, overlayName):
+        return list(self._pkgDict[overlayName][1])
+
+    def isPackagePreEnabled(self, overlayName, pkg):
+        return overlayName in self._pkgDict and pkg in self._pkgDict[overlayName][1]
+
+
 class OverlayCheckError(Exception):
 
     def __init__(self, message):
@@ -1274,7 +1411,11 @@ class CloudSnapshotUrls:
 
 class CloudOverlayDb:
 
-    """We expand overlay name "bgo" to ["bgo", "bgo-overlay", "bgo_overlay"]"""
+    """
+    We expand overlay name "bgo" to ["bgo", "bgo-overlay", "bgo_overlay"]
+    Every downloaded database is parsed in one streaming pass into dict<overlay-name, tuple(vcs-type, url)>.
+    Parsed data is cached in FmConst.cloudOverlayDbCacheDir, keyed by mtime and size of the database file.
+    """
 
     def __init__(self):
         self.itemDict = {
@@ -1285,13 +1426,14 @@ class CloudOverlayDb:
             ],
         }
 
-        # try parse all items
+        # try load or parse all items
         for itemName, val in self.itemDict.items():
             fullfn = os.path.join(FmConst.cloudOverlayDbDir, itemName)
             try:
-                val[2] = self.__parse(fullfn)
+                val[2] = self.__load(itemName, fullfn)
             except BaseException:
                 pass
+        self._mergedDict = None
 
     def update(self):
         for itemName, val in self.itemDict.items():
@@ -1300,7 +1442,7 @@ class CloudOverlayDb:
             while True:
                 try:
                     tm = FmUtil.downloadIfNewer(val[1], fullfn)
-                    val[2] = self.__parse(fullfn)
+                    val[2] = self.__load(itemName, fullfn)
                     break
                 except lxml.etree.XMLSyntaxError as e:
                     print("Failed to parse %s, %s" % (fullfn, e))
@@ -1310,6 +1452,7 @@ class CloudOverlayDb:
                     print("Failed to acces %s, %s" % (val[1], e))
                     time.sleep(1.0)
             print("%s: %s" % (val[0], tm.strftime("%Y%m%d%H%M%S")))
+        self._mergedDict = None
 
     def isUpdateComplete(self):
         return all([val[2] is not None for val in self.itemDict.values()])
@@ -1325,6 +1468,12 @@ class CloudOverlayDb:
         return ret
 
     def _getOverlayVcsTypeAndUrl(self, overlayName):
+        # all items are merged into one dict, the first item has the highest priority
+        if self._mergedDict is None:
+            self._mergedDict = dict()
+            for val in reversed(list(self.itemDict.values())):
+                self._mergedDict.update(val[2])
+
         # expand overlay name
         if overlayName.endswith("-overlay") or overlayName.endswith("_overlay"):
             overlayNameList = [overlayName]
@@ -1333,12 +1482,41 @@ class CloudOverlayDb:
 
         # find overlay
         for overlayName in overlayNameList:
-            for val in self.itemDict.values():
-                if overlayName in val[2]:
-                    return val[2][overlayName]
+            if overlayName in self._mergedDict:
+                return self._mergedDict[overlayName]
         return None
 
+    def __load(self, itemName, fullfn):
+        cacheFile = os.path.join(FmConst.cloudOverlayDbCacheDir, itemName + ".cache")
+        s = os.stat(fullfn)
+        stamp = (s.st_mtime_ns, s.st_size)
+
+        # load cache, it is tuple(stamp, parsed-data)
+        if os.path.exists(cacheFile):
+            try:
+                with open(cacheFile, "rb") as f:
+                    oldStamp, ret = pickle.load(f)
+                if oldStamp == stamp:
+                    return ret
+            except Exception:
+                pass                    # a corrupt cache file is the same as no cache file
+
+        ret = self.__parse(fullfn)
+
+        # save cache, it is not an error if cache directory is not writable
+        try:
+            os.makedirs(FmConst.cloudOverlayDbCacheDir, exist_ok=True)
+            tmpFile = cacheFile + ".tmp"
+            with open(tmpFile, "wb") as f:
+                pickle.dump((stamp, ret), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFile, cacheFile)
+        except OSError:
+            pass
+
+        return ret
+
     def __parse(self, fullfn):
+        # source with smaller index in this list is preferred
         cList = [
             ("git", "https"),
             ("git", "http"),
@@ -1351,25 +1529,31 @@ class CloudOverlayDb:
         ]
 
         ret = dict()
-        rootElem = lxml.etree.parse(fullfn).getroot()
-        for nameTag in rootElem.xpath(".//repo/name"):
-            overlayName = nameTag.text
-            if overlayName in ret:
-                raise Exception("duplicate overlay \"%s\"" % (overlayName))
-
-            for vcsType, urlPrefix in cList:
-                for sourceTag in nameTag.xpath("../source"):
-                    tVcsType = sourceTag.get("type")
-                    tUrl = sourceTag.text
-                    if tUrl.startswith("git://github.com/"):        # FIXME: github does not support git:// anymore
-                        tUrl = tUrl.replace("git://", "https://")
+        for event, repoTag in lxml.etree.iterparse(fullfn, events=("end",), tag="repo"):
+            # rank all the sources of this repo in one pass
+            best = None
+            for sourceTag in repoTag.iterchildren("source"):
+                tVcsType = sourceTag.get("type")
+                tUrl = sourceTag.text
+                if tUrl.startswith("git://github.com/"):        # FIXME: github does not support git:// anymore
+                    tUrl = tUrl.replace("git://", "https://")
+                for i, (vcsType, urlPrefix) in enumerate(cList):
                     if tVcsType == vcsType and tUrl.startswith(urlPrefix + "://"):
-                        ret[overlayName] = (tVcsType, tUrl)
+                        if best is None or i < best[0]:
+                            best = (i, tVcsType, tUrl)
                         break
-                if overlayName in ret:
-                    break
 
-            if overlayName not in ret:
-                raise Exception("no appropriate source for overlay \"%s\"" % (overlayName))
+            for nameTag in repoTag.iterchildren("name"):
+                overlayName = nameTag.text
+                if overlayName in ret:
+                    raise Exception("duplicate overlay \"%s\"" % (overlayName))
+                if best is None:
+                    raise Exception("no appropriate source for overlay \"%s\"" % (overlayName))
+                ret[overlayName] = (best[1], best[2])
+
+            # free the parsed elements, memory usage does not grow with the size of the file
+            repoTag.clear()
+            while repoTag.getprevious() is not None:
+                del repoTag.getparent()[0]
 
         return ret
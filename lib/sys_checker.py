@@ -6,9 +6,13 @@ import re
 import glob
 import time
 import stat
-import ntplib
 import pathlib
+import portage
 import filecmp
+import threading
+import functools
+import contextlib
+import concurrent.futures
 import strict_pgs
 import strict_fsh
 import strict_hdds
@@ -17,6 +21,8 @@ import robust_layer.simple_fops
 from fm_util import FmUtil
 from fm_util import CcacheLocalService
 from fm_util import TmpMount
+from fm_util import WildcardsMatcher
+from fm_util import DagTaskRunner
 from fm_param import FmConst
 from helper_bbki import BbkiWrapper
 from helper_bbki import BootDirWriter
@@ -24,7 +30,18 @@ from helper_pkg_warehouse import PkgWarehouse
 from helper_pkg_warehouse import RepositoryCheckError
 from helper_pkg_warehouse import OverlayCheckError
 from helper_pkg_warehouse import CloudOverlayDb
+from helper_pkg_warehouse import PkgLocationIndex
 from helper_pkg_merger import PkgMerger
+from helper_pkg_verifier import PkgFileVerifier
+from helper_pkg_verifier import PkgFileVerifyCache
+from helper_pkg_file_index import InstalledFileIndex
+from helper_pkg_file_index import CruftFileScanner
+from helper_pkg_extra_files import PkgExtraFilesEvaluator
+from helper_pkg_checkpoint import PkgCheckCheckpoint
+from helper_check_report import CheckReport
+from helper_pkg_md5_cache import PkgMd5CacheIndex
+from helper_pkg_sampler import PkgFileSampler
+from helper_io_throttle import IoThrottle
 
 
 # TODO:
@@ -57,97 +74,238 @@ class FmSysChecker:
     def __init__(self, param):
         self.param = param
         self.pkgwh = PkgWarehouse()
+        self._tls = threading.local()
         self.infoPrinter = None
         self.bAutoFix = False
+        self._lock = threading.RLock()              # protects objects that are created when first used
+        self._pkgVerifier = None
+        self._fileIndex = None
+        self._rootFs = None
+        self._fileScopeMatcher = None
+        self._extraFilesEvaluator = None
+        self._pkgLocationIndex = None
+        self._md5CacheIndex = None
+        self._ioThrottle = None
 
     def basicCheck(self):
         self._checkPortageCfg(bFullCheck=False)
         self._checkRepositories(bFullCheck=False)
         self._checkOverlays(False, bFullCheck=False)
+        self._invalidateResolver()
 
     def basicCheckWithOverlayContent(self):
         self._checkPortageCfg(bFullCheck=False)
         self._checkRepositories(bFullCheck=False)
         self._checkOverlays(True, bFullCheck=False)
+        self._invalidateResolver()
 
-    def fullCheck(self, bAutoFix, deepHardwareCheck, deepFileSystemCheck):
+    @property
+    def infoPrinter(self):
+        # check tasks run concurrently, each task thread has its own printer
+        return getattr(self._tls, "infoPrinter", self._infoPrinter)
+
+    @infoPrinter.setter
+    def infoPrinter(self, value):
+        self._infoPrinter = value
+
+    def fullCheck(self, bAutoFix, deepHardwareCheck, deepFileSystemCheck, bUseCache=True, bIncremental=False, reportFile=None, sampleSize=None, sampleTime=None, ioLimit=None, bIdleIo=False, jobNumber=None):
         self.bAutoFix = bAutoFix
         self.infoPrinter = self.param.infoPrinter
+        self._ioThrottle = IoThrottle(ioLimit, bIdleIo)
+        report = None
         try:
-            layout = None
-
-            with self.infoPrinter.printInfoAndIndent(">> Preparing..."):
-                self.basicCheck()
-
+            # record every check method, check tasks are run one by one and no background work is done, so that process wide counters are correct
+            if reportFile is not None:
+                report = CheckReport()
+                for name in self._getCheckMethodNameList():
+                    setattr(self, name, report.wrap(name, getattr(self, name), lambda: self.infoPrinter.getErrorCount()))
+
+            # check tasks, they are run concurrently as far as dependencies allow, output is in the order of adding
+            # auto-fix modifies the system (even emerge is run), and portage objects are shared, so tasks are run one by one
+            runner = DagTaskRunner(self.infoPrinter, jobNumber if report is None and not bAutoFix else 1)
+            runner.addTask("prepare", ">> Preparing...",
+                           self._wrapCheckTask(self.basicCheck))
             if self.param.runMode in ["normal", "setup"]:
-                with self.infoPrinter.printInfoAndIndent(">> Checking hardware..."):
-                    self._checkHarddisks(deepHardwareCheck)
-                    self._checkCooling()
-
-            if self.param.runMode in ["normal", "setup"]:
-                with self.infoPrinter.printInfoAndIndent(">> Checking storage layout..."):
-                    layout = self._checkAndGetStorageLayout()
-
-            with self.infoPrinter.printInfoAndIndent(">> Checking file system layout..."):
-                with self.infoPrinter.printInfoAndIndent("- Check rootfs..."):
-                    self._checkRootfsLayout(deepFileSystemCheck)
-                # if self.param.runMode in ["normal", "setup"]:
-                #     with self.infoPrinter.printInfoAndIndent("- Check premount rootfs..."):
-                #         self._checkPreMountRootfsLayout(layout)
-
-            with self.infoPrinter.printInfoAndIndent(">> Checking BIOS, bootloader, kernel and initramfs..."):
-                bbkiObj = BbkiWrapper(layout)
-                with self.infoPrinter.printInfoAndIndent("- Check config..."):
-                    bbkiObj.check_config(self.bAutoFix, self.infoPrinter.printError)
-                with self.infoPrinter.printInfoAndIndent("- Check repositories..."):
-                    bbkiObj.check_repositories(self.bAutoFix, self.infoPrinter.printError)
-                with self.infoPrinter.printInfoAndIndent("- Check boot entries..."):
-                    if self.bAutoFix:
-                        with BootDirWriter(layout):
-                            bbkiObj.check_boot_entry_files(self.bAutoFix, self.infoPrinter.printError)
-                    else:
-                        bbkiObj.check_boot_entry_files(self.bAutoFix, self.infoPrinter.printError)
-
-            with self.infoPrinter.printInfoAndIndent(">> Checking operating system..."):
-                with self.infoPrinter.printInfoAndIndent("- Check system configuration..."):
-                    self._checkCpuFreqDriver()              # config in /sys
-                    # self._checkMachineInfo()
-                    self._checkHostsFile()                  # config in /etc
-                    self._checkNsswitchFile()               # config in /etc
-                    self._checkSystemLocale()               # config in /etc
-                    # self._checkPamCfgFiles()
-                    self._checkEtcOnlyUserCreatedFiles()
-                    self._checkEtcLmSensorsCfgFiles()
-                    self._checkEtcUdevRuleFiles()
-                    self._checkCcacheFilesAndDirectories()
-                    self._checkServiceFiles()
-                    self._checkPortageCfg()
-                    self._checkSystemServices()
-                    self._checkSystemTime()                 # dynamic system status
-                with self.infoPrinter.printInfoAndIndent("- Check package repositories & overlays..."):
-                    self._checkPortagePkgwhCfg()
-                    self._checkRepositories()
-                    self._checkOverlays(True)
-                    self._checkNews()
-                    self._checkImportantPackage()
-                    self._checkWorldFile()
-                    self._checkRedundantRepositoryAndOverlay()
-                with self.infoPrinter.printInfoAndIndent("- Check users and groups..."):
-                    self._checkUsersAndGroups()
-
-            with self.infoPrinter.printInfoAndIndent(">> Checking software packages..."):
-                for pkgNameVer in sorted(FmUtil.portageGetInstalledPkgAtomList(FmConst.portageDbDir)):
-                    with self.infoPrinter.printInfoAndIndent("- Package %s:" % (pkgNameVer), bRecallable=True):
-                        self._checkPackageContentFile(pkgNameVer)
-                        self._checkPackageFileScope(pkgNameVer)
-                        self._checkPackageMd5(pkgNameVer)
-                        self._checkPkgByScript(pkgNameVer)
-
-            with self.infoPrinter.printInfoAndIndent(">> Checking cruft files..."):
-                self._checkSystemCruft()
+                runner.addTask("hardware", ">> Checking hardware...",
+                               self._wrapCheckTask(self._fullCheckHardware, deepHardwareCheck), ["prepare"])
+                runner.addTask("storage-layout", ">> Checking storage layout...",
+                               self._wrapCheckTask(self._checkAndGetStorageLayout), ["prepare"])
+            runner.addTask("rootfs-layout", "- Check rootfs...",
+                           self._wrapCheckTask(self._checkRootfsLayout, deepFileSystemCheck), ["prepare"],
+                           section=">> Checking file system layout...")
+            # if self.param.runMode in ["normal", "setup"]:
+            #     runner.addTask("premount-rootfs-layout", "- Check premount rootfs...", ...)
+            runner.addTask("bbki", ">> Checking BIOS, bootloader, kernel and initramfs...",
+                           self._wrapCheckTask(lambda: self._fullCheckBbki(runner.getResult("storage-layout") if runner.hasTask("storage-layout") else None)),
+                           ["storage-layout"] if runner.hasTask("storage-layout") else ["prepare"])
+            runner.addTask("system-config", "- Check system configuration...",
+                           self._wrapCheckTask(self._fullCheckSystemConfig), ["prepare"],
+                           section=">> Checking operating system...")
+            if bAutoFix:
+                runner.addDependency("bbki", "system-config")          # auto-fix of system-config modifies /etc/portage/bbki.*
+            runner.addTask("repositories", "- Check package repositories & overlays...",
+                           self._wrapCheckTask(self._fullCheckRepositoriesAndOverlays), ["system-config"],     # both modify portage configuration
+                           section=">> Checking operating system...")
+            runner.addTask("users", "- Check users and groups...",
+                           self._wrapCheckTask(self._checkUsersAndGroups), ["prepare"],
+                           section=">> Checking operating system...")
+            runner.addTask("packages", ">> Checking software packages...",
+                           self._wrapCheckTask(self._fullCheckPackages, bUseCache, bIncremental, sampleSize, sampleTime, report is None), ["system-config", "repositories"])
+            runner.addTask("cruft", ">> Checking cruft files...",
+                           self._wrapCheckTask(self._checkSystemCruft), ["packages"])
+            runner.run()
+
+            self._getPkgExtraFilesEvaluator().save()
+            if True:
+                checkpoint, pkgNameVerList = runner.getResult("packages")
+                checkpoint.save(pkgNameVerList)                             # checkpoint is only recorded after a successful run
+
+            criticalPath = " -> ".join(["%s (%.1fs)" % (x[0], x[1]) for x in runner.getCriticalPath()])
+            self.infoPrinter.printInfo(">> Finished in %.1fs, critical path: %s." % (runner.getTotalTime(), criticalPath))
+            if self._ioThrottle.getThroughput() is not None:
+                ioSize = self._ioThrottle.getTotalBytes() // 1024 // 1024
+                ioRate = self._ioThrottle.getThroughput() / 1024 / 1024
+                self.infoPrinter.printInfo(">> Read-heavy checks read %d MiB in %.1fs, %.1f MiB/s." % (ioSize, self._ioThrottle.getTotalTime(), ioRate))
+
+            if report is not None:
+                report.save(reportFile, runner.getTotalTime(), self._ioThrottle)
+                with self.infoPrinter.printInfoAndIndent(">> Slowest checks (report is saved to \"%s\"):" % (reportFile)):
+                    for name, t in report.getSlowestList():
+                        self.infoPrinter.printInfo("%8.1fs  %s" % (t, name))
         finally:
+            if report is not None:
+                for name in self._getCheckMethodNameList():
+                    delattr(self, name)
             self.infoPrinter = None
             self.bAutoFix = False
+            self._pkgVerifier = None
+            self._fileIndex = None
+            self._rootFs = None
+            self._fileScopeMatcher = None
+            self._extraFilesEvaluator = None
+            self._pkgLocationIndex = None
+            self._md5CacheIndex = None
+            self._ioThrottle = None
+
+    def _invalidateResolver(self):
+        # auto-fix may have modified /etc/portage or repos.conf, cached results of portage queries may be out of date
+        # so is the md5-cache index, repositories and overlays may have been created or changed
+        if self.bAutoFix:
+            self.pkgwh.resolver.invalidate()
+            with self._lock:
+                self._md5CacheIndex = None
+
+    def _getCheckMethodNameList(self):
+        return [x for x in dir(type(self)) if x.startswith("_check") and callable(getattr(type(self), x))]
+
+    def _wrapCheckTask(self, func, *args):
+        def _task(printer):
+            self._tls.infoPrinter = printer
+            try:
+                return func(*args)
+            finally:
+                del self._tls.infoPrinter
+        return _task
+
+    def _ioPhase(self):
+        # read-heavy phases are rate limited and run at idle I/O priority if specified, no limit out of fullCheck()
+        if self._ioThrottle is None:
+            return contextlib.nullcontext()
+        return self._ioThrottle.phase()
+
+    def _fullCheckHardware(self, deepHardwareCheck):
+        self._checkHarddisks(deepHardwareCheck)
+        self._checkCooling()
+
+    def _fullCheckBbki(self, layout):
+        bbkiObj = BbkiWrapper(layout)
+        with self.infoPrinter.printInfoAndIndent("- Check config..."):
+            bbkiObj.check_config(self.bAutoFix, self.infoPrinter.printError)
+        with self.infoPrinter.printInfoAndIndent("- Check repositories..."):
+            bbkiObj.check_repositories(self.bAutoFix, self.infoPrinter.printError)
+        with self.infoPrinter.printInfoAndIndent("- Check boot entries..."):
+            if self.bAutoFix:
+                with BootDirWriter(layout):
+                    bbkiObj.check_boot_entry_files(self.bAutoFix, self.infoPrinter.printError)
+            else:
+                bbkiObj.check_boot_entry_files(self.bAutoFix, self.infoPrinter.printError)
+
+    def _fullCheckSystemConfig(self):
+        self._checkCpuFreqDriver()              # config in /sys
+        # self._checkMachineInfo()
+        self._checkHostsFile()                  # config in /etc
+        self._checkNsswitchFile()               # config in /etc
+        self._checkSystemLocale()               # config in /etc
+        # self._checkPamCfgFiles()
+        self._checkEtcOnlyUserCreatedFiles()
+        self._checkEtcLmSensorsCfgFiles()
+        self._checkEtcUdevRuleFiles()
+        self._checkCcacheFilesAndDirectories()
+        self._checkServiceFiles()
+        self._checkPortageCfg()
+        self._invalidateResolver()
+        self._checkSystemServices()
+        self._checkSystemTime()                 # dynamic system status
+
+    def _fullCheckRepositoriesAndOverlays(self):
+        self._checkPortagePkgwhCfg()
+        self._checkRepositories()
+        self._checkOverlays(True)
+        self._invalidateResolver()
+        self._checkNews()
+        self._checkImportantPackage()
+        self._checkWorldFile()
+        self._checkRedundantRepositoryAndOverlay()
+
+    def _fullCheckPackages(self, bUseCache, bIncremental, sampleSize, sampleTime, bBackground=True):
+        pkgNameVerList = sorted(FmUtil.portageGetInstalledPkgAtomList(FmConst.portageDbDir))
+        checkpoint = PkgCheckCheckpoint(FmConst.portageDbDir, FmConst.pkgCheckCheckpointFile)
+        if bIncremental and checkpoint.isValid():
+            checkPkgList = checkpoint.getPackageList(pkgNameVerList)
+            self.infoPrinter.printInfo("- Incremental check, %d of %d packages are selected." % (len(checkPkgList), len(pkgNameVerList)))
+        else:
+            checkPkgList = pkgNameVerList                           # no checkpoint, fall back to full check
+
+        # sampling mode: only a rotating slice of regular files are verified, and they are really read, verify cache is not used
+        # files of all the packages are walked, so it can't be used with incremental check
+        assert not (bIncremental and (sampleSize is not None or sampleTime is not None))
+        sampler = None
+        sampleDict = None
+        if sampleSize is not None or sampleTime is not None:
+            sampler = PkgFileSampler(FmConst.portageDbDir, FmConst.pkgFileSampleCursorFile)
+            sampleDict, fileCount = sampler.select(self._getInstalledFileIndex(), sampler.getByteBudget(sampleSize, sampleTime))
+            sampleCount = sum([len(x) for x in sampleDict.values()])
+            self.infoPrinter.printInfo("- Sampling mode, %d of %d files (%d MiB) are selected for verification." % (sampleCount, fileCount, sampler.getSelectedBytes() // 1024 // 1024))
+            verifyCache = None
+        else:
+            verifyCache = PkgFileVerifyCache(FmConst.fileVerifyCacheFile, bUseCache)     # cache is re-built if not used
+
+        self._getPkgExtraFilesEvaluator().prefetch(checkPkgList)
+        with self._ioPhase(), PkgFileVerifier(FmConst.portageDbDir, self._getPkgExtraFilesEvaluator(), verifyCache, sampleDict=sampleDict, ioThrottle=self._ioThrottle) as self._pkgVerifier:
+            if bBackground:
+                # verify in background, results are collected in _checkPackageMd5()
+                # not when a check report is recorded, or else the background work would be counted to whichever check is running
+                for pkgNameVer in checkPkgList:
+                    self._pkgVerifier.addPackage(pkgNameVer)
+            for pkgNameVer in checkPkgList:
+                errorCount = self.infoPrinter.getErrorCount()
+                with self.infoPrinter.printInfoAndIndent("- Package %s:" % (pkgNameVer), bRecallable=True):
+                    self._checkPackageContentFile(pkgNameVer)
+                    self._checkPackageFileScope(pkgNameVer)
+                    self._checkPackageMd5(pkgNameVer)
+                    self._checkPkgByScript(pkgNameVer)
+                if self.infoPrinter.getErrorCount() != errorCount:
+                    checkpoint.setChecked(pkgNameVer, False)
+                elif sampler is None or sampler.isPackageFullySelected(pkgNameVer):
+                    checkpoint.setChecked(pkgNameVer, True)             # package is recorded only when all its files are verified
+            verifiedBytes = self._pkgVerifier.getVerifiedBytes()
+        self._pkgVerifier = None
+
+        if verifyCache is not None:
+            verifyCache.save(checkPkgList != pkgNameVerList)
+        if sampler is not None:
+            sampler.save(verifiedBytes)
+        return (checkpoint, pkgNameVerList)
 
     def _checkHarddisks(self, deepCheck):
         tlist = FmUtil.getDevPathListForFixedHdd()
@@ -155,59 +313,17 @@ class FmSysChecker:
             self.infoPrinter.printError("No hard disk?!")
             return
 
-        # hardware check
-        if not deepCheck:
-            for hdd in tlist:
-                with self.infoPrinter.printInfoAndIndent("- Doing basic hardware check for %s(%s)" % (hdd, FmUtil.getBlkDevModel(hdd))):
-                    rc, out = FmUtil.cmdCallWithRetCode("smartctl", "-H", hdd)
-                    if re.search("failure", out, re.I) is not None:
-                        self.infoPrinter.printError("HDD health check failed! Run \"smartctl -H %s\" to do future inspection!" % (hdd))
-        else:
-            with self.infoPrinter.printInfoAndIndent("- Starting extensive hardware test for %s(%s)" % (hdd, FmUtil.getBlkDevModel(hdd))):
-                tlist2 = list(tlist)
-                for hdd in tlist:
-                    try:
-                        rc, out = FmUtil.cmdCallWithRetCode("smartctl", "-t", "long", hdd)
-                        if rc == 0:
-                            m = re.search("Please wait ([0-9]+) minutes for test to complete\\.", out, re.M)
-                            if m is None:
-                                raise Exception("")
-                            self.infoPrinter.printInfo("Test on %s(%s) started, %s minutes needed." % (hdd, FmUtil.getBlkDevModel(hdd), m.group(1)))
-                        elif rc == 4:
-                            self.infoPrinter.printInfo("Test on %s(%s) started. Why it is already in progress?" % (hdd, FmUtil.getBlkDevModel(hdd)))
-                        else:
-                            raise Exception("")
-                    except:
-                        self.infoPrinter.printError("Failed to start test on %s(%s)!" % (hdd, FmUtil.getBlkDevModel(hdd)))
-                        FmUtil.cmdCallIgnoreResult("smartctl", "-X", hdd)
-                        tlist2.remove(hdd)
-
-            with self.infoPrinter.printInfoAndIndent("- Waiting..."):
-                try:
-                    last_progress = 0
-                    while tlist2 != []:
-                        time.sleep(60 * 5)
-                        min_progress = None
-                        for hdd in list(tlist2):
-                            out = FmUtil.cmdCall("smartctl", "-l", "selftest", hdd)
-                            if re.search("# 1\\s+Extended offline\\s+Completed without error\\s+.*", out, re.M) is not None:
-                                self.infoPrinter.printInfo("Test on %s finished." % (hdd))
-                                tlist2.remove(hdd)
-                                continue
-                            m = re.search("# 1\\s+Extended offline\\s+Self-test routine in progress\\s+([0-9]+)%.*", out, re.M)
-                            if m is None:
-                                self.infoPrinter.printInfo("Test on %s failed. Run \"smartctl -l selftest %s\" to do future inspection." % (hdd, hdd))
-                                tlist2.remove(hdd)
-                                continue
-                            if min_progress is None:
-                                min_progress = 100
-                            min_progress = min(min_progress, 100 - int(m.group(1)))
-                        if min_progress is not None and min_progress > last_progress:
-                            self.infoPrinter.printInfo("Test progress: %d%%" % (min_progress))
-                            last_progress = min_progress
-                finally:
-                    for hdd in tlist2:
-                        FmUtil.cmdCallIgnoreResult("smartctl", "-X", hdd)
+        # hardware check, all the disks are queried in parallel, so total time is about the slowest disk
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(tlist)) as pool:
+            modelDict = dict(zip(tlist, pool.map(FmUtil.getBlkDevModel, tlist)))
+            if not deepCheck:
+                retList = list(pool.map(lambda x: FmUtil.cmdCallWithRetCode("smartctl", "-H", x), tlist))
+                for hdd, (rc, out) in zip(tlist, retList):
+                    with self.infoPrinter.printInfoAndIndent("- Doing basic hardware check for %s(%s)" % (hdd, modelDict[hdd])):
+                        if re.search("failure", out, re.I) is not None:
+                            self.infoPrinter.printError("HDD health check failed! Run \"smartctl -H %s\" to do future inspection!" % (hdd))
+            else:
+                self.__checkHarddisksExtensive(tlist, modelDict, pool)
 
     def _checkCooling(self):
         # FIXME: check temperature event, too high, cpu throttle, gpu throttle... (_checkCooling)
@@ -384,14 +500,11 @@ class FmSysChecker:
             "/etc/udev/rules.d",
         ]
 
-        fileSet = None
         for dn in dirList:
             if not os.path.exists(dn):
                 continue
             for fullfn in glob.glob(os.path.join(dn, "*")):
-                if fileSet is None:
-                    fileSet = FmUtil.portageGetInstalledFileSet()
-                if fullfn in fileSet:
+                if fullfn in self._getInstalledFileIndex():
                     self.infoPrinter.printError("\"%s\" should contain only user created files, but \"%s\" is not." % (dn, fullfn))
 
     def _checkEtcLmSensorsCfgFiles(self):
@@ -400,8 +513,6 @@ class FmSysChecker:
             self.infoPrinter.printError("You should use \"sensors-detect\" command from package \"sys-apps/lm-sensors\" to generate \"%s\"." % (fn))
 
     def _checkEtcUdevRuleFiles(self):
-        fileSet = None
-
         # check /etc/udev/hwdb.d
         hwdbDir = "/etc/udev/hwdb.d"
         if os.path.exists(hwdbDir):
@@ -412,9 +523,7 @@ class FmSysChecker:
         rulesDir = "/etc/udev/rules.d"
         if os.path.exists(rulesDir):
             for fn, fullfn in FmUtil.listDirWithoutKeepFiles(rulesDir):
-                if fileSet is None:
-                    fileSet = FmUtil.portageGetInstalledFileSet()
-                if fullfn in fileSet:
+                if fullfn in self._getInstalledFileIndex():
                     self.infoPrinter.printError("\"%s\" should contain only user created files, but \"%s\" is not." % (rulesDir, fullfn))
                 if not FmUtil.udevIsPureUaccessRuleFile(fullfn):
                     self.infoPrinter.printError("\"%s\" is not a pure uaccess udev rule file." % (fullfn))
@@ -604,14 +713,11 @@ class FmSysChecker:
 
             # check package atom validity
             if bFullCheck:
-                pass
-                # porttree = portage.db[portage.root]["porttree"]
-                # cpvAll = porttree.dbapi.cpv_all()
-                # for fn in os.listdir(FmConst.portageCfgMaskDir):
-                #     fullfn = os.path.join(FmConst.portageCfgMaskDir, fn)
-                #     for pkgAtom in FmUtil.portageReadCfgMaskFile(fullfn):
-                #         if len(porttree.dbapi.match(pkgAtom)) == 0:
-                #             raise FmCheckException("invalid package atom \"%s\" in %s" % (pkgAtom, fullfn))
+                for fn in sorted(os.listdir(FmConst.portageCfgMaskDir)):
+                    fullfn = os.path.join(FmConst.portageCfgMaskDir, fn)
+                    for pkgAtom in FmUtil.portageReadCfgMaskFile(fullfn):
+                        if self.__portageGetCpvAndIuseList(pkgAtom) == []:
+                            self.infoPrinter.printError("Invalid package atom \"%s\" in %s." % (pkgAtom, fullfn))
 
         # check /etc/portage/package.unmask directory
         self.__checkAndFixEtcDir(FmConst.portageCfgUnmaskDir)
@@ -655,44 +761,32 @@ class FmSysChecker:
 
             # check use flag existence
             if bFullCheck:
-                pass
-                # porttree = portage.db[portage.root]["porttree"]
-                # cpvAll = porttree.dbapi.cpv_all()
-                # for fn in os.listdir(FmConst.portageCfgUseDir):
-                #     fullfn = os.path.join(FmConst.portageCfgUseDir, fn)
-                #     for pkgAtom, useList in FmUtil.portageReadCfgUseFile(fullfn):
-                #         if useList[0].endswith(":"):
-                #             # convert EXPAND_USE to normal use flags
-                #             useList = [useList[0][:-1].lower() + "_" + x.lstrip("-") for x in useList[1:] if x != "-*"]
-                #         else:
-                #             useList = [x.lstrip("-") for x in useList]
-
-                #         if pkgAtom == "*/*":
-                #             for u in useList:
-                #                 bFound = False
-                #                 for cpv in cpvAll:
-                #                     iuseList = porttree.dbapi.aux_get(cpv, ["IUSE"])[0].split()
-                #                     iuseList = [x.lstrip("+") for x in iuseList]
-                #                     if u in iuseList:
-                #                         bFound = True
-                #                         break
-                #                 if bFound:
-                #                     break
-                #             if not bFound:
-                #                 raise FmCheckException("invalid USE flag \"%s\" for \"%s\" in %s" % (u, pkgAtom, fullfn))
-                #         else:
-                #             cpvList = porttree.dbapi.match(pkgAtom)
-                #             if len(cpvList) == 0:
-                #                 raise FmCheckException("invalid package atom \"%s\" in %s" % (pkgAtom, fullfn))
-                #             if FmUtil.portageIsSimplePkgAtom(pkgAtom):
-                #                 cpvList = cpvList[-1:]                     # checks only the latest version for simple package atom (eg: media-video/smplayer)
-                #             for cpv in cpvList:
-                #                 iuseList = porttree.dbapi.aux_get(cpv, ["IUSE"])[0].split()
-                #                 iuseList = [x.lstrip("+") for x in iuseList]
-                #                 for u in useList:
-                #                     if u not in iuseList:
-                #                         print(iuseList)
-                #                         raise FmCheckException("invalid USE flag \"%s\" for package atom \"%s\" in %s" % (u, pkgAtom, fullfn))
+                for fn in sorted(os.listdir(FmConst.portageCfgUseDir)):
+                    fullfn = os.path.join(FmConst.portageCfgUseDir, fn)
+                    for pkgAtom, useList in FmUtil.portageParseCfgUseFile(pathlib.Path(fullfn).read_text()):
+                        if len(useList) > 0 and useList[0].endswith(":"):
+                            # convert EXPAND_USE to normal use flags
+                            useList = [useList[0][:-1].lower() + "_" + x.lstrip("-") for x in useList[1:] if x != "-*"]
+                        else:
+                            useList = [x.lstrip("-") for x in useList]
+
+                        if pkgAtom == "*/*":
+                            for u in useList:
+                                if u not in self._getMd5CacheIndex().getAllIuseSet() and u not in self.pkgwh.resolver.getImplicitIuseSet():
+                                    self.infoPrinter.printError("Invalid USE flag \"%s\" for \"%s\" in %s." % (u, pkgAtom, fullfn))
+                        else:
+                            cpvIuseList = self.__portageGetCpvAndIuseList(pkgAtom)
+                            if cpvIuseList is None:
+                                continue
+                            if cpvIuseList == []:
+                                self.infoPrinter.printError("Invalid package atom \"%s\" in %s." % (pkgAtom, fullfn))
+                                continue
+                            if FmUtil.portageIsSimplePkgAtom(pkgAtom):
+                                cpvIuseList = cpvIuseList[-1:]             # checks only the latest version for simple package atom (eg: media-video/smplayer)
+                            for cpv, iuseSet in cpvIuseList:
+                                for u in useList:
+                                    if u not in iuseSet:
+                                        self.infoPrinter.printError("Invalid USE flag \"%s\" for package atom \"%s\" in %s." % (u, pkgAtom, fullfn))
 
             # check use flag conflict
             if bFullCheck:
@@ -850,28 +944,26 @@ class FmSysChecker:
 
         # there should be no same ebuild directory between repositories
         if bFullCheck:
-            infoDict = dict()
-            for repoName in self.pkgwh.repoman.getRepositoryList():
-                repoDir = self.pkgwh.repoman.getRepoDir(repoName)
-                infoDict[repoName] = set(FmUtil.repoGetEbuildDirList(repoDir))
-
-            tlist = list(infoDict.items())
+            tlist = self.pkgwh.repoman.getRepositoryList()
             for i in range(0, len(tlist)):
                 for j in range(i + 1, len(tlist)):
-                    k, v = tlist[i]
-                    k2, v2 = tlist[j]
+                    k, v = tlist[i], self._getPkgLocationIndex().getRepoPackageSet(tlist[i])
+                    k2, v2 = tlist[j], self._getPkgLocationIndex().getRepoPackageSet(tlist[j])
                     for vi in list(v & v2):
                         self.infoPrinter.printError("Repository \"%s\" and \"%s\" has same package \"%s\"" % (k, k2, vi))
 
     def _checkOverlays(self, bCheckContent, bFullCheck=True):
         """Check overlays"""
 
-        # check all overlays
-        for overlayName in self.pkgwh.layman.getOverlayList():
-            try:
-                self.pkgwh.layman.checkOverlay(overlayName, bCheckContent, self.bAutoFix)
-            except OverlayCheckError as e:
-                raise FmCheckException(e.message)
+        # check all overlays, content comparison is read-heavy
+        with self._ioPhase() if bCheckContent else contextlib.nullcontext():
+            for overlayName in self.pkgwh.layman.getOverlayList():
+                try:
+                    self.pkgwh.layman.checkOverlay(overlayName, bCheckContent, self.bAutoFix, self._ioThrottle)
+                except OverlayCheckError as e:
+                    raise FmCheckException(e.message)
+        if self.bAutoFix:
+            self._pkgLocationIndex = None           # overlay content may be changed by auto-fix
 
         # basic check stops here
         if not bFullCheck:
@@ -898,25 +990,23 @@ class FmSysChecker:
 
             # 2. there should be no same ebuild directory between repository and overlay
             if True:
-                infoDict = dict()
-                for repoName in self.pkgwh.repoman.getRepositoryList():
-                    repoDir = self.pkgwh.repoman.getRepoDir(repoName)
-                    infoDict[repoName] = set(FmUtil.repoGetEbuildDirList(repoDir))
-
-                oDirInfo = set(FmUtil.repoGetEbuildDirList(oDir))
-                for k, v in infoDict.items():
+                oDirInfo = self._getPkgLocationIndex().getOverlayPackageSet(overlayName)
+                for k in self.pkgwh.repoman.getRepositoryList():
+                    v = self._getPkgLocationIndex().getRepoPackageSet(k)
                     for vi in list(v & oDirInfo):
                         if self.bAutoFix and self.pkgwh.layman.getOverlayType(overlayName) in ["trusted", "transient"]:
                             FmUtil.repoRemovePackageAndCategory(oDir, vi)
+                            self._getPkgLocationIndex().removeOverlayPackage(overlayName, vi)
                         else:
                             self.infoPrinter.printError("Repository \"%s\" and overlay \"%s\" has same package \"%s\"." % (k, overlayName, vi))
 
             # 3. transient overlay must has at least one enabled package
             #    this should be after check 2 since check 2 may auto remove package from overlay
             if self.pkgwh.layman.getOverlayType(overlayName) == "transient":
-                if len(FmUtil.repoGetEbuildDirList(oDir)) == 0:
+                if len(self._getPkgLocationIndex().getOverlayPackageSet(overlayName)) == 0:
                     if self.bAutoFix:
                         self.pkgwh.layman.removeOverlay(overlayName)
+                        self._getPkgLocationIndex().removeOverlay(overlayName)
                         continue
                     else:
                         self.infoPrinter.printError("Overlay \"%s\" has no enabled package." % (overlayName))
@@ -1015,9 +1105,9 @@ class FmSysChecker:
         # /etc/portage/package.use/97-linguas
         # FIXME: support syncupd
         if self.bAutoFix:
-            self.pkgwh.refreshLinguasUseFlags()
+            self.pkgwh.refreshLinguasUseFlags(self._getMd5CacheIndex())
         else:
-            self.pkgwh.checkLinguasUseFlags()
+            self.pkgwh.checkLinguasUseFlags(self._getMd5CacheIndex())
 
     def _checkImportantPackage(self):
         # get important package list
@@ -1031,25 +1121,18 @@ class FmSysChecker:
                     line = re.sub(r'\s*#.*', "", line)
                     importantPkgList.append(line)
 
-        # get all package list:
-        allPkgList = []
-        for repoName in self.pkgwh.repoman.getRepositoryList():
-            allPkgList += FmUtil.repoGetEbuildDirList(self.pkgwh.repoman.getRepoDir(repoName))
-        for oName in self.pkgwh.layman.getOverlayList():
-            allPkgList += FmUtil.repoGetEbuildDirList(self.pkgwh.layman.getOverlayDir(oName))
-
         # check existence
         for pkg in importantPkgList:
-            if pkg not in allPkgList:
+            if not self._getPkgLocationIndex().hasPackage(pkg):
                 self.infoPrinter.printError("Important package \"%s\" does not exist in any repository or overlay." % (pkg))
 
     def _checkWorldFile(self):
         worldFile = os.path.join(FmConst.portageDataDir, "world")
-        for line in pathlib.Path(worldFile).read_text().split("\n"):
-            line = line.strip()
-            if line == "":
-                continue
-            if not FmUtil.portageIsPkgInstallable(line):
+        lineList = [x.strip() for x in pathlib.Path(worldFile).read_text().split("\n")]
+        lineList = [x for x in lineList if x != ""]
+        matchDict = self.pkgwh.resolver.matchBatch(lineList)
+        for line in lineList:
+            if len(matchDict[line]) == 0:
                 self.infoPrinter.printError("Uninstallable package \"%s\" in \"%s\"." % (line, worldFile))
 
     def _checkUsersAndGroups(self):
@@ -1128,17 +1211,10 @@ class FmSysChecker:
 
         # check system time
         try:
-            for i in range(0, 4):
-                try:
-                    nc = ntplib.NTPClient()
-                    ret = nc.request("%d.pool.ntp.org" % (i))
-                    if abs(ret.offset) > 1.0:
-                        # we tolerant an offset of 1 seconds
-                        self.infoPrinter.printError("System time is incorrect. Maybe you need network time synchronization?")
-                    break
-                except:
-                    if i == 3:
-                        raise
+            offset = FmUtil.queryNtpOffset(["%d.pool.ntp.org" % (i) for i in range(0, 4)])
+            if abs(offset) > 1.0:
+                # we tolerant an offset of 1 seconds
+                self.infoPrinter.printError("System time is incorrect. Maybe you need network time synchronization?")
         except Exception as e:
             self.infoPrinter.printError("Error occured when checking system time, %s." % (str(e)))
 
@@ -1147,91 +1223,24 @@ class FmSysChecker:
         if not os.path.exists(contf):
             if self.bAutoFix:
                 PkgMerger().reInstallPkg(pkgNameVer)
+                self._pkgVerifier.removePackage(pkgNameVer)        # background verification result is out of date
+                self._fileIndex = None                              # file index is refreshed incrementally when used next time
                 if not os.path.exists(contf):
                     self.infoPrinter.printError("Content file %s is missing, auto-fix failed." % (contf))
             else:
                 self.infoPrinter.printError("Content file %s is missing." % (contf))
 
     def _checkPackageFileScope(self, pkgNameVer):
-        # There're some directories and files I think should not belong to any package, but others don't think so...
-        wildcards = []
-        if True:
-            obj = strict_fsh.RootFs()
-            wilecards = strict_fsh.merge_wildcards(wildcards, obj.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_SYSTEM_BOOT))
-            wildcards = strict_fsh.merge_wildcards(wildcards, obj.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_SYSTEM_DATA))
-            wildcards = strict_fsh.merge_wildcards(wildcards, obj.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_SYSTEM_CACHE))
-            wildcards = strict_fsh.merge_wildcards(wildcards, obj.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_USER))
-            wildcards = strict_fsh.merge_wildcards(wildcards, obj.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_RUNTIME))
-
         # get file list for this package
-        cmdStr = r"cat /var/db/pkg/%s/CONTENTS " % (pkgNameVer)
-        cmdStr += r'| sed -e "s:^obj \(.*\) [[:xdigit:]]\+ [[:digit:]]\+$:\1:" '
-        cmdStr += r'| sed -e "s:^sym \(.*\) -> .* .*$:\1:" '
-        cmdStr += r'| sed -e "s:^dir \(.*\)$:\1:" '
-        ret = FmUtil.shellCall(cmdStr).split("\n")
+        ret = self._getInstalledFileIndex().getPackageFileList(pkgNameVer)
 
         # check
-        for fn in strict_fsh.wildcards_filter(ret, wilecards):
+        for fn in self._getFileScopeMatcher().filter(ret):
             self.infoPrinter.printError("\"%s\" should not be installed by package manager. (add to \"/usr/lib/tmpfiles.d/*.conf\"?)" % (fn))
 
     def _checkPackageMd5(self, pkgNameVer):
-        itemList = []
-
-        # get item list from CONTENTS_2 file
-        if True:
-            contf = os.path.join(FmConst.portageDbDir, pkgNameVer, "CONTENTS_2")
-            if not os.path.exists(contf):
-                # FIXME
-                self.infoPrinter.printError("CONTENTS_2 file for %s is missing." % (pkgNameVer))
-                return
-            itemList = FmUtil.portageParseVarDbPkgContentFile(contf)
-
-        # filter extra files
-        if True:
-            wildcards = FmUtil.repoGetPkgExtraFilesWildcards(FmConst.portageDbDir, pkgNameVer)
-            wildcards = strict_fsh.merge_wildcards(wildcards, ["+ /etc/***"])
-            itemList = [x for x in itemList if not strict_fsh.wildcards_match(x[1], wildcards)]
-
-        # check md5
-        for item in itemList:
-            if item[0] == "dir":
-                if not os.path.exists(item[1]):
-                    self.infoPrinter.printError("Directory %s is missing." % (item[1]))
-                else:
-                    s = os.stat(item[1])
-                    if s.st_uid != item[3]:
-                        self.infoPrinter.printError("Directory %s failes for uid verification." % (item[1]))
-                    if s.st_gid != item[4]:
-                        self.infoPrinter.printError("Directory %s failes for gid verification." % (item[1]))
-            elif item[0] == "obj":
-                if not os.path.exists(item[1]):
-                    self.infoPrinter.printError("File %s is missing" % (item[1]))
-                else:
-                    if not FmUtil.verifyFileMd5(item[1], item[2]):
-                        self.infoPrinter.printError("File %s fails for MD5 verification." % (item[1]))
-                    s = os.stat(item[1])
-                    if s.st_mode != item[3]:
-                        self.infoPrinter.printError("File %s failes for permission verification." % (item[1]))
-                    if s.st_uid != item[4]:
-                        self.infoPrinter.printError("File %s failes for uid verification." % (item[1]))
-                    if s.st_gid != item[5]:
-                        self.infoPrinter.printError("File %s failes for gid verification." % (item[1]))
-            elif item[0] == "sym":
-                if not os.path.islink(item[1]):
-                    self.infoPrinter.printError("Symlink %s is missing." % (item[1]))
-                else:
-                    if os.readlink(item[1]) != item[2]:
-                        self.infoPrinter.printError("Symlink %s fails for target verification." % (item[1]))
-                    if not os.path.exists(item[1]):
-                        self.infoPrinter.printError("Symlink %s is broken." % (item[1]))
-                    else:
-                        s = os.stat(item[1])
-                        if s.st_uid != item[3]:
-                            self.infoPrinter.printError("Symlink %s failes for uid verification." % (item[1]))
-                        if s.st_gid != item[4]:
-                            self.infoPrinter.printError("Symlink %s failes for gid verification." % (item[1]))
-            else:
-                assert False
+        for msg in self._pkgVerifier.getResult(pkgNameVer):
+            self.infoPrinter.printError(msg)
 
     def _checkPkgByScript(self, pkgNameVer):
         pass
@@ -1244,7 +1253,7 @@ class FmSysChecker:
         #         self.infoPrinter.printError(e.message)
 
     def _checkSystemCruft(self):
-        rootFs = strict_fsh.RootFs()
+        rootFs = self._getRootFs()
 
         # get wildcards
         wildcards = rootFs.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_SYSTEM)
@@ -1259,26 +1268,154 @@ class FmSysChecker:
         wildcards = strict_fsh.deduct_wildcards(wildcards, rootFs.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_USER_TRASH))
 
         # filter wildcards: filter all package extra files
-        for pkgAtom in FmUtil.portageGetInstalledPkgAtomList(FmConst.portageDbDir):
-            wildcards2 = FmUtil.repoGetPkgExtraFilesWildcards(FmConst.portageDbDir, pkgAtom)
-            wildcards = strict_fsh.deduct_wildcards(wildcards, wildcards2)
-
-        # get files
-        fileSet = set(rootFs.wildcards_glob(wildcards))
-
-        # filter files: filter installed files
+        wildcards2 = []
         if True:
-            fileSet -= FmUtil.portageGetInstalledFileSet(expanded=True)
+            pkgAtomList = FmUtil.portageGetInstalledPkgAtomList(FmConst.portageDbDir)
+            self._getPkgExtraFilesEvaluator().prefetch(pkgAtomList)
+            for pkgAtom in pkgAtomList:
+                wildcards3 = self._getPkgExtraFilesEvaluator().getWildcards(pkgAtom)
+                wildcards = strict_fsh.deduct_wildcards(wildcards, wildcards3)
+                wildcards2 += wildcards3                # only used to skip directories fully owned by packages
+
+        # find cruft files, show or delete them as soon as they are found
+        scanner = CruftFileScanner(wildcards, wildcards2, self._getInstalledFileIndex(), self._ioThrottle)
+        with self._ioPhase():
+            for cf in scanner.scan():
+                if self.bAutoFix:
+                    # auto remove cruft file: broken symlink
+                    if os.path.islink(cf) and not os.path.exists(cf):
+                        os.unlink(cf)
+                        continue
+                # show cruft file
+                self.infoPrinter.printError("Cruft file found: %s" % (cf))
 
-        # show or delete
-        for cf in sorted(list(fileSet)):
-            if self.bAutoFix:
-                # auto remove cruft file: broken symlink
-                if os.path.islink(cf) and not os.path.exists(cf):
-                    os.unlink(cf)
+    def _getRootFs(self):
+        with self._lock:
+            if self._rootFs is None:
+                self._rootFs = strict_fsh.RootFs()
+            return self._rootFs
+
+    def _getFileScopeMatcher(self):
+        # There're some directories and files I think should not belong to any package, but others don't think so...
+        # compiled when first used, and used for all the packages
+        with self._lock:
+            if self._fileScopeMatcher is None:
+                wildcards = self._getRootFs().get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_SYSTEM_BOOT)
+                self._fileScopeMatcher = WildcardsMatcher(wildcards)
+            return self._fileScopeMatcher
+
+    def _getPkgExtraFilesEvaluator(self):
+        # created when first used, evaluation results are shared by the per-package check and the cruft check
+        with self._lock:
+            if self._extraFilesEvaluator is None:
+                self._extraFilesEvaluator = PkgExtraFilesEvaluator(FmConst.portageDbDir, FmConst.pkgExtraFilesCacheFile)
+            return self._extraFilesEvaluator
+
+    def _getPkgLocationIndex(self):
+        # built when first used, after repositories and overlays are checked
+        with self._lock:
+            if self._pkgLocationIndex is None:
+                self._pkgLocationIndex = PkgLocationIndex(self.pkgwh.repoman, self.pkgwh.layman)
+            return self._pkgLocationIndex
+
+    def _getMd5CacheIndex(self):
+        # built when first used, only changed md5-cache entries are read
+        with self._lock:
+            if self._md5CacheIndex is None:
+                repoDirList = [self.pkgwh.repoman.getRepoDir(x) for x in self.pkgwh.repoman.getRepositoryList()]
+                repoDirList += [self.pkgwh.layman.getOverlayDir(x) for x in self.pkgwh.layman.getOverlayList()]
+                self._md5CacheIndex = PkgMd5CacheIndex(repoDirList, FmConst.md5CacheIndexFile)
+            return self._md5CacheIndex
+
+    def _getInstalledFileIndex(self):
+        # built when first used, and used for the whole check
+        with self._lock:
+            if self._fileIndex is None:
+                self._fileIndex = InstalledFileIndex(FmConst.portageDbDir, FmConst.installedFileIndexFile)
+            return self._fileIndex
+
+    def __checkHarddisksExtensive(self, tlist, modelDict, pool):
+        # expected test time of each disk, None means unknown
+        testDict = dict()
+
+        with self.infoPrinter.printInfoAndIndent("- Starting extensive hardware test..."):
+            startTime = time.monotonic()
+            retList = list(pool.map(lambda x: FmUtil.cmdCallWithRetCode("smartctl", "-t", "long", x), tlist))
+            for hdd, (rc, out) in zip(tlist, retList):
+                if rc == 0:
+                    m = re.search("Please wait ([0-9]+) minutes for test to complete\\.", out, re.M)
+                    if m is not None:
+                        self.infoPrinter.printInfo("Test on %s(%s) started, %s minutes needed." % (hdd, modelDict[hdd], m.group(1)))
+                        testDict[hdd] = int(m.group(1)) * 60
+                        continue
+                elif rc == 4:
+                    self.infoPrinter.printInfo("Test on %s(%s) started. Why it is already in progress?" % (hdd, modelDict[hdd]))
+                    testDict[hdd] = None
                     continue
-            # show cruft file
-            self.infoPrinter.printError("Cruft file found: %s" % (cf))
+                self.infoPrinter.printError("Failed to start test on %s(%s)!" % (hdd, modelDict[hdd]))
+                FmUtil.cmdCallIgnoreResult("smartctl", "-X", hdd)
+
+        with self.infoPrinter.printInfoAndIndent("- Waiting..."):
+            try:
+                last_progress = 0
+                remainList = [x for x in testDict.values() if x is not None]
+                while len(testDict) > 0:
+                    # poll when the first disk is expected to finish, but not too often or too seldom
+                    interval = min(remainList) if len(remainList) > 0 else 60 * 5
+                    time.sleep(min(max(interval, 30), 60 * 5))
+
+                    hddList = list(testDict.keys())
+                    outList = list(pool.map(lambda x: FmUtil.cmdCall("smartctl", "-l", "selftest", x), hddList))
+                    elapsed = time.monotonic() - startTime
+                    min_progress = None
+                    remainList = []
+                    for hdd, out in zip(hddList, outList):
+                        if re.search("# 1\\s+Extended offline\\s+Completed without error\\s+.*", out, re.M) is not None:
+                            self.infoPrinter.printInfo("Test on %s finished." % (hdd))
+                            del testDict[hdd]
+                            continue
+                        m = re.search("# 1\\s+Extended offline\\s+Self-test routine in progress\\s+([0-9]+)%.*", out, re.M)
+                        if m is None:
+                            self.infoPrinter.printInfo("Test on %s failed. Run \"smartctl -l selftest %s\" to do future inspection." % (hdd, hdd))
+                            del testDict[hdd]
+                            continue
+                        progress = 100 - int(m.group(1))
+                        if min_progress is None:
+                            min_progress = 100
+                        min_progress = min(min_progress, progress)
+                        if progress > 0:
+                            remainList.append(elapsed * (100 - progress) / progress)
+                        elif testDict[hdd] is not None:
+                            remainList.append(testDict[hdd] - elapsed)
+                    if min_progress is not None and min_progress > last_progress:
+                        self.infoPrinter.printInfo("Test progress: %d%%" % (min_progress))
+                        last_progress = min_progress
+            finally:
+                for hdd in testDict:
+                    FmUtil.cmdCallIgnoreResult("smartctl", "-X", hdd)
+
+    def __portageGetCpvAndIuseList(self, pkgAtom):
+        # returns list<tuple(cpv, set<use-flag>)> in ascending version order, masked versions are included, returns None if the atom can't be checked (wildcard atom)
+        # md5-cache index is used first, portage is asked only for packages that are in repositories without md5-cache
+        if "*" in pkgAtom:
+            return None
+        try:
+            cpvList = self._getMd5CacheIndex().match(pkgAtom)
+            cp = portage.dep.Atom(pkgAtom).cp
+        except portage.exception.InvalidAtom:
+            return []
+        ret = [(x, self._getMd5CacheIndex().getIuseSet(x)) for x in (cpvList if cpvList is not None else [])]
+
+        # versions in overlays without md5-cache are merged, record in md5-cache is used if a version is in both
+        if self._getMd5CacheIndex().isInUnindexedRepo(cp):
+            cpvSet = set([x[0] for x in ret])
+            for cpv in self.pkgwh.resolver.xmatchAll(pkgAtom):
+                if cpv not in cpvSet:
+                    ret.append((cpv, set([y.lstrip("+-") for y in self.pkgwh.resolver.auxGet(cpv, "IUSE").split()])))
+                    cpvSet.add(cpv)
+            ret.sort(key=functools.cmp_to_key(lambda a, b: portage.versions.vercmp(portage.versions.cpv_getversion(a[0]), portage.versions.cpv_getversion(b[0]))))
+
+        return ret
 
     def __checkAndFixEtcDir(self, etcDir):
         if not os.path.exists(etcDir):
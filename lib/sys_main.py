@@ -23,6 +23,7 @@ from helper_bbki import BootDirWriter
 from helper_pkg_warehouse import EbuildRepositories
 from helper_pkg_warehouse import EbuildOverlays
 from helper_pkg_warehouse import CloudOverlayDb
+from helper_pkg_warehouse import PkgLocationIndex
 from sys_machine_info import HwInfoPcBranded
 from sys_machine_info import HwInfoPcAssembled
 from sys_machine_info import DevHwInfoDb
@@ -326,11 +327,12 @@ class FmMain:
         if True:
             pkgList = FmUtil.portageReadWorldFile(FmConst.worldFile)
             maxLen = max([len(x) for x in pkgList])
+            pkgLocIndex = PkgLocationIndex(repoman, layman)
 
             for repoName in repoman.getRepositoryList():
                 tempList = []
                 for pkg in pkgList:
-                    if os.path.exists(os.path.join(repoman.getRepoDir(repoName), pkg)):
+                    if pkg in pkgLocIndex.getRepoPackageSet(repoName):
                         print("    %s (repo-%s)" % (FmUtil.pad(pkg, maxLen), repoName))
                     else:
                         tempList.append(pkg)
@@ -339,7 +341,7 @@ class FmMain:
             for overlayName in layman.getOverlayList():
                 tempList = []
                 for pkg in pkgList:
-                    if os.path.exists(os.path.join(layman.getOverlayDir(overlayName), pkg)):
+                    if pkg in pkgLocIndex.getOverlayPackageSet(overlayName):
                         print("    %s (overlay-%s)" % (FmUtil.pad(pkg, maxLen), overlayName))
                     else:
                         tempList.append(pkg)
@@ -350,10 +352,10 @@ class FmMain:
 
         return 0
 
-    def doUpdate(self, bSync):
+    def doUpdate(self, bSync, syncJobNumber=8, syncJobNumberPerHost=None):
         self.param.sysChecker.basicCheck()
 
-        self.param.sysUpdater.update(bSync, True)
+        self.param.sysUpdater.update(bSync, True, syncJobNumber, syncJobNumberPerHost)
         return 0
 
     def doClean(self, bPretend):
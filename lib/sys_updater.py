@@ -2,10 +2,13 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import sys
 import json
+import subprocess
 import strict_hdds
 from fm_util import FmUtil
 from fm_util import ParallelRunSequencialPrint
+from fm_util import DagTaskRunner
 from fm_param import FmConst
 from client_build_server import BuildServerSelector
 from helper_bbki import BbkiWrapper
@@ -27,7 +30,9 @@ class FmSysUpdater:
         self.opEmergeWorld = os.path.join(FmConst.libexecDir, "op-emerge-world.py")
         self.opEmerge9999 = os.path.join(FmConst.libexecDir, "op-emerge-9999.py")
 
-    def update(self, bSync, bFetchAndBuild):
+        self._updateJobNumber = 4
+
+    def update(self, bSync, bFetchAndBuild, syncJobNumber=8, syncJobNumberPerHost=None):
         if self.param.runMode in ["normal", "setup"]:
             layout = strict_hdds.get_storage_layout()
         else:
@@ -42,8 +47,72 @@ class FmSysUpdater:
                 with BootDirWriter(layout):
                     bbkiObj.setStable(False)
 
+        # get build server
+        if BuildServerSelector.hasBuildServerCfgFile():
+            self.infoPrinter.printInfo(">> Selecting build server...")
+            buildServer = BuildServerSelector.selectBuildServer()
+            print("")
+        else:
+            buildServer = None
+
+        # phases are run concurrently as far as their dependencies allow, output of each phase is kept grouped and in the order of adding
+        # commands on build server write to the terminal directly, so phases are run one by one if there's build server
+        runner = DagTaskRunner(self.infoPrinter, self._updateJobNumber if buildServer is None else 1, bCaptureStdout=True)
+        runner.addTask("prepare", None, self._updatePrepare)
+        startTask = "prepare"
+        if buildServer is not None:
+            runner.addTask("sync-up", None,
+                           lambda p: self._updateSyncUp(p, buildServer), ["prepare"])
+            startTask = "sync-up"
+        kernelDependList = [startTask]
+        worldDependList = []
+        if bSync:
+            runner.addTask("sync-bbki-repo", None,
+                           lambda p: self._updateSyncBbkiRepositories(p, buildServer, bbkiObj, syncJobNumber, syncJobNumberPerHost), [startTask])
+            runner.addTask("sync-repo", None,
+                           lambda p: self._updateSyncRepositories(p, buildServer, pkgwh, syncJobNumber, syncJobNumberPerHost), [startTask])
+            runner.addTask("update-overlay-db", None,
+                           lambda p: self._updateCloudOverlayDb(p, overlayDb), [startTask])
+            runner.addTask("sync-overlay", None,
+                           lambda p: self._updateSyncOverlays(p, buildServer, pkgwh, syncJobNumber, syncJobNumberPerHost), ["sync-repo"])
+            runner.addTask("pre-enable", None,
+                           lambda p: self._updatePreEnable(p, buildServer, pkgwh, overlayDb), ["sync-overlay", "update-overlay-db"])
+            runner.addTask("refresh", None,
+                           lambda p: self._execAndSyncDownQuietly(p, buildServer, self.opSync, self.param.runMode, "refresh-package-related-stuff", directory=FmConst.portageCfgDir),
+                           ["pre-enable"])
+            # eliminate "Performing Global Updates", FIXME
+            runner.addTask("touch-portage-tree", None,
+                           lambda p: self._execAndSyncDownQuietly(p, buildServer, self.opSync, self.param.runMode, "touch-portage-tree", directory=FmConst.portageDbDir),
+                           ["refresh"])
+            # fetching and building kernel does not need package repositories, it runs when repositories and overlays are being synchronized
+            kernelDependList = ["sync-bbki-repo"]
+            worldDependList = ["touch-portage-tree"]
+        runner.addTask("install-kernel", None,
+                       lambda p: self._updateInstallKernel(p, buildServer, layout, bbkiObj), kernelDependList)
+        # creating initramfs and updating boot-loader are done in this process, sub-processes they spawn write to the terminal directly,
+        # so they start after all the previous phases are finished, to be at the output front
+        runner.addTask("update-bootloader", None,
+                       lambda p: self._updateBootloader(p, layout, bbkiObj), ["install-kernel"] + worldDependList)
+        runner.addTask("sync-boot-partition", None,
+                       lambda p: self._updateSyncBootPartitions(p, layout), ["update-bootloader"])
+        # emerge starts after all the previous phases are finished, so it is at the output front and has the terminal
+        runner.addTask("emerge-world", None,
+                       lambda p: self._updateEmerge(p, buildServer, ">> Updating @world...", self.opEmergeWorld),
+                       ["install-kernel", "sync-boot-partition"] + worldDependList)
+        runner.addTask("emerge-9999", None,
+                       lambda p: self._updateEmerge(p, buildServer, ">> Updating all \"-9999\" packages...", self.opEmerge9999), ["emerge-world"])
+        try:
+            runner.run()
+        finally:
+            self._printTimeline(runner)
+
+        # end remote build
+        if buildServer is not None:
+            buildServer.dispose()
+
+    def _updatePrepare(self, printer):
         # modify dynamic config
-        self.infoPrinter.printInfo(">> Preparing...")
+        printer.printInfo(">> Preparing...")
         if True:
             dcm = DynCfgModifier()
             dcm.updateMirrors()
@@ -52,202 +121,217 @@ class FmSysUpdater:
             dcm.updateCcache()
         print("")
 
-        # get build server
-        if BuildServerSelector.hasBuildServerCfgFile():
-            self.infoPrinter.printInfo(">> Selecting build server...")
-            buildServer = BuildServerSelector.selectBuildServer()
-            print("")
-        else:
-            buildServer = None
-
+    def _updateSyncUp(self, printer, buildServer):
         # sync up and start working
-        if buildServer is not None:
-            self.infoPrinter.printInfo(">> Synchronizing up...")
-            buildServer.syncUp()
-            buildServer.startWorking()
-            print("")
+        printer.printInfo(">> Synchronizing up...")
+        buildServer.syncUp()
+        buildServer.startWorking()
+        print("")
 
-        # do sync
-        if bSync:
-            # sync bbki repositories
-            with ParallelRunSequencialPrint() as prspObj:
-                if buildServer is not None:
-                    startCoro = buildServer.asyncStartSshExec
-                    waitCoro = buildServer.asyncWaitSshExec
-                else:
-                    startCoro = FmUtil.asyncStartCmdExec
-                    waitCoro = FmUtil.asyncWaitCmdExec
-                for repo in bbkiObj.repositories:
-                    prspObj.add_task(
-                        startCoro, [self.opSync, self.param.runMode, "sync-bbki-repo", repo.name],
-                        waitCoro,
-                        pre_func=lambda x=repo.name: self.infoPrinter.printInfo(">> Synchronizing BBKI repository \"%s\"..." % (x)),
-                        post_func=lambda: print(""),
-                    )
-            # FIXME: there should be no sync down after realtime network filesystem support is done
+    def _updateSyncBbkiRepositories(self, printer, buildServer, bbkiObj, syncJobNumber, syncJobNumberPerHost):
+        with ParallelRunSequencialPrint(syncJobNumber, syncJobNumberPerHost) as prspObj:
             if buildServer is not None:
-                buildServer.syncDownDirectory(FmConst.portageDataDir)
+                startCoro = buildServer.asyncStartSshExec
+                waitCoro = buildServer.asyncWaitSshExec
+            else:
+                startCoro = FmUtil.asyncStartCmdExec
+                waitCoro = FmUtil.asyncWaitCmdExec
+            for repo in bbkiObj.repositories:
+                prspObj.add_task(
+                    startCoro, [self.opSync, self.param.runMode, "sync-bbki-repo", repo.name],
+                    waitCoro,
+                    pre_func=lambda x=repo.name: printer.printInfo(">> Synchronizing BBKI repository \"%s\"..." % (x)),
+                    post_func=lambda: print(""),
+                )
+        # FIXME: there should be no sync down after realtime network filesystem support is done
+        if buildServer is not None:
+            buildServer.syncDownDirectory(FmConst.portageDataDir)
 
-            # sync repository directories
+    def _updateSyncRepositories(self, printer, buildServer, pkgwh, syncJobNumber, syncJobNumberPerHost):
+        # sync repository directories, gentoo repository is patched after sync in the same sub-process
+        # gentoo repository is the largest and slowest one, so it is started first
+        # other repositories are patched after all the repositories are synchronized, their patches call "ebuild manifest" which uses eclasses of gentoo repository
+        if buildServer is not None:
+            startCoro = buildServer.asyncStartSshExec
+            waitCoro = buildServer.asyncWaitSshExec
+        else:
+            startCoro = FmUtil.asyncStartCmdExec
+            waitCoro = FmUtil.asyncWaitCmdExec
+        with ParallelRunSequencialPrint(syncJobNumber, syncJobNumberPerHost) as prspObj:
             for repoName in pkgwh.repoman.getRepositoryList():
-                repoDir = pkgwh.repoman.getRepoDir(repoName)
-                self.infoPrinter.printInfo(">> Synchronizing repository \"%s\"..." % (repoName))
-                self._execAndSyncDownQuietly(buildServer, self.opSync, self.param.runMode, "sync-repo", repoName, directory=repoDir)
-                print("")
+                prspObj.add_task(
+                    startCoro, [self.opSync, self.param.runMode, ("sync-repo" if repoName == "gentoo" else "sync-repo-without-patch"), repoName],
+                    waitCoro,
+                    pre_func=lambda x=repoName: printer.printInfo(">> Synchronizing repository \"%s\"..." % (x)),
+                    post_func=lambda: print(""),
+                    url=pkgwh.repoman.getRepoSyncUrl(repoName),
+                    priority=(1 if repoName == "gentoo" else 0),
+                )
+        with ParallelRunSequencialPrint(syncJobNumber) as prspObj:
+            for repoName in pkgwh.repoman.getRepositoryList():
+                if repoName == "gentoo" or not pkgwh.repoman.hasPatch(repoName):
+                    continue
+                prspObj.add_task(
+                    startCoro, [self.opSync, self.param.runMode, "patch-repo", repoName],
+                    waitCoro,
+                    pre_func=lambda x=repoName: printer.printInfo(">> Patching repository \"%s\"..." % (x)),
+                    post_func=lambda: print(""),
+                )
+        if buildServer is not None:
+            for repoName in pkgwh.repoman.getRepositoryList():
+                buildServer.syncDownDirectory(pkgwh.repoman.getRepoDir(repoName), quiet=True)
 
-            # update cloud overlay db
-            self.infoPrinter.printInfo(">> Synchronizing cloud overlay database...")
-            overlayDb.update()
-            print("")
+    def _updateCloudOverlayDb(self, printer, overlayDb):
+        printer.printInfo(">> Synchronizing cloud overlay database...")
+        overlayDb.update()
+        print("")
 
-            # sync overlay directories
-            with ParallelRunSequencialPrint() as prspObj:
-                if buildServer is not None:
-                    startCoro = buildServer.asyncStartSshExec
-                    waitCoro = buildServer.asyncWaitSshExec
-                else:
-                    startCoro = FmUtil.asyncStartCmdExec
-                    waitCoro = FmUtil.asyncWaitCmdExec
-                for repo in pkgwh.layman.getOverlayList():
-                    if pkgwh.layman.getOverlayType(repo) == "static":
-                        continue
-                    prspObj.add_task(
-                        startCoro, [self.opSync, self.param.runMode, "sync-overlay", repo],
-                        waitCoro,
-                        pre_func=lambda x=repo: self.infoPrinter.printInfo(">> Synchronizing overlay \"%s\"..." % (x)),
-                        post_func=lambda: print(""),
-                    )
-            # FIXME: there should be no sync down after realtime network filesystem support is done
+    def _updateSyncOverlays(self, printer, buildServer, pkgwh, syncJobNumber, syncJobNumberPerHost):
+        # sync overlay directories
+        with ParallelRunSequencialPrint(syncJobNumber, syncJobNumberPerHost) as prspObj:
             if buildServer is not None:
-                buildServer.syncDownDirectory(FmConst.portageDataDir)
-
-            # add pre-enabled overlays
-            for repo, ourl in pkgwh.getPreEnableOverlays().items():
-                if not pkgwh.layman.isOverlayExist(repo):
-                    self.infoPrinter.printInfo(">> Installing overlay \"%s\"..." % repo)
-                    vcsType = "git"
-                    if overlayDb.hasOverlay(repo):
-                        vcsType, ourl = overlayDb.getOverlayVcsTypeAndUrl(repo)
-                    if ourl is None:
-                        raise Exception("no URL for overlay %s" % repo)
-                    if buildServer is None:
-                        FmUtil.cmdExec(self.opSync, self.param.runMode, "add-trusted-overlay", repo, vcsType, ourl)
-                    else:
-                        buildServer.sshExec(self.opSync, "add-trusted-overlay", repo, vcsType, ourl)
-                        buildServer.syncDownWildcardList([
-                            os.path.join(pkgwh.layman.getOverlayFilesDir(repo), "***"),
-                            pkgwh.layman.getOverlayDir(repo),
-                            pkgwh.layman.getOverlayCfgReposFile(repo),
-                        ], quiet=True)
-                    print("")
-
-            # add pre-enabled overlays by pre-enabled package
-            for repo, data in pkgwh.getPreEnablePackages().items():
-                ourl = data[0]
-                if not pkgwh.layman.isOverlayExist(repo):
-                    self.infoPrinter.printInfo(">> Installing overlay \"%s\"..." % repo)
-                    vcsType = "git"
-                    if overlayDb.hasOverlay(repo):
-                        vcsType, ourl = overlayDb.getOverlayVcsTypeAndUrl(repo)
-                    if ourl is None:
-                        raise Exception("no URL for overlay %s" % repo)
-                    if buildServer is None:
-                        FmUtil.cmdExec(self.opSync, self.param.runMode, "add-transient-overlay", repo, vcsType, ourl)
-                    else:
-                        buildServer.sshExec(self.opSync, self.param.runMode, "add-transient-overlay", repo, vcsType, ourl)
-                        buildServer.syncDownWildcardList([
-                            os.path.join(pkgwh.layman.getOverlayFilesDir(repo), "***"),
-                            pkgwh.layman.getOverlayDir(repo),
-                            pkgwh.layman.getOverlayCfgReposFile(repo),
-                        ], quiet=True)
-                    print("")
+                startCoro = buildServer.asyncStartSshExec
+                waitCoro = buildServer.asyncWaitSshExec
+            else:
+                startCoro = FmUtil.asyncStartCmdExec
+                waitCoro = FmUtil.asyncWaitCmdExec
+            for repo in pkgwh.layman.getOverlayList():
+                if pkgwh.layman.getOverlayType(repo) == "static":
+                    continue
+                prspObj.add_task(
+                    startCoro, [self.opSync, self.param.runMode, "sync-overlay", repo],
+                    waitCoro,
+                    pre_func=lambda x=repo: printer.printInfo(">> Synchronizing overlay \"%s\"..." % (x)),
+                    post_func=lambda: print(""),
+                    url=pkgwh.layman.getOverlayVcsTypeAndUrl(repo)[1],
+                )
+        # FIXME: there should be no sync down after realtime network filesystem support is done
+        if buildServer is not None:
+            buildServer.syncDownDirectory(FmConst.portageDataDir)
+
+    def _updatePreEnable(self, printer, buildServer, pkgwh, overlayDb):
+        # add pre-enabled overlays
+        for repo, ourl in pkgwh.getPreEnableOverlays().items():
+            if not pkgwh.layman.isOverlayExist(repo):
+                printer.printInfo(">> Installing overlay \"%s\"..." % repo)
+                vcsType = "git"
+                if overlayDb.hasOverlay(repo):
+                    vcsType, ourl = overlayDb.getOverlayVcsTypeAndUrl(repo)
+                if ourl is None:
+                    raise Exception("no URL for overlay %s" % repo)
+                if buildServer is None:
+                    self._cmdExec(printer, self.opSync, self.param.runMode, "add-trusted-overlay", repo, vcsType, ourl)
+                else:
+                    buildServer.sshExec(self.opSync, "add-trusted-overlay", repo, vcsType, ourl)
+                    buildServer.syncDownWildcardList([
+                        os.path.join(pkgwh.layman.getOverlayFilesDir(repo), "***"),
+                        pkgwh.layman.getOverlayDir(repo),
+                        pkgwh.layman.getOverlayCfgReposFile(repo),
+                    ], quiet=True)
+                print("")
 
-            # add pre-enabled packages
-            for repo, data in pkgwh.getPreEnablePackages().items():
-                tlist = [x for x in data[1] if not pkgwh.layman.isOverlayPackageEnabled(repo, x)]
-                if tlist != []:
-                    self.infoPrinter.printInfo(">> Enabling packages in overlay \"%s\"..." % repo)
-                    self._exec(buildServer, self.opSync, self.param.runMode, "enable-overlay-package", repo, *tlist)
-                    print("")
-            if buildServer is not None:
-                buildServer.syncDownDirectory(os.path.join(FmConst.portageDataDir, "overlay-*"), quiet=True)
+        # add pre-enabled overlays by pre-enabled package
+        for repo, data in pkgwh.getPreEnablePackages().items():
+            ourl = data[0]
+            if not pkgwh.layman.isOverlayExist(repo):
+                printer.printInfo(">> Installing overlay \"%s\"..." % repo)
+                vcsType = "git"
+                if overlayDb.hasOverlay(repo):
+                    vcsType, ourl = overlayDb.getOverlayVcsTypeAndUrl(repo)
+                if ourl is None:
+                    raise Exception("no URL for overlay %s" % repo)
+                if buildServer is None:
+                    self._cmdExec(printer, self.opSync, self.param.runMode, "add-transient-overlay", repo, vcsType, ourl)
+                else:
+                    buildServer.sshExec(self.opSync, self.param.runMode, "add-transient-overlay", repo, vcsType, ourl)
+                    buildServer.syncDownWildcardList([
+                        os.path.join(pkgwh.layman.getOverlayFilesDir(repo), "***"),
+                        pkgwh.layman.getOverlayDir(repo),
+                        pkgwh.layman.getOverlayCfgReposFile(repo),
+                    ], quiet=True)
+                print("")
 
-            # refresh package related stuff
-            self._execAndSyncDownQuietly(buildServer, self.opSync, self.param.runMode, "refresh-package-related-stuff", directory=FmConst.portageCfgDir)
+        # add pre-enabled packages
+        for repo, data in pkgwh.getPreEnablePackages().items():
+            tlist = [x for x in data[1] if not pkgwh.layman.isOverlayPackageEnabled(repo, x)]
+            if tlist != []:
+                printer.printInfo(">> Enabling packages in overlay \"%s\"..." % repo)
+                self._exec(printer, buildServer, self.opSync, self.param.runMode, "enable-overlay-package", repo, *tlist)
+                print("")
+        if buildServer is not None:
+            buildServer.syncDownDirectory(os.path.join(FmConst.portageDataDir, "overlay-*"), quiet=True)
 
-            # eliminate "Performing Global Updates"
-            self._execAndSyncDownQuietly(buildServer, self.opSync, self.param.runMode, "touch-portage-tree", directory=FmConst.portageDbDir)     # FIXME
+    def _updateInstallKernel(self, printer, buildServer, layout, bbkiObj):
+        resultFile = os.path.join(self.param.tmpDir, "result.txt")
+        kernelCfgRules = json.dumps(self.param.machineInfoGetter.hwInfo().kernelCfgRules)
 
-        # do fetch and build
-        if True:
-            resultFile = os.path.join(self.param.tmpDir, "result.txt")
-            kernelCfgRules = json.dumps(self.param.machineInfoGetter.hwInfo().kernelCfgRules)
-
-            # install kernel, initramfs and bootloader
-            with BootDirWriter(layout):
-                self.infoPrinter.printInfo(">> Installing %s-%s..." % (bbkiObj.get_kernel_atom().fullname, bbkiObj.get_kernel_atom().ver))
-                if True:
-                    self._exec(buildServer, self.opInstallKernel, self.param.runMode, kernelCfgRules, resultFile)
-                    # kernelBuilt, postfix = self._parseKernelBuildResult(self._readResultFile(buildServer, resultFile))
-                    print("")
+        # install kernel, initramfs and boot-loader are done by update-bootloader phase
+        with BootDirWriter(layout):
+            printer.printInfo(">> Installing %s-%s..." % (bbkiObj.get_kernel_atom().fullname, bbkiObj.get_kernel_atom().ver))
+            if True:
+                self._exec(printer, buildServer, self.opInstallKernel, self.param.runMode, kernelCfgRules, resultFile)
+                # kernelBuilt, postfix = self._parseKernelBuildResult(self._readResultFile(buildServer, resultFile))
+                print("")
 
-                    if buildServer is not None:
-                        self.infoPrinter.printInfo(">> Synchronizing down /boot, /lib/modules and /lib/firmware...")
-                        buildServer.syncDownKernel()
-                        print("")
-
-                self.infoPrinter.printInfo(">> Creating initramfs...")
-                if True:
-                    if self.param.runMode in ["normal", "setup"]:
-                        bbkiObj.installInitramfs()
-                    else:
-                        print("WARNING: Running in \"%s\" mode, do NOT create initramfs!!!" % (self.param.runMode))
+                if buildServer is not None:
+                    printer.printInfo(">> Synchronizing down /boot, /lib/modules and /lib/firmware...")
+                    buildServer.syncDownKernel()
                     print("")
 
-                self.infoPrinter.printInfo(">> Updating boot-loader...")
+    def _updateBootloader(self, printer, layout, bbkiObj):
+        with BootDirWriter(layout):
+            printer.printInfo(">> Creating initramfs...")
+            if True:
                 if self.param.runMode in ["normal", "setup"]:
-                    bbkiObj.updateBootloader()
+                    bbkiObj.installInitramfs()
                 else:
-                    print("WARNING: Running in \"%s\" mode, do NOT maniplate boot-loader!!!" % (self.param.runMode))
+                    print("WARNING: Running in \"%s\" mode, do NOT create initramfs!!!" % (self.param.runMode))
                 print("")
 
-            # synchronize boot partitions
-            if layout.name in ["efi-btrfs", "efi-bcache-btrfs", "efi-bcachefs"]:
-                dstList = layout.get_pending_esp_list()
-                if len(dstList) > 0:
-                    with self.infoPrinter.printInfoAndIndent(">> Synchronizing boot partitions..."):
-                        for dst in dstList:
-                            self.infoPrinter.printInfo("        - %s to %s..." % (layout.get_esp(), dst))
-                            layout.sync_esp(dst)
-                    print("")
-
-            # emerge @world
-            self.infoPrinter.printInfo(">> Updating @world...")
-            if buildServer is not None:
-                try:
-                    buildServer.sshExec(self.opEmergeWorld)
-                finally:
-                    self.infoPrinter.printInfo(">> Synchronizing down system files...")
-                    buildServer.syncDownSystem()
-                    print("")
+            printer.printInfo(">> Updating boot-loader...")
+            if self.param.runMode in ["normal", "setup"]:
+                bbkiObj.updateBootloader()
             else:
-                FmUtil.cmdExec(self.opEmergeWorld)
+                print("WARNING: Running in \"%s\" mode, do NOT maniplate boot-loader!!!" % (self.param.runMode))
+            print("")
 
-            # re-emerge all "-9999" packages
-            self.infoPrinter.printInfo(">> Updating all \"-9999\" packages...")
-            if buildServer is not None:
-                try:
-                    buildServer.sshExec(self.opEmerge9999)
-                finally:
-                    self.infoPrinter.printInfo(">> Synchronizing down system files...")
-                    buildServer.syncDownSystem()
-                    print("")
-            else:
-                FmUtil.cmdExec(self.opEmerge9999)
+    def _updateSyncBootPartitions(self, printer, layout):
+        # synchronize boot partitions
+        if layout.name in ["efi-btrfs", "efi-bcache-btrfs", "efi-bcachefs"]:
+            dstList = layout.get_pending_esp_list()
+            if len(dstList) > 0:
+                with printer.printInfoAndIndent(">> Synchronizing boot partitions..."):
+                    for dst in dstList:
+                        printer.printInfo("        - %s to %s..." % (layout.get_esp(), dst))
+                        layout.sync_esp(dst)
+                print("")
 
-        # end remote build
+    def _updateEmerge(self, printer, buildServer, title, opEmerge):
+        printer.printInfo(title)
         if buildServer is not None:
-            buildServer.dispose()
+            try:
+                buildServer.sshExec(opEmerge)
+            finally:
+                printer.printInfo(">> Synchronizing down system files...")
+                buildServer.syncDownSystem()
+                print("")
+        else:
+            self._cmdExec(printer, opEmerge)
+
+    def _printTimeline(self, runner):
+        # one row per phase, bar shows when the phase was running
+        width = 50
+        totalTime = runner.getTotalTime()
+        with self.infoPrinter.printInfoAndIndent(">> Timeline (%.1fs in total):" % (totalTime)):
+            for name, startTime, endTime in runner.getTimeline():
+                if totalTime > 0:
+                    a = int(startTime / totalTime * width)
+                    b = max(int(endTime / totalTime * width), a + 1)
+                else:
+                    a, b = 0, width
+                bar = " " * a + "#" * (b - a) + " " * (width - b)
+                self.infoPrinter.printInfo("%-20s |%s| %7.1fs - %7.1fs" % (name, bar, startTime, endTime))
+        print("")
 
     def stablize(self):
         layout = strict_hdds.get_storage_layout()
@@ -292,12 +376,30 @@ class FmSysUpdater:
                         layout.sync_esp(dst)
                 print("")
 
-    def _exec(self, buildServer, *args, base64=False):
+    def _exec(self, printer, buildServer, *args, base64=False):
         if buildServer is None:
-            FmUtil.cmdExec(*args)
+            self._cmdExec(printer, *args)
         else:
             buildServer.sshExec(*args, base64=base64)
 
+    def _cmdExec(self, printer, cmd, *kargs):
+        # command has the terminal only when the phase is at the output front, or else its output is recorded and shown later
+        # commands see a pipe as stdout then, so they should not write control sequences, see PrintLoadAvgThread
+        if printer.isLive():
+            FmUtil.cmdExec(cmd, *kargs)
+            return
+
+        proc = subprocess.Popen([cmd] + list(kargs), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        while True:
+            buf = proc.stdout.read1(65536)
+            if buf == b'':
+                break
+            sys.stdout.buffer.write(buf)
+            sys.stdout.flush()
+        proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, [cmd] + list(kargs))
+
     def _readResultFile(self, buildServer, resultFile):
         if buildServer is None:
             with open(resultFile, "r", encoding="iso8859-1") as f:
@@ -305,9 +407,9 @@ class FmSysUpdater:
         else:
             return buildServer.getFile(resultFile).decode("iso8859-1")
 
-    def _execAndSyncDownQuietly(self, buildServer, *args, directory=None):
+    def _execAndSyncDownQuietly(self, printer, buildServer, *args, directory=None):
         if buildServer is None:
-            FmUtil.cmdExec(*args)
+            self._cmdExec(printer, *args)
         else:
             buildServer.sshExec(*args)
             buildServer.syncDownDirectory(directory, quiet=True)
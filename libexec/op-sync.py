@@ -30,6 +30,18 @@ if item == "sync-repo":
     repoman.syncRepository(repoName)
     sys.exit(0)
 
+if item == "sync-repo-without-patch":
+    repoName = sys.argv[3]
+    repoman = EbuildRepositories()
+    repoman.syncRepository(repoName, bPatch=False)
+    sys.exit(0)
+
+if item == "patch-repo":
+    repoName = sys.argv[3]
+    repoman = EbuildRepositories()
+    repoman.patchRepository(repoName)
+    sys.exit(0)
+
 if item == "sync-overlay":
     overlayName = sys.argv[3]
     EbuildOverlays().syncOverlay(overlayName)
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# measure constructing CloudOverlayDb and resolving every overlay in data/pre-enable
+# "cold" is parsing the downloaded databases when there is no cache file, "warm" is loading them from the cache files
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from fm_param import FmConst
+from helper_pkg_warehouse import CloudOverlayDb
+from helper_pkg_warehouse import PkgPreEnableIndex
+
+
+def runOnce(nameList):
+    t1 = time.perf_counter()
+    obj = CloudOverlayDb()
+    t2 = time.perf_counter()
+    count = 0
+    for name in nameList:
+        if obj.hasOverlay(name):
+            obj.getOverlayVcsTypeAndUrl(name)
+            count += 1
+    t3 = time.perf_counter()
+    return (t2 - t1, t3 - t2, count)
+
+
+if len(sys.argv) > 2:
+    print("syntax: benchmark-cloud-overlay-db [overlay-db-directory]")
+    sys.exit(1)
+
+if len(sys.argv) == 2:
+    FmConst.cloudOverlayDbDir = sys.argv[1]
+selfDir = os.path.dirname(os.path.abspath(__file__))
+count = 10
+
+with tempfile.TemporaryDirectory() as tmpDir:
+    FmConst.cloudOverlayDbCacheDir = os.path.join(tmpDir, "cloud-overlay-db")
+
+    if not CloudOverlayDb().isUpdateComplete():
+        print("overlay database in \"%s\" is not complete, it is downloaded by \"sysman update\"" % (FmConst.cloudOverlayDbDir))
+        sys.exit(1)
+
+    preEnable = PkgPreEnableIndex(os.path.join(selfDir, "..", "data", "pre-enable"), os.path.join(tmpDir, "pre-enable-index.cache"))
+    nameList = sorted(set(preEnable.getOverlayList()) | set(preEnable.getPackageOverlayList()))
+
+    for title, bCold in [("cold", True), ("warm", False)]:
+        constructTime = 0
+        resolveTime = 0
+        for i in range(0, count):
+            if bCold:
+                shutil.rmtree(FmConst.cloudOverlayDbCacheDir, ignore_errors=True)
+            t1, t2, found = runOnce(nameList)
+            constructTime += t1
+            resolveTime += t2
+        print("%s: construct %.2fms, resolve %d/%d overlays %.3fms" % (title, constructTime * 1000 / count, found, len(nameList), resolveTime * 1000 / count))
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# compare serial and parallel verification of PkgFileVerifier on a synthetic /var/db/pkg
+# files and CONTENTS_2 files are generated in a temporary directory, result is printed to stdout
+# page cache is dropped before each run when we are root, or else the files are mostly read from page cache
+
+import os
+import sys
+import time
+import random
+import hashlib
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from helper_pkg_verifier import PkgFileVerifier
+
+
+class NoExtraFilesEvaluator:
+
+    def getWildcards(self, pkgNameVer):
+        return []
+
+
+def generate(tmpDir, pkgNumber, fileNumber, fileSize):
+    pkgDbDir = os.path.join(tmpDir, "pkg")
+    rootDir = os.path.join(tmpDir, "root")
+    pkgList = []
+    for i in range(0, pkgNumber):
+        pkgNameVer = "bench-cat/pkg%d-1.0" % (i)
+        dataDir = os.path.join(rootDir, "usr", "share", "pkg%d" % (i))
+        os.makedirs(os.path.join(pkgDbDir, pkgNameVer))
+        os.makedirs(dataDir)
+        with open(os.path.join(pkgDbDir, pkgNameVer, "CONTENTS_2"), "w") as f:
+            s = os.stat(dataDir)
+            f.write("dir %s %o %d %d\n" % (dataDir, s.st_mode & 0o7777, s.st_uid, s.st_gid))
+            for j in range(0, fileNumber):
+                fullfn = os.path.join(dataDir, "file%d" % (j))
+                buf = random.randbytes(random.randint(fileSize // 2, fileSize * 3 // 2))
+                with open(fullfn, "wb") as f2:
+                    f2.write(buf)
+                s = os.stat(fullfn)
+                f.write("obj %s %s %d %o %d %d\n" % (fullfn, hashlib.md5(buf).hexdigest(), int(s.st_mtime), s.st_mode, s.st_uid, s.st_gid))
+                if j % 10 == 0:
+                    linkfn = os.path.join(dataDir, "link%d" % (j))
+                    os.symlink("file%d" % (j), linkfn)
+                    f.write("sym %s -> %s %d %d %d\n" % (linkfn, "file%d" % (j), int(s.st_mtime), s.st_uid, s.st_gid))
+        pkgList.append(pkgNameVer)
+    return (pkgDbDir, pkgList)
+
+
+def dropCaches():
+    if os.getuid() != 0:
+        return
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3")
+
+
+def runSerial(pkgDbDir, pkgList):
+    # packages are not added, so they are verified one by one in the calling thread
+    errList = []
+    with PkgFileVerifier(pkgDbDir, NoExtraFilesEvaluator(), jobNumber=1) as verifier:
+        for pkgNameVer in pkgList:
+            errList += verifier.getResult(pkgNameVer)
+    return errList
+
+
+def runParallel(pkgDbDir, pkgList, jobNumber):
+    # same usage as sys_checker, all packages are added first, results are fetched in order
+    errList = []
+    with PkgFileVerifier(pkgDbDir, NoExtraFilesEvaluator(), jobNumber=jobNumber) as verifier:
+        for pkgNameVer in pkgList:
+            verifier.addPackage(pkgNameVer)
+        for pkgNameVer in pkgList:
+            errList += verifier.getResult(pkgNameVer)
+    return errList
+
+
+if len(sys.argv) > 5:
+    print("syntax: benchmark-pkg-verify [package-number] [files-per-package] [average-file-size-in-KB] [job-number]")
+    sys.exit(1)
+
+pkgNumber = int(sys.argv[1]) if len(sys.argv) >= 2 else 200
+fileNumber = int(sys.argv[2]) if len(sys.argv) >= 3 else 50
+fileSize = int(sys.argv[3]) * 1024 if len(sys.argv) >= 4 else 64 * 1024
+jobNumber = int(sys.argv[4]) if len(sys.argv) >= 5 else os.cpu_count()
+
+with tempfile.TemporaryDirectory() as tmpDir:
+    pkgDbDir, pkgList = generate(tmpDir, pkgNumber, fileNumber, fileSize)
+    totalSize = sum(os.path.getsize(os.path.join(dirpath, fn)) for dirpath, dirnames, filenames in os.walk(os.path.join(tmpDir, "root")) for fn in filenames) / 1024 / 1024
+    print("%d packages, %d files, %.1fMB, page cache is %s" % (pkgNumber, pkgNumber * fileNumber, totalSize, "dropped" if os.getuid() == 0 else "not dropped (not root)"))
+
+    result = None
+    for title, func, args in [("serial", runSerial, []), ("parallel (%d jobs)" % (jobNumber), runParallel, [jobNumber])]:
+        dropCaches()
+        t = time.perf_counter()
+        errList = func(pkgDbDir, pkgList, *args)
+        t = time.perf_counter() - t
+        print("%s: %.2fs, %.1fMB/s, %d errors" % (title, t, totalSize / t, len(errList)))
+        if result is not None and errList != result:
+            print("error: results of serial and parallel verification differ")
+            sys.exit(1)
+        result = errList
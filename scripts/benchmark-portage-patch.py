@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# measure patching of the gentoo repository after a re-sync which brings no upstream change
+# the eclass, profiles and patched package directories of an unpatched gentoo repository are copied to a temporary directory before each run, as rsync does
+# "nocache" is patching without cache, "cold" is patching with an empty cache, "warm" is patching with the cache filled by the last run
+# "ebuild manifest" is run for the patched packages, so this script must be run on a gentoo system
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from fm_util import FmUtil
+
+
+def resync(upstreamDir, repoDir, pkgDirList):
+    if os.path.exists(repoDir):
+        shutil.rmtree(repoDir)
+    for relDir in ["metadata", "eclass", "profiles"] + pkgDirList:
+        if os.path.exists(os.path.join(upstreamDir, relDir)):
+            shutil.copytree(os.path.join(upstreamDir, relDir), os.path.join(repoDir, relDir), symlinks=True,
+                            ignore=shutil.ignore_patterns("md5-cache"))
+
+
+def patch(repoDir, patchDirList, cacheDir):
+    t = time.perf_counter()
+    for patchTypeName, patchDir in patchDirList:
+        FmUtil.portagePatchRepository("repo-gentoo", repoDir, patchTypeName, patchDir, os.cpu_count(), cacheDir)
+    return time.perf_counter() - t
+
+
+if len(sys.argv) != 2:
+    print("syntax: benchmark-portage-patch <unpatched-gentoo-repository-directory>")
+    sys.exit(1)
+
+upstreamDir = sys.argv[1]
+dataDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+patchDirList = [
+    ("N-patch", os.path.join(dataDir, "pkgwh-n-patch", "repo-gentoo")),
+    ("S-patch", os.path.join(dataDir, "pkgwh-s-patch", "repo-gentoo")),
+]
+
+pkgDirList = set()
+for patchTypeName, patchDir in patchDirList:
+    for categoryDir in os.listdir(patchDir):
+        if categoryDir in ["README", "eclass", "profiles"]:
+            continue
+        for ebuildDir in os.listdir(os.path.join(patchDir, categoryDir)):
+            pkgDirList.add(os.path.join(categoryDir, ebuildDir))
+pkgDirList = sorted(pkgDirList)
+
+with tempfile.TemporaryDirectory() as tmpDir:
+    repoDir = os.path.join(tmpDir, "repo-gentoo")
+    cacheDir = os.path.join(tmpDir, "portage-patch")
+
+    for title, curCacheDir in [("nocache", None), ("cold", cacheDir), ("warm", cacheDir)]:
+        resync(upstreamDir, repoDir, pkgDirList)
+        with open(os.devnull, "w") as f:
+            realStdout = sys.stdout
+            sys.stdout = f                  # discard messages of the patch scripts
+            try:
+                t = patch(repoDir, patchDirList, curCacheDir)
+            finally:
+                sys.stdout = realStdout
+        print("%s: %d packages, %.2fs" % (title, len(pkgDirList), t))
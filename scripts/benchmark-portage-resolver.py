@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# compare resolving a world file by FmUtil.portageIsPkgInstallable() (one porttree query per atom) and by PortageResolverSession
+# a world file of 300 atoms is generated from the packages of the repositories if no world file is specified
+# generated atoms are package names, versioned atoms and slotted atoms, like a real world file
+# portage must be configured on this system, results of the two are compared
+
+import os
+import sys
+import time
+import random
+import portage
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from fm_util import FmUtil
+from fm_util import PortageResolverSession
+
+
+def generate(atomNumber):
+    porttree = portage.db[portage.root]["porttree"]
+    cpList = porttree.dbapi.cp_all()
+    random.shuffle(cpList)
+
+    ret = []
+    for cp in cpList:
+        if len(ret) >= atomNumber:
+            break
+        cpvList = porttree.dbapi.match(cp)
+        if len(cpvList) == 0:
+            continue
+        cpv = random.choice(cpvList)
+        kind = random.randint(0, 9)
+        if kind < 6:
+            ret.append(cp)
+        elif kind < 8:
+            ret.append(">=" + cpv)
+        else:
+            ret.append("%s:%s" % (cp, porttree.dbapi.aux_get(cpv, ["SLOT"])[0].split("/")[0]))
+    return ret
+
+
+if len(sys.argv) > 2:
+    print("syntax: benchmark-portage-resolver [world-file]")
+    sys.exit(1)
+
+if len(sys.argv) >= 2:
+    with open(sys.argv[1], "r") as f:
+        atomList = [x.strip() for x in f.read().split("\n") if x.strip() != ""]
+else:
+    atomList = generate(300)
+print("%d atoms" % (len(atomList)))
+
+# porttree has its own caches, so each measurement runs twice, the second one is the warm run
+t = time.perf_counter()
+result1 = [FmUtil.portageIsPkgInstallable(x) for x in atomList]
+t = time.perf_counter() - t
+t2 = time.perf_counter()
+[FmUtil.portageIsPkgInstallable(x) for x in atomList]
+t2 = time.perf_counter() - t2
+print("portageIsPkgInstallable: %.3fs, %.3fs when warm" % (t, t2))
+
+resolver = PortageResolverSession()
+t = time.perf_counter()
+matchDict = resolver.matchBatch(atomList)
+result2 = [len(matchDict[x]) > 0 for x in atomList]
+t = time.perf_counter() - t
+t2 = time.perf_counter()
+resolver.matchBatch(atomList)
+t2 = time.perf_counter() - t2
+print("PortageResolverSession: %.3fs, %.3fs when warm" % (t, t2))
+
+if result1 != result2:
+    for i in range(0, len(atomList)):
+        if result1[i] != result2[i]:
+            print("error: results differ, first different atom is %s" % (atomList[i]))
+            break
+    sys.exit(1)
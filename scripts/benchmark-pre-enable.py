@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# measure the pre-enable phase of "sysman update": getPreEnableOverlays() is called once and getPreEnablePackages() twice
+# "parse" is parsing all the definition files in every call, which is what was done before PkgPreEnableIndex
+# "cold" is building the index when there is no cache file, "warm" is loading the index from the cache file
+
+import os
+import sys
+import time
+import tempfile
+import configparser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from helper_pkg_warehouse import PkgPreEnableIndex
+
+
+def parseAll(modDir):
+    for fn in sorted(os.listdir(modDir)):
+        if fn.endswith(".new_overlay") or fn.endswith(".new_package"):
+            cfg = configparser.ConfigParser()
+            cfg.read(os.path.join(modDir, fn))
+
+
+def runPhase(modDir, cacheFile):
+    obj = PkgPreEnableIndex(modDir, cacheFile)
+    obj.getOverlayList()
+    for i in range(0, 2):
+        for name in obj.getPackageOverlayList():
+            obj.getPackageList(name)
+
+
+if len(sys.argv) > 2:
+    print("syntax: benchmark-pre-enable [pre-enable-directory]")
+    sys.exit(1)
+
+modDir = sys.argv[1] if len(sys.argv) == 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "pre-enable")
+count = 20
+
+with tempfile.TemporaryDirectory() as tmpDir:
+    cacheFile = os.path.join(tmpDir, "pre-enable-index.cache")
+
+    t = time.perf_counter()
+    for i in range(0, count):
+        for j in range(0, 3):
+            parseAll(modDir)
+    print("parse: %.2fms" % ((time.perf_counter() - t) * 1000 / count))
+
+    t = time.perf_counter()
+    for i in range(0, count):
+        if os.path.exists(cacheFile):
+            os.unlink(cacheFile)
+        runPhase(modDir, cacheFile)
+    print("cold:  %.2fms" % ((time.perf_counter() - t) * 1000 / count))
+
+    t = time.perf_counter()
+    for i in range(0, count):
+        runPhase(modDir, cacheFile)
+    print("warm:  %.2fms" % ((time.perf_counter() - t) * 1000 / count))
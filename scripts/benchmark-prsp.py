@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# measure throughput of ParallelRunSequencialPrint, every task writes lines of text to stdout
+# stdout is redirected to /dev/null when running, result is printed to stderr
+# "ordered" is the default mode, most of the output of the tasks behind the front one is spilled to temporary files, "live" is the live mode
+
+import os
+import sys
+import time
+import asyncio
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from fm_util import FmUtil
+from fm_util import ParallelRunSequencialPrint
+
+
+async def startTask(size, loop=None):
+    # "loop" parameter of asyncio.create_subprocess_exec() is removed in newer python versions
+    proc = await asyncio.create_subprocess_exec("sh", "-c", "yes 'abcdefghijklmnopqrstuvwxyz0123456789 progress line of a sync task' | head -c %d" % (size),
+                                                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    return (proc, proc.stdout)
+
+
+if len(sys.argv) > 3:
+    print("syntax: benchmark-prsp [task-number] [task-output-size-in-MB]")
+    sys.exit(1)
+
+taskNumber = int(sys.argv[1]) if len(sys.argv) >= 2 else 4
+taskSize = int(sys.argv[2]) * 1024 * 1024 if len(sys.argv) >= 3 else 100 * 1024 * 1024
+
+with open(os.devnull, "w") as f:
+    realStdout = sys.stdout
+    for title, bLive in [("ordered", False), ("live", True)]:
+        sys.stdout = f
+        try:
+            t = time.perf_counter()
+            with ParallelRunSequencialPrint(live=bLive) as prspObj:
+                for i in range(0, taskNumber):
+                    prspObj.add_task(startTask, [taskSize], FmUtil.asyncWaitCmdExec)
+            t = time.perf_counter() - t
+        finally:
+            sys.stdout = realStdout
+        totalSize = taskNumber * taskSize / 1024 / 1024
+        print("%s: %d tasks, %dMB in %.2fs, %.1fMB/s" % (title, taskNumber, totalSize, t, totalSize / t), file=sys.stderr)
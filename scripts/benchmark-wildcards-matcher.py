@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# compare strict_fsh.wildcards_match() and WildcardsMatcher on synthetic paths, 1M paths by default
+# wildcards are the root filesystem wildcards of this system, results of the two are compared
+# paths are not created, so directory only rules ("dir/") only match existing directories of this system
+
+import os
+import sys
+import time
+import random
+import strict_fsh
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from fm_util import WildcardsMatcher
+
+
+def generate(pathNumber):
+    topList = ["/boot", "/etc", "/usr/bin", "/usr/lib", "/usr/lib64", "/usr/share", "/usr/include", "/usr/src", "/opt",
+               "/var/cache", "/var/lib", "/var/log", "/var/tmp", "/home/user", "/root", "/tmp", "/run", "/lost+found"]
+    nameList = ["lib", "share", "doc", "python3", "site-packages", "__pycache__", "modules", "firmware", "locale", "man", "include", ".cache", "data"]
+    extList = ["", ".so", ".py", ".pyc", ".conf", ".h", ".txt", ".gz", ".o", ".keep", ".log"]
+
+    ret = []
+    for i in range(0, pathNumber):
+        path = random.choice(topList)
+        for j in range(0, random.randint(0, 5)):
+            path = os.path.join(path, random.choice(nameList))
+        path = os.path.join(path, "file%d%s" % (random.randint(0, 999), random.choice(extList)))
+        ret.append(path)
+    return ret
+
+
+if len(sys.argv) > 2:
+    print("syntax: benchmark-wildcards-matcher [path-number]")
+    sys.exit(1)
+
+pathNumber = int(sys.argv[1]) if len(sys.argv) >= 2 else 1000000
+
+rootFs = strict_fsh.RootFs()
+wildcards = rootFs.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_SYSTEM)
+wildcards = strict_fsh.deduct_wildcards(wildcards, rootFs.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_LAYOUT))
+wildcards = strict_fsh.deduct_wildcards(wildcards, rootFs.get_wildcards(wildcards_flag=strict_fsh.WILDCARDS_SYSTEM_BOOT))
+wildcards = strict_fsh.merge_wildcards(wildcards, ["- /usr/src/", "+ *.pyc"])          # a directory only rule and an unanchored rule
+pathList = generate(pathNumber)
+print("%d wildcards, %d paths" % (len(wildcards), len(pathList)))
+
+t = time.perf_counter()
+matcher = WildcardsMatcher(wildcards)
+t = time.perf_counter() - t
+print("compile: %.3fs" % (t))
+
+resultList = []
+for title, func in [("strict_fsh.wildcards_match", lambda x: strict_fsh.wildcards_match(x, wildcards)), ("WildcardsMatcher", matcher.match)]:
+    t = time.perf_counter()
+    result = [func(x) for x in pathList]
+    t = time.perf_counter() - t
+    print("%s: %.2fs, %.0f paths/s, %d matched" % (title, t, len(pathList) / t, result.count(True)))
+    resultList.append(result)
+
+if resultList[0] != resultList[1]:
+    for i in range(0, len(pathList)):
+        if resultList[0][i] != resultList[1][i]:
+            print("error: results differ, first different path is %s" % (pathList[i]))
+            break
+    sys.exit(1)
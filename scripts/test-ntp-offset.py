@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# test FmUtil.queryNtpOffset() against local NTP stand-ins, no network access is needed
+# every stand-in listens on its own loopback address (127.0.0.N) with the same UDP port
+# a stand-in answers with a given offset after a given delay, or never answers, or answers garbage
+
+import os
+import sys
+import time
+import socket
+import struct
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from fm_util import FmUtil
+
+
+class NtpStandIn(threading.Thread):
+
+    NTP_DELTA = 2208988800          # seconds from 1900-01-01 to 1970-01-01
+
+    def __init__(self, addr, port, offset=0, delay=0, bDrop=False, bGarbage=False):
+        super().__init__(daemon=True)
+        self._offset = offset
+        self._delay = delay
+        self._bDrop = bDrop
+        self._bGarbage = bGarbage
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((addr, port))
+        self.port = self._sock.getsockname()[1]
+        self.start()
+
+    def close(self):
+        self._sock.close()
+
+    def run(self):
+        while True:
+            try:
+                data, peer = self._sock.recvfrom(1024)
+            except OSError:
+                return                  # socket closed
+            if self._bDrop:
+                continue
+            recvTime = self._toNtpTime(time.time() + self._offset)
+            threading.Timer(self._delay, self._answer, [data, peer, recvTime]).start()
+
+    def _answer(self, data, peer, recvTime):
+        # the delay is server processing time, which is not counted in the round trip, so it does not change the offset
+        if self._bGarbage:
+            buf = b"garbage"
+        else:
+            txTime = self._toNtpTime(time.time() + self._offset)
+            buf = struct.pack("!B B B b 11I",
+                              (0 << 6 | 3 << 3 | 4), 2, 4, -20,       # leap, version 3, mode server, stratum, poll, precision
+                              0, 0, 0,                                # root delay, root dispersion, reference id
+                              *recvTime,                              # reference timestamp
+                              *struct.unpack("!2I", data[40:48]),     # originate timestamp is transmit timestamp of the request
+                              *recvTime, *txTime)
+        try:
+            self._sock.sendto(buf, peer)
+        except OSError:
+            pass
+
+    def _toNtpTime(self, t):
+        t += self.NTP_DELTA
+        return (int(t), int((t - int(t)) * 2 ** 32))
+
+
+def runCase(title, serverParamList, expected, maxTime, **kwargs):
+    # expected is the offset, or None if an exception is expected
+    serverList = []
+    port = 0
+    try:
+        for i, param in enumerate(serverParamList):
+            serverList.append(NtpStandIn("127.0.0.%d" % (i + 1), port, **param))
+            port = serverList[0].port
+        t = time.monotonic()
+        try:
+            ret = FmUtil.queryNtpOffset(["127.0.0.%d" % (i + 1) for i in range(0, len(serverList))], port=port, **kwargs)
+            err = None
+        except Exception as e:
+            ret = None
+            err = e
+        t = time.monotonic() - t
+    finally:
+        for s in serverList:
+            s.close()
+
+    bOk = t <= maxTime
+    if expected is None:
+        bOk = bOk and err is not None
+        result = "exception \"%s\"" % (err)
+    else:
+        bOk = bOk and ret is not None and abs(ret - expected) < 0.05
+        result = "offset %s" % ("%.3f" % (ret) if ret is not None else "exception \"%s\"" % (err))
+    print("%s: %s, %s in %.2fs" % ("ok" if bOk else "FAILED", title, result, t))
+    return bOk
+
+
+bOk = True
+bOk &= runCase("median of the first 3 answers",
+               [dict(offset=10), dict(offset=11, delay=0.05), dict(offset=30, delay=0.1), dict(offset=100, delay=1.0)],
+               11, 0.5)
+bOk &= runCase("slow servers are abandoned after grace time",
+               [dict(offset=3), dict(offset=4, delay=0.2), dict(offset=100, delay=1.5), dict(offset=100, delay=1.5)],
+               3.5, 1.0, graceTime=0.5)
+bOk &= runCase("partial answers, others filtered",
+               [dict(offset=-5), dict(bDrop=True), dict(bDrop=True), dict(bDrop=True)],
+               -5, 1.0, graceTime=0.5)
+bOk &= runCase("garbage answers are ignored",
+               [dict(bGarbage=True), dict(offset=7, delay=0.05), dict(bGarbage=True), dict(offset=8, delay=0.1)],
+               7.5, 1.0, graceTime=0.5)
+bOk &= runCase("no answer, exception after timeout",
+               [dict(bDrop=True), dict(bDrop=True), dict(bDrop=True), dict(bDrop=True)],
+               None, 1.5, timeout=1)
+bOk &= runCase("only garbage answers, exception of the client is raised",
+               [dict(bGarbage=True), dict(bGarbage=True), dict(bGarbage=True), dict(bGarbage=True)],
+               None, 1.5, timeout=1)
+sys.exit(0 if bOk else 1)
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# test FmSysUpdater._updateSyncRepositories() against local servers, no network access is needed
+# gentoo repository is served by a local rsync daemon, other repositories are served by a local git daemon
+# this script is also the op-sync stand-in, patching is simulated: patching gentoo takes some time,
+# patching other repositories records whether gentoo repository is completely synchronized and patched at that time
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import tempfile
+import subprocess
+import robust_layer.simple_git
+import robust_layer.rsync
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from fm_util import FmUtil
+from fm_util import InfoPrinter
+from sys_updater import FmSysUpdater
+
+
+class RepoManStandIn:
+
+    def __init__(self, cfg):
+        self._cfg = cfg
+
+    def getRepositoryList(self):
+        return list(self._cfg["url"].keys())
+
+    def getRepoDir(self, repoName):
+        return self._cfg["dir"][repoName]
+
+    def getRepoSyncUrl(self, repoName):
+        return self._cfg["url"][repoName]
+
+    def hasPatch(self, repoName):
+        return True
+
+
+class PkgWarehouseStandIn:
+
+    def __init__(self, cfg):
+        self.repoman = RepoManStandIn(cfg)
+
+
+class ParamStandIn:
+
+    def __init__(self):
+        self.runMode = "normal"
+        self.infoPrinter = InfoPrinter()
+
+
+def getTree(dirPath):
+    # returns dict<relative-path, md5>, git data and the patch marker are excluded
+    ret = dict()
+    for dirpath, dirnames, filenames in os.walk(dirPath):
+        dirnames[:] = [x for x in dirnames if x != ".git"]
+        for fn in filenames:
+            fullfn = os.path.join(dirpath, fn)
+            if fn != ".patched":
+                with open(fullfn, "rb") as f:
+                    ret[os.path.relpath(fullfn, dirPath)] = hashlib.md5(f.read()).hexdigest()
+    return ret
+
+
+def opSyncStandIn(tmpDir, item, repoName):
+    with open(os.path.join(tmpDir, "cfg.json"), "r") as f:
+        cfg = json.load(f)
+    repoDir = cfg["dir"][repoName]
+
+    if item in ["sync-repo", "sync-repo-without-patch"]:
+        if repoName == "gentoo":
+            robust_layer.rsync.exec("-rlptD", "--delete", cfg["url"][repoName] + "/", repoDir)
+        else:
+            robust_layer.simple_git.pull(repoDir, reclone_on_failure=True, url=cfg["url"][repoName])
+        if item == "sync-repo-without-patch":
+            return
+
+    print("Patching...")
+    if repoName == "gentoo":
+        time.sleep(1)
+        with open(os.path.join(repoDir, ".patched"), "w") as f:
+            f.write("")
+    else:
+        gentooDir = cfg["dir"]["gentoo"]
+        bOk = os.path.exists(os.path.join(gentooDir, ".patched")) and getTree(gentooDir) == getTree(os.path.join(tmpDir, "src", "gentoo"))
+        with open(os.path.join(tmpDir, "patch.log"), "a") as f:
+            f.write("%s %s\n" % (repoName, "ok" if bOk else "gentoo-not-ready"))
+    print("Done.")
+
+
+def createSource(tmpDir, repoNameList, fileNumber):
+    # gentoo repository is a plain directory, other repositories are bare git repositories, files are added when called again
+    srcDir = os.path.join(tmpDir, "src")
+    for repoName in repoNameList:
+        workDir = os.path.join(srcDir, repoName)
+        os.makedirs(os.path.join(workDir, "eclass"), exist_ok=True)
+        start = len(os.listdir(os.path.join(workDir, "eclass")))
+        for i in range(start, start + fileNumber):
+            with open(os.path.join(workDir, "eclass", "file%d.eclass" % (i)), "w") as f:
+                f.write("# %s %d\n" % (repoName, i) * 1000)
+        if repoName != "gentoo":
+            gitCmd = ["git", "-C", workDir, "-c", "user.name=test", "-c", "user.email=test@localhost"]
+            if start == 0:
+                subprocess.run(gitCmd + ["init", "-q"], check=True)
+            subprocess.run(gitCmd + ["add", "."], check=True)
+            subprocess.run(gitCmd + ["commit", "-q", "-m", "files from %d" % (start)], check=True)
+            bareDir = os.path.join(srcDir, repoName + ".git")
+            if start == 0:
+                subprocess.run(["git", "clone", "-q", "--bare", workDir, bareDir], check=True)
+            else:
+                subprocess.run(["git", "-C", workDir, "push", "-q", bareDir, "HEAD"], check=True)
+
+
+def waitPort(port):
+    for i in range(0, 50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception("server on port %d is not started" % (port))
+
+
+def runCase(title, tmpDir, cfg, syncJobNumber, syncJobNumberPerHost):
+    patchLog = os.path.join(tmpDir, "patch.log")
+    if os.path.exists(patchLog):
+        os.unlink(patchLog)
+
+    param = ParamStandIn()
+    updater = FmSysUpdater(param)
+    updater.opSync = os.path.abspath(__file__)
+    t = time.monotonic()
+    try:
+        updater._updateSyncRepositories(param.infoPrinter, None, PkgWarehouseStandIn(cfg), syncJobNumber, syncJobNumberPerHost)
+        err = None
+    except Exception as e:
+        err = e
+    t = time.monotonic() - t
+
+    bOk = err is None
+    for repoName, repoDir in cfg["dir"].items():
+        if getTree(repoDir) != getTree(os.path.join(tmpDir, "src", repoName)):
+            bOk = False
+            err = "content of repository \"%s\" differs" % (repoName)
+    if os.path.exists(patchLog):
+        with open(patchLog, "r") as f:
+            lineList = f.read().split("\n")[:-1]
+    else:
+        lineList = []
+    if sorted(lineList) != sorted(["%s ok" % (x) for x in cfg["dir"] if x != "gentoo"]):
+        bOk = False
+        err = "patch log is %s" % (lineList)
+    print("%s: %s%s in %.2fs" % ("ok" if bOk else "FAILED", title, (", %s" % (err)) if err is not None else "", t))
+    print("")
+    return bOk
+
+
+if len(sys.argv) == 4 and "SYSMAN_TEST_SYNC_DIR" in os.environ:
+    # called as op-sync, sys.argv[1] is run mode
+    opSyncStandIn(os.environ["SYSMAN_TEST_SYNC_DIR"], sys.argv[2], sys.argv[3])
+    sys.exit(0)
+
+if len(sys.argv) > 2:
+    print("syntax: test-sync-repositories [repository-number]")
+    sys.exit(1)
+
+repoNameList = ["gentoo"] + ["repo%d" % (i) for i in range(0, int(sys.argv[1]) if len(sys.argv) >= 2 else 4)]
+
+with tempfile.TemporaryDirectory() as tmpDir:
+    os.environ["SYSMAN_TEST_SYNC_DIR"] = tmpDir
+    createSource(tmpDir, repoNameList, 2000)
+
+    rsyncPort = FmUtil.getFreeTcpPort()
+    with open(os.path.join(tmpDir, "rsyncd.conf"), "w") as f:
+        f.write("use chroot = no\n")
+        f.write("[gentoo-portage]\n")
+        f.write("path = %s\n" % (os.path.join(tmpDir, "src", "gentoo")))
+        f.write("read only = yes\n")
+    rsyncProc = subprocess.Popen(["rsync", "--daemon", "--no-detach", "--address=127.0.0.1", "--port=%d" % (rsyncPort), "--config=%s" % (os.path.join(tmpDir, "rsyncd.conf"))])
+    gitPort = FmUtil.getFreeTcpPort(rsyncPort + 1)
+    gitProc = subprocess.Popen(["git", "daemon", "--reuseaddr", "--export-all", "--listen=127.0.0.1", "--port=%d" % (gitPort), "--base-path=%s" % (os.path.join(tmpDir, "src"))])
+    try:
+        waitPort(rsyncPort)
+        waitPort(gitPort)
+
+        cfg = {"dir": dict(), "url": dict()}
+        for repoName in repoNameList:
+            cfg["dir"][repoName] = os.path.join(tmpDir, "dst", repoName)
+            if repoName == "gentoo":
+                cfg["url"][repoName] = "rsync://127.0.0.1:%d/gentoo-portage" % (rsyncPort)
+            else:
+                cfg["url"][repoName] = "git://127.0.0.1:%d/%s.git" % (gitPort, repoName)
+        with open(os.path.join(tmpDir, "cfg.json"), "w") as f:
+            json.dump(cfg, f)
+
+        bOk = True
+        bOk &= runCase("initial sync, no job limit", tmpDir, cfg, None, None)
+        createSource(tmpDir, repoNameList, 500)
+        bOk &= runCase("incremental sync, 8 jobs, 1 job per host", tmpDir, cfg, 8, 1)
+        createSource(tmpDir, repoNameList, 500)
+        bOk &= runCase("incremental sync, 1 job", tmpDir, cfg, 1, None)
+    finally:
+        rsyncProc.terminate()
+        gitProc.terminate()
+        rsyncProc.wait()
+        gitProc.wait()
+
+sys.exit(0 if bOk else 1)